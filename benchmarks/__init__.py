@@ -0,0 +1,18 @@
+"""
+Benchmarks for narrative.  These are kept out of the regular test run;
+run one explicitly through the test runner, eg:
+
+    NOSE_NOCAPTURE=1 python manage.py test benchmarks/uptime_benchmark.py
+"""
+import time
+
+
+def time_call(label, func, *args, **kwargs):
+    """
+    Call func, print how long it took and return its result.
+    """
+    start_time = time.time()
+    result = func(*args, **kwargs)
+    print('{0}: {1:.3f} seconds'.format(label, time.time() - start_time))
+
+    return result
@@ -0,0 +1,30 @@
+import unittest
+
+from benchmarks import time_call
+from narrative.batteries.uptime import detect_temporal_clusters
+
+
+class ClusteringBenchmark(unittest.TestCase):
+    def test_ten_million_timestamps(self):
+        timestamp_count = 10 * 1000 * 1000
+
+        # 30 second heartbeats with an outage every 100k beats
+        time_list = []
+        current_time = 0
+
+        for idx in range(timestamp_count):
+            current_time += 30
+
+            if idx % 100000 == 0:
+                current_time += 3600
+
+            time_list.append(current_time)
+
+        numpy_clusters, numpy_threshold = time_call(
+            'detect_temporal_clusters (numpy)', detect_temporal_clusters, time_list)
+        python_clusters, python_threshold = time_call(
+            'detect_temporal_clusters (pure python)', detect_temporal_clusters, time_list, use_numpy=False)
+
+        self.assertEqual(numpy_threshold, python_threshold)
+        self.assertEqual(numpy_clusters, python_clusters)
+        self.assertEqual(timestamp_count, sum(count for start, end, count in numpy_clusters))
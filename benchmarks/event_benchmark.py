@@ -0,0 +1,37 @@
+from django.test import TestCase
+
+from benchmarks import time_call
+from narrative.events import Event
+from narrative.models import EventMeta
+
+
+class FailedJobsEvent(Event):
+    job_ids = []
+
+    def detect(self, *args, **kwargs):
+        return True
+
+    def instance_summary(self, job_id=None):
+        return {'job_id': job_id}
+
+    def detect_many(self):
+        return [self.instance_summary(job_id) for job_id in self.job_ids]
+
+
+class EventDetectionBenchmark(TestCase):
+    def test_detect_10k_instances(self):
+        event = FailedJobsEvent(EventMeta.objects.create(display_name='bench', class_load_path='bench'))
+        job_ids = list(range(10000))
+
+        def detect_one_at_a_time():
+            for job_id in job_ids:
+                event.get_or_create_summary_datum(job_id=job_id)
+
+        time_call('10k instances, one get_or_create each', detect_one_at_a_time)
+        time_call('10k instances seen before, one get_or_create each', detect_one_at_a_time)
+
+        event.event_meta = EventMeta.objects.create(display_name='bench 2', class_load_path='bench')
+        event.job_ids = job_ids
+
+        time_call('10k instances, detect_many', event.detect_and_handle)
+        time_call('10k instances seen before, detect_many', event.detect_and_handle)
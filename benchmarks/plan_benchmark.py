@@ -0,0 +1,20 @@
+import time
+import unittest
+
+from benchmarks import time_call
+from narrative.executor import Executor
+
+
+class LatencyExecutor(Executor):
+    def do_ping(self, host):
+        # Stands in for a network round trip
+        time.sleep(0.05)
+
+
+class StepGroupBenchmark(unittest.TestCase):
+    def test_latency_bound_steps(self):
+        executor = LatencyExecutor()
+        steps = [('ping', {'host': 'host-{0}'.format(i)}) for i in range(40)]
+
+        time_call('40 pings of 50ms in sequence', executor.execute, steps)
+        time_call('40 pings of 50ms in one step group', executor.execute, [steps])
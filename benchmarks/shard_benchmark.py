@@ -0,0 +1,33 @@
+import multiprocessing
+
+from django.test import TestCase
+
+from benchmarks import time_call
+from narrative.assertions import ModelAssertion
+from narrative.models import AssertionMeta
+
+from test_project.models import TestModel
+
+
+class CpuBoundModelAssertion(ModelAssertion):
+    @property
+    def queryset(self):
+        return TestModel.objects.all()
+
+    def check_record(self, record):
+        # Stands in for an expensive check
+        return sum(i * i for i in range(20000)) >= 0
+
+
+class ShardBenchmark(TestCase):
+    def test_sharded_model_assertion(self):
+        TestModel.objects.bulk_create([TestModel(id=i) for i in range(1, 2001)])
+        assertion = CpuBoundModelAssertion(AssertionMeta.objects.create(display_name='bench', class_load_path='bench'))
+
+        time_call('2000 records in order', assertion.check_and_diagnose)
+
+        for shard_workers in range(1, multiprocessing.cpu_count() + 1):
+            assertion.shard_workers = shard_workers
+
+            time_call(
+                '2000 records in {0} worker processes'.format(shard_workers), assertion.check_and_diagnose)
@@ -0,0 +1,80 @@
+import datetime
+
+from django.test import TestCase
+
+from benchmarks import time_call
+from narrative.batteries.models import HeartbeatBucket
+from narrative.batteries.uptime import (
+    detect_temporal_clusters, get_uptime_history, get_uptime_history_many, time_site_came_up, unix_timestamp,
+    DEFAULT_SERVICE_NAME)
+
+
+def insert_heartbeats(start_time, end_time, beats_per_minute=2, service_name=DEFAULT_SERVICE_NAME):
+    """
+    Insert the per-minute heartbeat buckets of a service beating
+    steadily between start_time and end_time.
+    """
+    buckets = []
+    bucket_start = start_time
+
+    while bucket_start <= end_time:
+        buckets.append(HeartbeatBucket(
+            service_name=service_name, bucket_start=bucket_start, beat_count=beats_per_minute))
+        bucket_start += datetime.timedelta(minutes=1)
+
+    HeartbeatBucket.objects.bulk_create(buckets, batch_size=500)
+
+    return len(buckets)
+
+
+class UptimeBenchmark(TestCase):
+    def test_year_of_heartbeats(self):
+        start_time = datetime.datetime(2013, 1, 1)
+        outage_start = datetime.datetime(2013, 6, 1)
+        outage_end = outage_start + datetime.timedelta(hours=2)
+        end_time = datetime.datetime(2014, 1, 1)
+
+        # Beating every 30 seconds, this is twice as many heartbeats as rows
+        bucket_count = insert_heartbeats(start_time, outage_start)
+        bucket_count += insert_heartbeats(outage_end, end_time)
+        print('Heartbeat buckets: {0} ({1} heartbeats)'.format(bucket_count, bucket_count * 2))
+
+        def full_recompute():
+            heartbeat_times = [
+                unix_timestamp(bucket_start) for bucket_start in HeartbeatBucket.objects.filter(
+                    service_name=DEFAULT_SERVICE_NAME).order_by('bucket_start').values_list('bucket_start', flat=True)
+            ]
+            return detect_temporal_clusters(heartbeat_times)
+
+        time_call('Full recompute of all clusters', full_recompute)
+
+        history = time_call('First (cold) get_uptime_history', get_uptime_history)
+        self.assertEqual(3, len(history))
+
+        time_call('Warm get_uptime_history, no new heartbeats', get_uptime_history)
+
+        insert_heartbeats(end_time + datetime.timedelta(minutes=1), end_time + datetime.timedelta(days=1))
+        time_call('Warm get_uptime_history, one new day of heartbeats', get_uptime_history)
+
+        self.assertEqual(start_time, time_call('time_site_came_up', time_site_came_up))
+
+    def test_many_services(self):
+        start_time = datetime.datetime(2013, 1, 1)
+        end_time = start_time + datetime.timedelta(days=1)
+        service_names = ['service-{0}'.format(i) for i in range(100)]
+
+        for service_name in service_names:
+            insert_heartbeats(start_time, end_time, service_name=service_name)
+
+        histories = time_call(
+            'First (cold) get_uptime_history_many, 100 services', get_uptime_history_many, service_names)
+        self.assertEqual(100, len(histories))
+
+        for service_name in service_names:
+            insert_heartbeats(
+                end_time + datetime.timedelta(minutes=1), end_time + datetime.timedelta(hours=1),
+                service_name=service_name)
+
+        time_call(
+            'Warm get_uptime_history_many, 100 services with an hour of new heartbeats',
+            get_uptime_history_many, service_names)
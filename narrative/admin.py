@@ -1,12 +1,43 @@
 """
 Admin for platform integration.
 """
-from django.contrib.admin import site
+from django.conf.urls import patterns, url
+from django.contrib.admin import ModelAdmin, site
+from django.shortcuts import render
 
 from . import models
+from .metrics import get_periodical_costs
+
+
+class PeriodicalRunAdmin(ModelAdmin):
+    """
+    The most expensive runs first; the costs view ranks the periodicals
+    themselves by the time spent running them.
+    """
+    list_display = (
+        'meta', 'started', 'duration_seconds', 'succeeded', 'query_count', 'records_checked',
+        'issues_opened', 'issues_resolved', 'emails_sent', 'notifications_deferred')
+    list_filter = ('meta_type', 'succeeded')
+    ordering = ('-duration_seconds',)
+    date_hierarchy = 'started'
+
+    def get_urls(self):
+        return patterns(
+            '',
+            url(r'^costs/$', self.admin_site.admin_view(self.costs_view), name='narrative_periodicalrun_costs'),
+        ) + super(PeriodicalRunAdmin, self).get_urls()
+
+    def costs_view(self, request):
+        return render(request, 'admin/narrative/periodicalrun/costs.html', {
+            'title': 'Periodical costs',
+            'opts': self.model._meta,
+            'costs': get_periodical_costs(),
+        })
 
 
 site.register(models.Datum)
 site.register(models.AssertionMeta)
 site.register(models.EventMeta)
 site.register(models.NarrativeConfig)
+site.register(models.SolutionJob)
+site.register(models.PeriodicalRun, PeriodicalRunAdmin)
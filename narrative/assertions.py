@@ -1,18 +1,170 @@
 import abc
 import copy
 import datetime
-import sys
-import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import time
 
 from pytz import utc as utc_tz
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models
+from django.db.models import Max, Min, Q
+from django.db.models.query import QuerySet
 from django.template.loader import render_to_string
+from django.utils import timezone
 import six
 
-from .models import Issue, ModelIssue, IssueStatusType, ResolutionStepActionType
-from .executor import Executor
+from .models import AssertionMeta, Issue, ModelIssue, IssueStatusType, ResolutionStepActionType, load_class
+from .executor import bind_active_digest, Executor
+from .jobs import enqueue_solution, get_class_load_path
+from .metrics import record_metric
+from .utils import format_error_traceback
 
 
-class Assertion(six.with_metaclass(abc.ABCMeta, object)):
+def diagnostic_priority(priority):
+    """
+    Decorator giving a diagnostic case a priority; cases with a higher
+    priority run first, and cases without one have a priority of 0.
+    """
+    def set_priority(diagnostic_case):
+        diagnostic_case.diagnostic_priority = priority
+        return diagnostic_case
+
+    return set_priority
+
+
+class DiagnosisStrategy(object):
+    # Run every diagnostic case; if more than one finds a resolution step, that is an impasse
+    ALL = 'all'
+
+    # Run the diagnostic cases in order, stopping at the first one that finds a resolution step
+    FIRST_MATCH = 'first_match'
+
+
+class AssertionType(abc.ABCMeta):
+    """
+    Metaclass of the assertions; caches the diagnostic cases of each
+    assertion class, so they are only discovered once per class.
+    """
+    # Bumped whenever a diagnostic case is added to or removed from any assertion class
+    diagnostic_case_generation = 0
+
+    def __setattr__(cls, name, value):
+        super(AssertionType, cls).__setattr__(name, value)
+
+        if name.startswith('diagnostic_case_'):
+            AssertionType.diagnostic_case_generation += 1
+
+    def __delattr__(cls, name):
+        super(AssertionType, cls).__delattr__(name)
+
+        if name.startswith('diagnostic_case_'):
+            AssertionType.diagnostic_case_generation += 1
+
+    def get_diagnostic_cases(cls):
+        """
+        Return a tuple of the names of the class's diagnostic case methods,
+        highest priority first and otherwise in alphabetical order.
+        """
+        cached = cls.__dict__.get('_diagnostic_cases')
+
+        if cached is None or cached[0] != AssertionType.diagnostic_case_generation:
+            diagnostic_cases = find_diagnostic_cases(cls, dir(cls))
+
+            # Stored with type.__setattr__ so caching does not count as a change
+            type.__setattr__(cls, '_diagnostic_cases', (AssertionType.diagnostic_case_generation, diagnostic_cases))
+
+            return diagnostic_cases
+
+        return cached[1]
+
+
+def find_diagnostic_cases(obj, member_names):
+    diagnostic_cases = [
+        member_name for member_name in member_names
+        if member_name.startswith('diagnostic_case_') and
+        callable(getattr(obj, member_name))
+    ]
+
+    # A tuple, as the class's cases are shared by all of its instances
+    return tuple(sorted(
+        diagnostic_cases,
+        key=lambda member_name: (-getattr(getattr(obj, member_name), 'diagnostic_priority', 0), member_name)))
+
+
+class DiagnosisPool(object):
+    """
+    The threads that parallel diagnoses run their cases on, shared by every
+    assertion so there are never more than NARRATIVE_DIAGNOSIS_WORKERS of
+    them (8 by default), however many diagnoses are running.  The threads
+    are started on first use, and again in a forked process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pid = None
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                self.pool = ThreadPool(getattr(settings, 'NARRATIVE_DIAGNOSIS_WORKERS', 8))
+                self.pid = os.getpid()
+
+            return self.pool
+
+    def apply_async(self, func, args, kwargs):
+        return self.get_pool().apply_async(func, args, kwargs)
+
+
+diagnosis_pool = DiagnosisPool()
+
+
+class DiagnosticCaseRun(object):
+    """
+    A diagnostic case of a parallel diagnosis, submitted to the
+    diagnosis_pool.  Its lock settles whether the case's result is used or
+    discarded, whichever of the case and the diagnosis waiting for it gets
+    there first.
+    """
+    def __init__(self, diagnostic_case_name):
+        self.diagnostic_case_name = diagnostic_case_name
+        self.lock = threading.Lock()
+        self.started = threading.Event()
+        self.start_time = None
+        self.finished = False
+        self.cancelled = False
+        self.pending_result = None
+
+    def cancel(self):
+        """
+        Discard the result of the case, returning False if the case
+        finished before it could be cancelled.
+        """
+        with self.lock:
+            if self.finished:
+                return False
+
+            self.cancelled = True
+            return True
+
+
+def discard_resolution_step(resolution_step):
+    """
+    Delete the resolution step a cancelled diagnostic case saved, so it is
+    not left behind without the diagnosis that would have used it.
+    """
+    if resolution_step is not None and resolution_step.pk is not None:
+        resolution_step.delete()
+
+
+# The DiagnosticCaseRun a diagnosis_pool thread is running
+_diagnosis_state = threading.local()
+
+
+class Assertion(six.with_metaclass(AssertionType, object)):
     """
     The assertion class is used for making
     assertions about properties of the system.
@@ -20,9 +172,21 @@ class Assertion(six.with_metaclass(abc.ABCMeta, object)):
     to fix the problem by calling any provided
     diagnostic methods.
     """
+    # How the diagnostic cases are run; a value from DiagnosisStrategy
+    diagnosis_strategy = DiagnosisStrategy.ALL
+
+    # Run the diagnostic cases concurrently on the diagnosis_pool threads (each
+    # with its own database connection); see run_diagnostic_cases_in_parallel
+    parallel_diagnosis = False
+
+    # Seconds a diagnostic case may take in a parallel diagnosis before it
+    # is treated as having found nothing
+    diagnostic_case_timeout = None
+
     def __init__(self, assertion_meta):
         self.assertion_meta = assertion_meta
         self.current_issue = None
+        self._executor = None
 
     @property
     def args(self):
@@ -34,9 +198,156 @@ class Assertion(six.with_metaclass(abc.ABCMeta, object)):
 
     @property
     def executor(self):
-        return Executor()
+        """
+        The Executor this assertion notifies and runs solutions with; one per instance.
+        """
+        if self._executor is None:
+            self._executor = Executor()
+
+        return self._executor
 
     # Diagnostic related methods ---
+    def run_diagnostic_case(self, diagnostic_case_name, *args, **kwargs):
+        """
+        Run a diagnostic case, returning its result and how many seconds it took.
+        """
+        start_time = time.time()
+
+        return getattr(self, diagnostic_case_name)(*args, **kwargs), time.time() - start_time
+
+    def run_diagnostic_cases(self, *args, **kwargs):
+        """
+        Run each diagnostic case, returning a (case name, result, seconds)
+        tuple for each, in the order of diagnostic_cases.  With the
+        FIRST_MATCH diagnosis_strategy, the cases after the first one
+        to find a resolution step are skipped and left out.
+
+        Inside a transaction, the cases of a parallel diagnosis are run in
+        order anyway, as the diagnosis_pool threads have connections of their
+        own and would not see anything written in the transaction.
+        """
+        if self.parallel_diagnosis and not connection.in_atomic_block:
+            return self.run_diagnostic_cases_in_parallel(*args, **kwargs)
+
+        case_results = []
+
+        for diagnostic_case_name in self.diagnostic_cases:
+            case_results.append(
+                (diagnostic_case_name,) + self.run_diagnostic_case(diagnostic_case_name, *args, **kwargs))
+
+            if self.diagnosis_strategy == DiagnosisStrategy.FIRST_MATCH and case_results[-1][1]:
+                break
+
+        return case_results
+
+    def run_diagnostic_cases_in_parallel(self, *args, **kwargs):
+        """
+        As run_diagnostic_cases, but with the cases running concurrently on
+        the shared diagnosis_pool; a case still running diagnostic_case_timeout
+        seconds after it started counts as having returned None after None
+        seconds.  Time spent waiting for a thread does not count against a
+        case, unless it has not started by the time all of the cases could
+        have run out of time.
+
+        A case whose result is not used, because it ran out of time or the
+        results needed were already in, is cancelled: a case not yet started
+        is skipped, and a case still running is left to finish in the
+        background, after which the resolution step it returned is deleted.
+        Long running cases should check is_diagnosis_cancelled to stop early,
+        and before writing anything else.
+
+        Notifications sent by the cases go to the digest collecting on the
+        calling thread, but metrics recorded by them are not counted in the
+        periodical's run, as the run is thread local.
+        """
+        case_runs = [DiagnosticCaseRun(diagnostic_case_name) for diagnostic_case_name in self.diagnostic_cases]
+
+        for case_run in case_runs:
+            case_run.pending_result = diagnosis_pool.apply_async(
+                bind_active_digest(self.run_cancellable_diagnostic_case), (case_run,) + args, kwargs)
+
+        case_results = []
+
+        try:
+            for case_run in case_runs:
+                case_results.append((case_run.diagnostic_case_name,) + self.get_case_run_result(
+                    case_run, len(case_runs)))
+
+                if self.diagnosis_strategy == DiagnosisStrategy.FIRST_MATCH and case_results[-1][1]:
+                    break
+
+            return case_results
+        finally:
+            # The cases after the first match, or after an error, are not waited for
+            for case_run in case_runs[len(case_results):]:
+                if not case_run.cancel():
+                    discard_resolution_step(case_run.pending_result.get()[0])
+
+    def get_case_run_result(self, case_run, case_count):
+        """
+        Wait for the result of a case of a parallel diagnosis, cancelling
+        the case if it runs out of time.
+        """
+        if not self.diagnostic_case_timeout:
+            return case_run.pending_result.get()
+
+        case_run.started.wait(self.diagnostic_case_timeout * case_count)
+
+        try:
+            if case_run.start_time is not None:
+                timeout = case_run.start_time + self.diagnostic_case_timeout - time.time()
+
+                return case_run.pending_result.get(max(timeout, 0))
+        except multiprocessing.TimeoutError:
+            pass
+
+        if case_run.cancel():
+            return None, None
+
+        # It finished just as it ran out of time
+        return case_run.pending_result.get()
+
+    def run_cancellable_diagnostic_case(self, case_run, *args, **kwargs):
+        """
+        Run a diagnostic case on a diagnosis_pool thread, unless the
+        diagnosis was cancelled before the case got a thread; the step
+        returned by a case cancelled while running is discarded.
+        """
+        with case_run.lock:
+            if case_run.cancelled:
+                return None, None
+
+            case_run.start_time = time.time()
+
+        case_run.started.set()
+        _diagnosis_state.case_run = case_run
+
+        try:
+            result, seconds = self.run_diagnostic_case(case_run.diagnostic_case_name, *args, **kwargs)
+
+            with case_run.lock:
+                if not case_run.cancelled:
+                    case_run.finished = True
+                    return result, seconds
+
+            discard_resolution_step(result)
+
+            return None, None
+        finally:
+            _diagnosis_state.case_run = None
+
+            # Each case has its own thread, and so its own database connection
+            connection.close()
+
+    def is_diagnosis_cancelled(self):
+        """
+        Determine if the parallel diagnosis the calling diagnostic case is
+        running for has gone on without it; see run_diagnostic_cases_in_parallel.
+        """
+        case_run = getattr(_diagnosis_state, 'case_run', None)
+
+        return case_run is not None and case_run.cancelled
+
     def diagnose(self, *args, **kwargs):
         """
         Run diagnostic cases and find all potential solutions.
@@ -47,13 +358,19 @@ class Assertion(six.with_metaclass(abc.ABCMeta, object)):
         """
         current_issue = kwargs['current_issue']
         # Get all diagnostic results
-        resolution_steps = [
-            getattr(self, diagnostic_case_name)(*args, **kwargs)
-            for diagnostic_case_name in self.diagnostic_cases
-        ]
+        case_results = self.run_diagnostic_cases(*args, **kwargs)
 
         # Filter out any 'None' results
-        resolution_steps = list(filter(bool, resolution_steps))
+        resolution_steps = [result for diagnostic_case_name, result, seconds in case_results if result]
+
+        if self.parallel_diagnosis:
+            # Record how long each case took on the steps that came of them
+            diagnosis_timings = dict(
+                (diagnostic_case_name, seconds) for diagnostic_case_name, result, seconds in case_results)
+
+            for resolution_step in resolution_steps:
+                resolution_step.set_diagnosis_timings(diagnosis_timings)
+                resolution_step.save()
 
         if len(resolution_steps) == 0:
             # No solution found, notify the admins
@@ -106,45 +423,64 @@ class Assertion(six.with_metaclass(abc.ABCMeta, object)):
         return Issue.objects.create(
             failed_assertion=self.assertion_meta)
 
+    def fetch_current_issue(self, *args, **kwargs):
+        """
+        Fetch the unresolved issue for these parameters in one query; if
+        there is none, a WONT_FIX issue is returned instead, if one exists.
+        """
+        issues = (
+            self.build_unresolved_issue_queryset(*args, **kwargs) |
+            self.build_wont_fix_issue_queryset(*args, **kwargs))
+
+        current_issue = None
+
+        for issue in issues:
+            if issue.status != IssueStatusType.WONT_FIX:
+                return issue
+
+            current_issue = issue
+
+        return current_issue
+
+    def resolve_issues(self, *args, **kwargs):
+        """
+        Resolve any unresolved issues for these parameters with a single
+        update, returning the number of issues resolved.
+        """
+        return self.build_unresolved_issue_queryset(*args, **kwargs).update(
+            status=IssueStatusType.RESOLVED, resolved_timestamp=self.get_utc_now())
+
     def check_and_diagnose(self, *args, **kwargs):
         """
         Check and diagnose this assertion for these parameters.
         """
-        unresolved_issue_queryset = self.build_unresolved_issue_queryset(
-            *args, **kwargs)
-        wont_fix_issue_queryset = self.build_wont_fix_issue_queryset(
-            *args, **kwargs)
-
         check_result = self.check(*args, **kwargs)
+        record_metric('records_checked')
 
         self.assertion_meta.last_check = datetime.datetime.utcnow()
-        self.assertion_meta.save()
+        self.assertion_meta.save(update_fields=['last_check'])
 
         if check_result:
-            # Everything is currently okay
-            if unresolved_issue_queryset.exists():
-                # This assertion just started passing.
-                # Set the resolved timestamp to now
-                unresolved_issue_queryset.update(resolved_timestamp=self.get_utc_now())
+            # Everything is currently okay; close any open issues
+            resolved_count = self.resolve_issues(*args, **kwargs)
+            record_metric('issues_resolved', resolved_count)
 
-                # Close any open issues
-                unresolved_issue_queryset.update(status=IssueStatusType.RESOLVED)
-
-                # Do any needed clean up.
+            if resolved_count:
+                # This assertion just started passing. Do any needed clean up.
                 self.post_recovery_cleanup(*args, **kwargs)
 
             return True
         else:
             # Something's wrong
-            if unresolved_issue_queryset.exists():
-                # Issue alredy exists
-                current_issue = unresolved_issue_queryset[0]
-            elif wont_fix_issue_queryset.exists():
-                # This is a pre-existing issue marked as WONT_FIX
-                return False
-            else:
+            current_issue = self.fetch_current_issue(*args, **kwargs)
+
+            if current_issue is None:
                 # No issue yet exists; create one
                 current_issue = self.create_issue(*args, **kwargs)
+                record_metric('issues_opened')
+            elif current_issue.status == IssueStatusType.WONT_FIX:
+                # This is a pre-existing issue marked as WONT_FIX
+                return False
 
             kwargs['current_issue'] = current_issue
 
@@ -156,13 +492,14 @@ class Assertion(six.with_metaclass(abc.ABCMeta, object)):
     @property
     def diagnostic_cases(self):
         """
-        Get all diagnostic case methods.
+        Get all diagnostic case methods, in the order they should run;
+        see AssertionType.get_diagnostic_cases.
         """
-        return [
-            member_name for member_name in dir(self)
-            if member_name.startswith('diagnostic_case_') and
-            callable(getattr(self, member_name))
-        ]
+        if any(member_name.startswith('diagnostic_case_') for member_name in self.__dict__):
+            # Cases were attached to this instance, so the class's cases are not the whole story
+            return find_diagnostic_cases(self, dir(self))
+
+        return type(self).get_diagnostic_cases()
 
     # Misc utilties for working with solutions ---
     def get_utc_now(self):
@@ -181,28 +518,47 @@ class Assertion(six.with_metaclass(abc.ABCMeta, object)):
     def execute_solution(self, solution):
         """
         Validate a solution, then step through and execute each of it's steps.
+        With NARRATIVE_QUEUE_SOLUTIONS set, the solution is queued for the
+        solution job workers instead; see narrative.jobs.
         """
         if self.validate_solution(solution):
+            if getattr(settings, 'NARRATIVE_QUEUE_SOLUTIONS', False):
+                enqueue_solution(solution, self.executor)
+                return
+
             try:
                 self.executor.execute(solution.get_plan())
             except:
                 # If an error occurrs executing the solution, store the traceback information.
-                exc_type, exc_value, tb = sys.exc_info()
-
-                solution.error_traceback = '\n'.join(
-                    traceback.format_tb(tb) + [
-                        str(exc_type),
-                        str(exc_value)])
+                solution.error_traceback = format_error_traceback()
 
             solution.enacted = self.get_utc_now()
             solution.save()
 
 
-class ModelAssertion(six.with_metaclass(abc.ABCMeta, Assertion)):
+class ModelAssertion(six.with_metaclass(AssertionType, Assertion)):
     """
     ModelAssertion is a class for making assertions about
     a particular set of models.
+
+    Querysets are read in chunks of chunk_size records (the
+    NARRATIVE_MODEL_ASSERTION_CHUNK_SIZE setting by default) ordered by
+    primary key, so memory use does not grow with the table.  Set
+    record_fields to load only the fields check_record needs.
+
+    Set modified_field to the name of a field holding when a record last
+    changed (eg, a DateTimeField with auto_now) to only check the records
+    changed since the last finished run, plus those with unresolved issues;
+    all records are still checked every full_sweep_interval.
     """
+    chunk_size = None
+    record_fields = None
+
+    # Number of worker processes to check querysets with; see check_and_diagnose_sharded
+    shard_workers = None
+
+    modified_field = None
+    full_sweep_interval = datetime.timedelta(days=1)
 
     def __init__(self, *args, **kwargs):
         super(ModelAssertion, self).__init__(*args, **kwargs)
@@ -221,30 +577,31 @@ class ModelAssertion(six.with_metaclass(abc.ABCMeta, Assertion)):
     def check(self, *args, **kwargs):
         return self.check_record(kwargs.pop('record'))
 
+    def build_record_issue_queryset(self, record):
+        """
+        All of this assertion's Model Issues for the record; the content
+        type comes from the content type cache, so there is no join.
+        """
+        return ModelIssue.objects.filter(
+            failed_assertion=self.assertion_meta,
+            model_type_id=ContentType.objects.get_for_model(record).id,
+            model_id=record.pk)
+
     def build_unresolved_issue_queryset(self, *args, **kwargs):
         """
         We override this to query for Model Issues instead of
         just Issues like the base Assertion class.
         """
-        record = kwargs['record']
-
-        return ModelIssue.objects.current_issues.filter(
-            failed_assertion=self.assertion_meta,
-            model_type__model=record.__class__.__name__.lower(),
-            model_id=record.id)
+        return self.build_record_issue_queryset(kwargs['record']).filter(
+            status__in=IssueStatusType.current_statuses)
 
     def build_wont_fix_issue_queryset(self, *args, **kwargs):
         """
         We override this to query for Model Issues instead of
         just Issues like the base Assertion class.
         """
-        record = kwargs['record']
-
-        return ModelIssue.objects.filter(
-            failed_assertion=self.assertion_meta,
-            model_type__model=record.__class__.__name__.lower(),
-            status=IssueStatusType.WONT_FIX,
-            model_id=record.id)
+        return self.build_record_issue_queryset(kwargs['record']).filter(
+            status=IssueStatusType.WONT_FIX)
 
     def create_issue(self, *args, **kwargs):
         """
@@ -257,20 +614,376 @@ class ModelAssertion(six.with_metaclass(abc.ABCMeta, Assertion)):
             failed_assertion=self.assertion_meta,
             model=record)
 
+    def get_chunk_size(self):
+        return self.chunk_size or getattr(settings, 'NARRATIVE_MODEL_ASSERTION_CHUNK_SIZE', 1000)
+
+    def iter_record_chunks(self, queryset, after_pk=None):
+        """
+        Yield the records of the queryset in lists of at most chunk_size,
+        starting after after_pk.  Each chunk is fetched with a keyset query
+        on the primary key, so no result set bigger than a chunk is held in
+        memory.
+        """
+        if not isinstance(queryset, QuerySet):
+            # Plain sequences of records are already in memory
+            yield list(queryset)
+            return
+
+        chunk_size = self.get_chunk_size()
+        queryset = queryset.order_by('pk')
+
+        if self.record_fields is not None:
+            queryset = queryset.only(*self.record_fields)
+
+        last_pk = after_pk
+
+        while True:
+            chunk_queryset = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            chunk = list(chunk_queryset[:chunk_size])
+
+            if not chunk:
+                return
+
+            yield chunk
+
+            last_pk = chunk[-1].pk
+
+            if len(chunk) < chunk_size:
+                return
+
+    def set_record_watermark(self, record_watermark, record_run_start=None):
+        self.assertion_meta.record_watermark = record_watermark
+        self.assertion_meta.record_run_start = record_run_start
+        AssertionMeta.objects.filter(id=self.assertion_meta.id).update(
+            record_watermark=record_watermark, record_run_start=record_run_start)
+
     def check_and_diagnose(self, *args, **kwargs):
         """
         ModelAssertion is kind of funny; all of the logic of
         the base Assertion class needs to be ran, but for a particular
         record.  So that's exactly what we do.
+
+        The last record of each finished chunk is stored as the watermark
+        of the assertion meta, so a run that gets interrupted continues
+        from there the next time; a run that finishes clears it.  The
+        result only covers the records checked in this run.  The start of
+        the interrupted run is stored with the watermark, and the run that
+        finishes it counts as having started then, as the records before
+        the watermark were checked no later than that.
+
+        With shard_workers set, the records are checked in worker
+        processes instead; see check_and_diagnose_sharded.
+        """
+        run_start = self.get_run_start()
+        full_sweep = self.is_full_sweep_due(run_start)
+        queryset = self.build_check_queryset(full_sweep)
+
+        if self.can_shard(queryset):
+            all_passed = self.check_and_diagnose_sharded(queryset, full_sweep, *args, **kwargs)
+        else:
+            all_passed = self.check_and_diagnose_in_order(queryset, run_start, *args, **kwargs)
+
+        if self.modified_field is not None:
+            self.finish_run(run_start, full_sweep)
+
+        return all_passed
+
+    def get_run_start(self):
+        """
+        When this run started; for a run that continues from the watermark,
+        when the interrupted run did.
+        """
+        if self.assertion_meta.record_watermark is not None and self.assertion_meta.record_run_start is not None:
+            return self.assertion_meta.record_run_start
+
+        return timezone.now()
+
+    def is_full_sweep_due(self, now):
         """
-        results = []
+        Determine whether this run has to check all of the records, rather
+        than only those changed since the last finished run.
+        """
+        if self.modified_field is None or self.assertion_meta.last_complete_run is None:
+            return True
+
+        if self.full_sweep_interval is None:
+            return False
+
+        last_full_sweep = self.assertion_meta.last_full_sweep
+
+        return last_full_sweep is None or last_full_sweep + self.full_sweep_interval <= now
+
+    def build_check_queryset(self, full_sweep):
+        """
+        The records to check in this run; for an incremental run, those
+        changed since the last finished run and those with unresolved issues.
+        """
+        queryset = self.queryset
+
+        if full_sweep or not isinstance(queryset, QuerySet):
+            return queryset
+
+        open_issue_pks = ModelIssue.objects.current_issues.filter(
+            failed_assertion=self.assertion_meta,
+            model_type_id=ContentType.objects.get_for_model(queryset.model).id).values('model_id')
+
+        return queryset.filter(
+            Q(**{'{0}__gte'.format(self.modified_field): self.assertion_meta.last_complete_run}) |
+            Q(pk__in=open_issue_pks))
+
+    def finish_run(self, run_start, full_sweep):
+        """
+        Record that every record changed before run_start has been checked.
+        """
+        finished_fields = {'last_complete_run': run_start}
 
-        for record in self.queryset:
-            # For each record
+        if full_sweep:
+            finished_fields['last_full_sweep'] = run_start
+
+        for field_name, value in finished_fields.items():
+            setattr(self.assertion_meta, field_name, value)
+
+        AssertionMeta.objects.filter(id=self.assertion_meta.id).update(**finished_fields)
+
+    def check_and_diagnose_chunk(self, chunk, *args, **kwargs):
+        all_passed = True
+
+        for record in chunk:
             args_copy = copy.copy(args)
             kwargs_copy = copy.copy(kwargs)
             kwargs_copy['record'] = record
 
-            results.append(super(ModelAssertion, self).check_and_diagnose(*args_copy, **kwargs_copy))
+            if not super(ModelAssertion, self).check_and_diagnose(*args_copy, **kwargs_copy):
+                all_passed = False
+
+        return all_passed
+
+    def check_and_diagnose_in_order(self, queryset, run_start, *args, **kwargs):
+        all_passed = True
+
+        for chunk in self.iter_record_chunks(queryset, self.assertion_meta.record_watermark):
+            if not self.check_and_diagnose_chunk(chunk, *args, **kwargs):
+                all_passed = False
+
+            if isinstance(queryset, QuerySet):
+                self.set_record_watermark(chunk[-1].pk, run_start)
+
+        if self.assertion_meta.record_watermark is not None:
+            self.set_record_watermark(None)
+
+        return all_passed
+
+    def check_and_diagnose_records(self, pks, *args, **kwargs):
+        """
+        Check and diagnose just the records of the queryset with these
+        primary keys, eg because they changed; see narrative.triggers.
+        """
+        queryset = self.queryset
+        pks = set(pks)
+
+        if isinstance(queryset, QuerySet):
+            queryset = queryset.filter(pk__in=pks)
+        else:
+            queryset = [record for record in queryset if record.pk in pks]
+
+        all_passed = True
+
+        for chunk in self.iter_record_chunks(queryset):
+            if not self.check_and_diagnose_chunk(chunk, *args, **kwargs):
+                all_passed = False
+
+        return all_passed
+
+    def can_shard(self, queryset):
+        """
+        Determine if the queryset can be checked in worker processes; see
+        check_and_diagnose_sharded.  Inside a transaction it cannot, as the
+        workers would not see its changes and closing its connection would
+        end it, so the records are checked in order instead.
+        """
+        return (
+            bool(self.shard_workers) and isinstance(queryset, QuerySet) and
+            isinstance(queryset.model._meta.pk, (models.AutoField, models.IntegerField)) and
+            not connection.in_atomic_block)
+
+    def check_shard(self, first_pk, last_pk, full_sweep=True):
+        """
+        Run check_record on the records to check with primary keys from
+        first_pk to last_pk, returning the primary keys of the records that
+        passed and of those that failed.
+        """
+        passed_pks = []
+        failed_pks = []
+        queryset = self.build_check_queryset(full_sweep).filter(pk__gte=first_pk, pk__lte=last_pk)
+
+        for chunk in self.iter_record_chunks(queryset):
+            for record in chunk:
+                (passed_pks if self.check_record(record) else failed_pks).append(record.pk)
+
+        return (passed_pks, failed_pks)
+
+    def check_and_diagnose_sharded(self, queryset, full_sweep, *args, **kwargs):
+        """
+        Split the queryset into primary key ranges and run check_record on
+        them in a pool of shard_workers processes.  Only the checks run in
+        the workers; the issues of the records are then resolved, looked up
+        and created here, a chunk of records at a time.
+
+        The assertion class must be importable by the workers, and its
+        check_record may only read from the database.  The shards are
+        ranges of integer primary keys, so models with any other kind of
+        primary key are checked in order (see can_shard).  Every shard is
+        checked on every run, so record_watermark is not used; the run
+        clears any left by an interrupted run in order, as it covers
+        those records too.
+        """
+        pk_bounds = queryset.aggregate(first_pk=Min('pk'), last_pk=Max('pk'))
+        shard_results = []
+
+        if pk_bounds['first_pk'] is not None:
+            # A few shards per worker keeps the workers busy when shards take uneven time
+            pk_ranges = split_pk_range(pk_bounds['first_pk'], pk_bounds['last_pk'], self.shard_workers * 4)
+            shard_args = [
+                (get_class_load_path(type(self)), self.assertion_meta, pk_range, full_sweep)
+                for pk_range in pk_ranges
+            ]
+
+            # Forked workers must not share the database connection
+            connection.close()
+
+            pool = multiprocessing.Pool(self.shard_workers)
+
+            try:
+                shard_results = pool.map(check_record_shard, shard_args)
+            finally:
+                pool.close()
+                pool.join()
+
+        self.assertion_meta.last_check = datetime.datetime.utcnow()
+        self.assertion_meta.save(update_fields=['last_check'])
+
+        if self.assertion_meta.record_watermark is not None:
+            self.set_record_watermark(None)
+
+        failed_pks = []
+
+        for passed_pks, shard_failed_pks in shard_results:
+            record_metric('records_checked', len(passed_pks) + len(shard_failed_pks))
+            self.resolve_record_issues(queryset, passed_pks, *args, **kwargs)
+            failed_pks.extend(shard_failed_pks)
+
+        self.diagnose_records(queryset, failed_pks, *args, **kwargs)
+
+        return not failed_pks
+
+    def build_records_issue_queryset(self, model, pks):
+        return ModelIssue.objects.filter(
+            failed_assertion=self.assertion_meta,
+            model_type_id=ContentType.objects.get_for_model(model).id,
+            model_id__in=pks)
+
+    def iter_pk_chunks(self, pks):
+        chunk_size = self.get_chunk_size()
+
+        for index in range(0, len(pks), chunk_size):
+            yield pks[index:index + chunk_size]
+
+    def resolve_record_issues(self, queryset, pks, *args, **kwargs):
+        """
+        Resolve the unresolved issues of the records with these primary
+        keys, which passed their check, and clean up after them.
+        """
+        for pk_chunk in self.iter_pk_chunks(pks):
+            issues = self.build_records_issue_queryset(queryset.model, pk_chunk).filter(
+                status__in=IssueStatusType.current_statuses)
+            recovered_pks = list(issues.values_list('model_id', flat=True))
+
+            if not recovered_pks:
+                continue
+
+            record_metric(
+                'issues_resolved',
+                issues.update(status=IssueStatusType.RESOLVED, resolved_timestamp=self.get_utc_now()))
+
+            for record in queryset.filter(pk__in=recovered_pks):
+                kwargs_copy = copy.copy(kwargs)
+                kwargs_copy['record'] = record
+
+                self.post_recovery_cleanup(*args, **kwargs_copy)
+
+    def resolve_deleted_record_issues(self, model, pks):
+        """
+        Resolve the unresolved issues of the records of the model with these
+        primary keys, which were deleted; there is no record left to check
+        or to clean up after.  Returns the number of issues resolved.
+        """
+        resolved_count = 0
+
+        for pk_chunk in self.iter_pk_chunks(pks):
+            resolved_count += self.build_records_issue_queryset(model, pk_chunk).filter(
+                status__in=IssueStatusType.current_statuses).update(
+                status=IssueStatusType.RESOLVED, resolved_timestamp=self.get_utc_now())
+
+        record_metric('issues_resolved', resolved_count)
+
+        return resolved_count
+
+    def fetch_current_record_issues(self, model, pks):
+        """
+        Fetch the current issues of the records with these primary keys in
+        one query, keyed by primary key; like fetch_current_issue, a record's
+        WONT_FIX issue is only returned if it has no unresolved one.
+        """
+        current_issues = {}
+
+        for issue in self.build_records_issue_queryset(model, pks).exclude(status=IssueStatusType.RESOLVED):
+            current_issue = current_issues.get(issue.model_id)
+
+            if current_issue is None or current_issue.status == IssueStatusType.WONT_FIX:
+                current_issues[issue.model_id] = issue
+
+        return current_issues
+
+    def diagnose_records(self, queryset, pks, *args, **kwargs):
+        """
+        Diagnose the records with these primary keys, which failed their
+        check, creating issues for those that do not have one yet.  Records
+        with a WONT_FIX issue are left alone.
+        """
+        for pk_chunk in self.iter_pk_chunks(pks):
+            current_issues = self.fetch_current_record_issues(queryset.model, pk_chunk)
+
+            for record in queryset.filter(pk__in=pk_chunk):
+                kwargs_copy = copy.copy(kwargs)
+                kwargs_copy['record'] = record
+                kwargs_copy['current_issue'] = current_issues.get(record.pk)
+
+                if kwargs_copy['current_issue'] is None:
+                    kwargs_copy['current_issue'] = self.create_issue(*args, **kwargs_copy)
+                    record_metric('issues_opened')
+                elif kwargs_copy['current_issue'].status == IssueStatusType.WONT_FIX:
+                    continue
+
+                self.diagnose(*args, **kwargs_copy)
+
+
+def split_pk_range(first_pk, last_pk, shard_count):
+    """
+    Split the integer primary keys from first_pk to last_pk into at most
+    shard_count contiguous (first, last) ranges of about equal size.
+    """
+    shard_size = max(1, -(-(last_pk - first_pk + 1) // shard_count))
+
+    return [
+        (shard_first_pk, min(shard_first_pk + shard_size - 1, last_pk))
+        for shard_first_pk in range(first_pk, last_pk + 1, shard_size)
+    ]
+
+
+def check_record_shard(shard_args):
+    """
+    Check a shard of a model assertion's records in a worker process.
+    """
+    class_load_path, assertion_meta, (first_pk, last_pk), full_sweep = shard_args
 
-        return all(results)
+    return load_class(class_load_path)(assertion_meta).check_shard(first_pk, last_pk, full_sweep)
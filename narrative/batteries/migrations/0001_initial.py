@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UptimeSegment',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('start', models.DateTimeField(db_index=True)),
+                ('end', models.DateTimeField()),
+                ('heartbeat_count', models.PositiveIntegerField(default=1)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='UptimeState',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('origin', models.CharField(max_length=64)),
+                ('datum_name', models.CharField(max_length=64)),
+                ('watermark', models.DateTimeField(default=None, null=True, blank=True)),
+                ('cluster_threshold_seconds', models.IntegerField(default=None, null=True, blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='uptimestate',
+            unique_together=set([('origin', 'datum_name')]),
+        ),
+        migrations.AddField(
+            model_name='uptimesegment',
+            name='uptime_state',
+            field=models.ForeignKey(to='batteries.UptimeState'),
+            preserve_default=True,
+        ),
+    ]
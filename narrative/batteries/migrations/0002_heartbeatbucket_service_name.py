@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('batteries', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HeartbeatBucket',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('service_name', models.CharField(max_length=64)),
+                ('bucket_start', models.DateTimeField(db_index=True)),
+                ('beat_count', models.PositiveIntegerField(default=1)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='heartbeatbucket',
+            unique_together=set([('service_name', 'bucket_start')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='uptimestate',
+            unique_together=set([]),
+        ),
+        migrations.RemoveField(
+            model_name='uptimestate',
+            name='datum_name',
+        ),
+        # Existing states were all for the external heartbeat, whose origin is the default service name
+        migrations.RenameField(
+            model_name='uptimestate',
+            old_name='origin',
+            new_name='service_name',
+        ),
+        migrations.AlterField(
+            model_name='uptimestate',
+            name='service_name',
+            field=models.CharField(unique=True, max_length=64),
+            preserve_default=True,
+        ),
+    ]
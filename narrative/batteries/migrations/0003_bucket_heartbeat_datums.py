@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import itertools
+
+from django.db import models, migrations
+
+# The origin and datum name heartbeats were logged under before they were bucketed;
+# the origin is the default service name
+HEARTBEAT_ORIGIN = 'external_heartbeat'
+HEARTBEAT_DATUM_NAME = 'beat'
+
+BUCKET_BATCH_SIZE = 1000
+
+
+def bucket_heartbeat_datums(apps, schema_editor):
+    Datum = apps.get_model('narrative', 'Datum')
+    HeartbeatBucket = apps.get_model('batteries', 'HeartbeatBucket')
+    UptimeState = apps.get_model('batteries', 'UptimeState')
+
+    heartbeat_times = Datum.objects.filter(
+        origin=HEARTBEAT_ORIGIN, datum_name=HEARTBEAT_DATUM_NAME).order_by('timestamp').values_list(
+        'timestamp', flat=True)
+    existing_bucket_ids = dict(HeartbeatBucket.objects.filter(
+        service_name=HEARTBEAT_ORIGIN).values_list('bucket_start', 'id'))
+
+    new_buckets = []
+
+    for bucket_start, beats in itertools.groupby(
+            heartbeat_times.iterator(), key=lambda timestamp: timestamp.replace(second=0, microsecond=0)):
+        beat_count = len(list(beats))
+
+        if bucket_start in existing_bucket_ids:
+            HeartbeatBucket.objects.filter(id=existing_bucket_ids[bucket_start]).update(
+                beat_count=models.F('beat_count') + beat_count)
+        else:
+            new_buckets.append(HeartbeatBucket(
+                service_name=HEARTBEAT_ORIGIN, bucket_start=bucket_start, beat_count=beat_count))
+
+        if len(new_buckets) >= BUCKET_BATCH_SIZE:
+            HeartbeatBucket.objects.bulk_create(new_buckets)
+            new_buckets = []
+
+    HeartbeatBucket.objects.bulk_create(new_buckets)
+
+    # Thresholds learned from individual datums are finer than the minute buckets; learn them again
+    UptimeState.objects.filter(cluster_threshold_seconds__lt=60).update(cluster_threshold_seconds=None)
+
+
+def leave_heartbeat_datums(apps, schema_editor):
+    # The datums are left in place, so there is nothing to undo
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('batteries', '0002_heartbeatbucket_service_name'),
+        ('narrative', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(bucket_heartbeat_datums, leave_heartbeat_datums),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('batteries', '0003_bucket_heartbeat_datums'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uptimestate',
+            name='cluster_threshold_learned',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='uptimestate',
+            name='cluster_threshold_sample_size',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,65 @@
+from django.db import models
+import six
+
+
+@six.python_2_unicode_compatible
+class HeartbeatBucket(models.Model):
+    """
+    A rollup of the heartbeats a service sent during one minute; a
+    service gets at most one row per minute, however often it beats.
+    """
+    class Meta:
+        unique_together = ('service_name', 'bucket_start',)
+
+    service_name = models.CharField(max_length=64)
+
+    # The start of the minute these heartbeats arrived in
+    bucket_start = models.DateTimeField(db_index=True)
+
+    beat_count = models.PositiveIntegerField(default=1)
+
+    def __str__(self):
+        return 'HeartbeatBucket - service_name:{0} bucket_start:{1} beat_count:{2}'.format(
+            self.service_name, self.bucket_start, self.beat_count)
+
+
+@six.python_2_unicode_compatible
+class UptimeState(models.Model):
+    """
+    Bookkeeping for the incremental uptime computation of a service;
+    records how far into its heartbeats we have processed and how
+    big a gap between heartbeats has to be to count as downtime.
+    """
+    service_name = models.CharField(max_length=64, unique=True)
+
+    # Start of the most recent heartbeat bucket folded into the uptime segments
+    watermark = models.DateTimeField(null=True, blank=True, default=None)
+
+    # Any gap between heartbeats larger than this starts a new segment;
+    # learned from the latest heartbeats, and learned again once it is old
+    # or if it was learned from too few of them (see learn_cluster_thresholds)
+    cluster_threshold_seconds = models.IntegerField(null=True, blank=True, default=None)
+    cluster_threshold_sample_size = models.PositiveIntegerField(default=0)
+    cluster_threshold_learned = models.DateTimeField(null=True, blank=True, default=None)
+
+    def __str__(self):
+        return 'UptimeState - service_name:{0} watermark:{1}'.format(self.service_name, self.watermark)
+
+
+@six.python_2_unicode_compatible
+class UptimeSegment(models.Model):
+    """
+    A run of heartbeats close enough together that the site is
+    considered to have been up for the whole run.
+    """
+    uptime_state = models.ForeignKey(UptimeState)
+
+    start = models.DateTimeField(db_index=True)
+    end = models.DateTimeField()
+
+    # Heartbeats counted in the segment's buckets at the time they were processed
+    heartbeat_count = models.PositiveIntegerField(default=1)
+
+    def __str__(self):
+        return 'UptimeSegment - {0} to {1} ({2} heartbeats)'.format(
+            self.start, self.end, self.heartbeat_count)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'UptimeState'
+        db.create_table(u'batteries_uptimestate', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('origin', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('datum_name', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('watermark', self.gf('django.db.models.fields.DateTimeField')(default=None, null=True, blank=True)),
+            ('cluster_threshold_seconds', self.gf('django.db.models.fields.IntegerField')(default=None, null=True, blank=True)),
+        ))
+        db.send_create_signal(u'batteries', ['UptimeState'])
+
+        # Adding unique constraint on 'UptimeState', fields ['origin', 'datum_name']
+        db.create_unique(u'batteries_uptimestate', ['origin', 'datum_name'])
+
+        # Adding model 'UptimeSegment'
+        db.create_table(u'batteries_uptimesegment', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('uptime_state', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['batteries.UptimeState'])),
+            ('start', self.gf('django.db.models.fields.DateTimeField')(db_index=True)),
+            ('end', self.gf('django.db.models.fields.DateTimeField')()),
+            ('heartbeat_count', self.gf('django.db.models.fields.PositiveIntegerField')(default=1)),
+        ))
+        db.send_create_signal(u'batteries', ['UptimeSegment'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'UptimeState', fields ['origin', 'datum_name']
+        db.delete_unique(u'batteries_uptimestate', ['origin', 'datum_name'])
+
+        # Deleting model 'UptimeState'
+        db.delete_table(u'batteries_uptimestate')
+
+        # Deleting model 'UptimeSegment'
+        db.delete_table(u'batteries_uptimesegment')
+
+
+    models = {
+        u'batteries.uptimesegment': {
+            'Meta': {'object_name': 'UptimeSegment'},
+            'end': ('django.db.models.fields.DateTimeField', [], {}),
+            'heartbeat_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'uptime_state': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['batteries.UptimeState']"})
+        },
+        u'batteries.uptimestate': {
+            'Meta': {'unique_together': "(('origin', 'datum_name'),)", 'object_name': 'UptimeState'},
+            'cluster_threshold_seconds': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'datum_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'origin': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'watermark': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['batteries']
\ No newline at end of file
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'HeartbeatBucket'
+        db.create_table(u'batteries_heartbeatbucket', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('service_name', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('bucket_start', self.gf('django.db.models.fields.DateTimeField')(db_index=True)),
+            ('beat_count', self.gf('django.db.models.fields.PositiveIntegerField')(default=1)),
+        ))
+        db.send_create_signal(u'batteries', ['HeartbeatBucket'])
+
+        # Adding unique constraint on 'HeartbeatBucket', fields ['service_name', 'bucket_start']
+        db.create_unique(u'batteries_heartbeatbucket', ['service_name', 'bucket_start'])
+
+        # Removing unique constraint on 'UptimeState', fields ['origin', 'datum_name']
+        db.delete_unique(u'batteries_uptimestate', ['origin', 'datum_name'])
+
+        # Deleting field 'UptimeState.datum_name'
+        db.delete_column(u'batteries_uptimestate', 'datum_name')
+
+        # Renaming field 'UptimeState.origin' to 'UptimeState.service_name'; existing states
+        # were all for the external heartbeat, whose origin is the default service name
+        db.rename_column(u'batteries_uptimestate', 'origin', 'service_name')
+
+        # Adding unique constraint on 'UptimeState', fields ['service_name']
+        db.create_unique(u'batteries_uptimestate', ['service_name'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'UptimeState', fields ['service_name']
+        db.delete_unique(u'batteries_uptimestate', ['service_name'])
+
+        # Renaming field 'UptimeState.service_name' to 'UptimeState.origin'
+        db.rename_column(u'batteries_uptimestate', 'service_name', 'origin')
+
+        # Adding field 'UptimeState.datum_name'
+        db.add_column(u'batteries_uptimestate', 'datum_name',
+                      self.gf('django.db.models.fields.CharField')(default='beat', max_length=64),
+                      keep_default=False)
+
+        # Adding unique constraint on 'UptimeState', fields ['origin', 'datum_name']
+        db.create_unique(u'batteries_uptimestate', ['origin', 'datum_name'])
+
+        # Removing unique constraint on 'HeartbeatBucket', fields ['service_name', 'bucket_start']
+        db.delete_unique(u'batteries_heartbeatbucket', ['service_name', 'bucket_start'])
+
+        # Deleting model 'HeartbeatBucket'
+        db.delete_table(u'batteries_heartbeatbucket')
+
+
+    models = {
+        u'batteries.heartbeatbucket': {
+            'Meta': {'unique_together': "(('service_name', 'bucket_start'),)", 'object_name': 'HeartbeatBucket'},
+            'beat_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            'bucket_start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'service_name': ('django.db.models.fields.CharField', [], {'max_length': '64'})
+        },
+        u'batteries.uptimesegment': {
+            'Meta': {'object_name': 'UptimeSegment'},
+            'end': ('django.db.models.fields.DateTimeField', [], {}),
+            'heartbeat_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'uptime_state': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['batteries.UptimeState']"})
+        },
+        u'batteries.uptimestate': {
+            'Meta': {'object_name': 'UptimeState'},
+            'cluster_threshold_seconds': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'service_name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'watermark': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['batteries']
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+import itertools
+
+# The origin and datum name heartbeats were logged under before they were bucketed;
+# the origin is the default service name
+HEARTBEAT_ORIGIN = 'external_heartbeat'
+HEARTBEAT_DATUM_NAME = 'beat'
+
+BUCKET_BATCH_SIZE = 1000
+
+
+class Migration(DataMigration):
+
+    depends_on = (
+        ('narrative', '0029_auto__add_periodicalrun__add_index_periodicalrun_meta_type_meta_id_sta'),
+    )
+
+    def forwards(self, orm):
+        # Count the heartbeats logged as datums into the default service's minute buckets
+        heartbeat_times = orm['narrative.Datum'].objects.filter(
+            origin=HEARTBEAT_ORIGIN, datum_name=HEARTBEAT_DATUM_NAME).order_by(
+            'timestamp').values_list('timestamp', flat=True)
+        existing_bucket_ids = dict(orm.HeartbeatBucket.objects.filter(
+            service_name=HEARTBEAT_ORIGIN).values_list('bucket_start', 'id'))
+
+        new_buckets = []
+
+        for bucket_start, beats in itertools.groupby(
+                heartbeat_times.iterator(), key=lambda timestamp: timestamp.replace(second=0, microsecond=0)):
+            beat_count = len(list(beats))
+
+            if bucket_start in existing_bucket_ids:
+                orm.HeartbeatBucket.objects.filter(id=existing_bucket_ids[bucket_start]).update(
+                    beat_count=models.F('beat_count') + beat_count)
+            else:
+                new_buckets.append(orm.HeartbeatBucket(
+                    service_name=HEARTBEAT_ORIGIN, bucket_start=bucket_start, beat_count=beat_count))
+
+            if len(new_buckets) >= BUCKET_BATCH_SIZE:
+                orm.HeartbeatBucket.objects.bulk_create(new_buckets)
+                new_buckets = []
+
+        orm.HeartbeatBucket.objects.bulk_create(new_buckets)
+
+        # Thresholds learned from individual datums are finer than the minute buckets; learn them again
+        orm.UptimeState.objects.filter(cluster_threshold_seconds__lt=60).update(cluster_threshold_seconds=None)
+
+    def backwards(self, orm):
+        # The datums are left in place, so there is nothing to undo
+        pass
+
+    models = {
+        u'batteries.heartbeatbucket': {
+            'Meta': {'unique_together': "(('service_name', 'bucket_start'),)", 'object_name': 'HeartbeatBucket'},
+            'beat_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            'bucket_start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'service_name': ('django.db.models.fields.CharField', [], {'max_length': '64'})
+        },
+        u'batteries.uptimesegment': {
+            'Meta': {'object_name': 'UptimeSegment'},
+            'end': ('django.db.models.fields.DateTimeField', [], {}),
+            'heartbeat_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'uptime_state': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['batteries.UptimeState']"})
+        },
+        u'batteries.uptimestate': {
+            'Meta': {'object_name': 'UptimeState'},
+            'cluster_threshold_seconds': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'service_name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'watermark': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'narrative.assertionmeta': {
+            'Meta': {'unique_together': "(('display_name', 'class_load_path'),)", 'object_name': 'AssertionMeta'},
+            'args_json': ('django.db.models.fields.TextField', [], {'default': "'{}'", 'blank': 'True'}),
+            'check_interval_seconds': ('django.db.models.fields.IntegerField', [], {'default': '3600'}),
+            'class_load_path': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '96'}),
+            'display_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_check': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(1970, 1, 1, 0, 0)'}),
+            'last_complete_run': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'last_full_sweep': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'record_watermark': ('django.db.models.fields.PositiveIntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        },
+        u'narrative.datum': {
+            'Meta': {'object_name': 'Datum'},
+            'datum_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'datum_note_json': ('django.db.models.fields.TextField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'expiration_time': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log_level': ('django.db.models.fields.IntegerField', [], {'default': '2'}),
+            'origin': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'thread_id': ('django.db.models.fields.CharField', [], {'max_length': '36', 'null': 'True', 'blank': 'True'}),
+            'timestamp': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'})
+        },
+        u'narrative.eventmeta': {
+            'Meta': {'unique_together': "(('display_name', 'class_load_path'),)", 'object_name': 'EventMeta'},
+            'args_json': ('django.db.models.fields.TextField', [], {'default': "'{}'", 'blank': 'True'}),
+            'check_interval_seconds': ('django.db.models.fields.IntegerField', [], {'default': '3600'}),
+            'class_load_path': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '96'}),
+            'display_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'enabled': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_check': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(1970, 1, 1, 0, 0)'})
+        },
+        u'narrative.issue': {
+            'Meta': {'object_name': 'Issue', 'index_together': "(('failed_assertion', 'status'),)"},
+            'created_timestamp': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'failed_assertion': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['narrative.AssertionMeta']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'non_pass_step_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'resolved_timestamp': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        u'narrative.modelissue': {
+            'Meta': {'object_name': 'ModelIssue', '_ormbases': [u'narrative.Issue'], 'index_together': "(('model_type', 'model_id'),)"},
+            u'issue_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['narrative.Issue']", 'unique': 'True', 'primary_key': 'True'}),
+            'model_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'model_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"})
+        },
+        u'narrative.narrativeconfig': {
+            'Meta': {'object_name': 'NarrativeConfig'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'minimum_datum_log_level': ('django.db.models.fields.IntegerField', [], {'default': '2'})
+        },
+        u'narrative.periodicalrun': {
+            'Meta': {'object_name': 'PeriodicalRun', 'index_together': "(('meta_type', 'meta_id', 'started'),)"},
+            'duration_seconds': ('django.db.models.fields.FloatField', [], {}),
+            'emails_sent': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issues_opened': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'issues_resolved': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'meta_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'meta_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            'query_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'records_checked': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'succeeded': ('django.db.models.fields.NullBooleanField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        },
+        u'narrative.resolutionstep': {
+            'Meta': {'object_name': 'ResolutionStep'},
+            'action_type': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'diagnosis_timings_json': ('django.db.models.fields.TextField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'issue': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['narrative.Issue']"}),
+            'reason': ('django.db.models.fields.CharField', [], {'default': 'None', 'max_length': '64', 'null': 'True', 'blank': 'True'}),
+            'solution': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['narrative.Solution']", 'null': 'True', 'blank': 'True'})
+        },
+        u'narrative.solution': {
+            'Meta': {'object_name': 'Solution'},
+            'diagnostic_case_name': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'enacted': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'error_traceback': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'operation_signature': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '40', 'db_index': 'True'}),
+            'plan_json': ('django.db.models.fields.TextField', [], {}),
+            'problem_description': ('django.db.models.fields.CharField', [], {'max_length': '128'})
+        },
+        u'narrative.solutionjob': {
+            'Meta': {'object_name': 'SolutionJob'},
+            'attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'error_traceback': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'executor_class_load_path': ('django.db.models.fields.CharField', [], {'max_length': '96'}),
+            'finished': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'max_attempts': ('django.db.models.fields.PositiveIntegerField', [], {'default': '3'}),
+            'next_attempt': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.utcnow', 'db_index': 'True'}),
+            'solution': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['narrative.Solution']"}),
+            'started': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_index': 'True'})
+        }
+    }
+
+    complete_apps = ['narrative', 'batteries']
+    symmetrical = True
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding field 'UptimeState.cluster_threshold_sample_size'
+        db.add_column(u'batteries_uptimestate', 'cluster_threshold_sample_size',
+                      self.gf('django.db.models.fields.PositiveIntegerField')(default=0),
+                      keep_default=False)
+
+        # Adding field 'UptimeState.cluster_threshold_learned'
+        db.add_column(u'batteries_uptimestate', 'cluster_threshold_learned',
+                      self.gf('django.db.models.fields.DateTimeField')(default=None, null=True, blank=True),
+                      keep_default=False)
+
+
+    def backwards(self, orm):
+        # Deleting field 'UptimeState.cluster_threshold_sample_size'
+        db.delete_column(u'batteries_uptimestate', 'cluster_threshold_sample_size')
+
+        # Deleting field 'UptimeState.cluster_threshold_learned'
+        db.delete_column(u'batteries_uptimestate', 'cluster_threshold_learned')
+
+
+    models = {
+        u'batteries.heartbeatbucket': {
+            'Meta': {'unique_together': "(('service_name', 'bucket_start'),)", 'object_name': 'HeartbeatBucket'},
+            'beat_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            'bucket_start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'service_name': ('django.db.models.fields.CharField', [], {'max_length': '64'})
+        },
+        u'batteries.uptimesegment': {
+            'Meta': {'object_name': 'UptimeSegment'},
+            'end': ('django.db.models.fields.DateTimeField', [], {}),
+            'heartbeat_count': ('django.db.models.fields.PositiveIntegerField', [], {'default': '1'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'start': ('django.db.models.fields.DateTimeField', [], {'db_index': 'True'}),
+            'uptime_state': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['batteries.UptimeState']"})
+        },
+        u'batteries.uptimestate': {
+            'Meta': {'object_name': 'UptimeState'},
+            'cluster_threshold_learned': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            'cluster_threshold_sample_size': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'cluster_threshold_seconds': ('django.db.models.fields.IntegerField', [], {'default': 'None', 'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'service_name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '64'}),
+            'watermark': ('django.db.models.fields.DateTimeField', [], {'default': 'None', 'null': 'True', 'blank': 'True'})
+        }
+    }
+
+    complete_apps = ['batteries']
\ No newline at end of file
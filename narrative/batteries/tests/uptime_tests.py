@@ -1,11 +1,24 @@
 import datetime
+import threading
+import time
 import unittest
 
-from narrative.batteries.uptime import detect_temporal_clusters, heartbeat_details, get_uptime_history, UptimeEventTypes
-from narrative.models import Datum
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+from pytz import utc
 
+from narrative.batteries.models import HeartbeatBucket, UptimeSegment, UptimeState
+from narrative.batteries.uptime import (
+    compute_interval_list, create_heartbeat, detect_temporal_clusters, get_uptime_history, get_uptime_history_many,
+    record_heartbeat, split_temporal_clusters, supports_window_functions, time_site_came_up, unix_timestamp,
+    update_uptime_segments, DEFAULT_SERVICE_NAME, HeartbeatThrottle, UptimeEventTypes)
 
-def simulate_uptime(start_time, end_time, interval=None):
+
+def simulate_uptime(start_time, end_time, interval=None, service_name=DEFAULT_SERVICE_NAME):
     """
     Create the needed heartbeats to simulate uptime during the
     specified time range.
@@ -14,16 +27,141 @@ def simulate_uptime(start_time, end_time, interval=None):
 
     interval_seconds = int(interval.total_seconds())
 
-    for beat_time in range(
-            int(start_time.strftime('%s')),
-            int(end_time.strftime('%s')) + interval_seconds,
-            interval_seconds):
-        # Create an datum
-        evt = Datum.objects.create(
-            origin=heartbeat_details['origin'], datum_name=heartbeat_details['datum_name'])
-        # Reset it's creation timestamp for testing purposes
-        evt.timestamp = datetime.datetime.utcfromtimestamp(beat_time)
-        evt.save()
+    for beat_time in range(unix_timestamp(start_time), unix_timestamp(end_time) + interval_seconds, interval_seconds):
+        record_heartbeat(service_name, datetime.datetime.utcfromtimestamp(beat_time))
+
+
+def run_in_threads(thread_count, target):
+    """
+    Start thread_count threads running target as close to simultaneously
+    as possible, and wait for them all to finish.
+    """
+    start_event = threading.Event()
+
+    def run():
+        start_event.wait()
+        target()
+
+    threads = [threading.Thread(target=run) for i in range(thread_count)]
+
+    for thread in threads:
+        thread.start()
+
+    start_event.set()
+
+    for thread in threads:
+        thread.join()
+
+
+class TestCreateHeartbeat(TestCase):
+    def setUp(self):
+        self.throttle = HeartbeatThrottle()
+        self.min_interval = settings.NARRATIVE_HEARTBEAT_MIN_INTERVAL
+
+    def test_once_per_interval(self):
+        mock_now = datetime.datetime.utcnow()
+
+        self.assertTrue(create_heartbeat(get_utc_now=lambda: mock_now, throttle=self.throttle))
+
+        # Within the interval, the database is not touched at all
+        with self.assertNumQueries(0):
+            self.assertFalse(create_heartbeat(
+                get_utc_now=lambda: mock_now + datetime.timedelta(minutes=1), throttle=self.throttle))
+
+        self.assertTrue(create_heartbeat(
+            get_utc_now=lambda: mock_now + self.min_interval + datetime.timedelta(seconds=1), throttle=self.throttle))
+
+        self.assertEqual(2, HeartbeatBucket.objects.filter(service_name=DEFAULT_SERVICE_NAME).count())
+
+    def test_services_are_throttled_separately(self):
+        mock_now = datetime.datetime.utcnow()
+
+        self.assertTrue(create_heartbeat(get_utc_now=lambda: mock_now, throttle=self.throttle))
+        self.assertTrue(create_heartbeat(
+            get_utc_now=lambda: mock_now, throttle=self.throttle, service_name='worker'))
+        self.assertFalse(create_heartbeat(
+            get_utc_now=lambda: mock_now, throttle=self.throttle, service_name='worker'))
+
+        self.assertEqual(
+            [DEFAULT_SERVICE_NAME, 'worker'],
+            list(HeartbeatBucket.objects.order_by('service_name').values_list('service_name', flat=True)))
+
+    def test_heartbeat_from_another_process(self):
+        """
+        Verify that a recent heartbeat created by another process is
+        respected, and that it is only looked up once.
+        """
+        mock_now = datetime.datetime.utcnow()
+
+        self.assertTrue(create_heartbeat(get_utc_now=lambda: mock_now, throttle=HeartbeatThrottle()))
+
+        self.assertFalse(create_heartbeat(
+            get_utc_now=lambda: mock_now + datetime.timedelta(minutes=1), throttle=self.throttle))
+
+        with self.assertNumQueries(0):
+            self.assertFalse(create_heartbeat(
+                get_utc_now=lambda: mock_now + datetime.timedelta(minutes=2), throttle=self.throttle))
+
+    @patch('narrative.batteries.uptime.record_heartbeat')
+    @patch('narrative.batteries.uptime.get_last_heartbeat_time', return_value=None)
+    def test_concurrent_threads(self, get_last_heartbeat_time_mock, record_heartbeat_mock):
+        """
+        Verify that out of many threads in one process, only one
+        goes on to the database.
+        """
+        mock_now = datetime.datetime.utcnow()
+
+        run_in_threads(50, lambda: create_heartbeat(get_utc_now=lambda: mock_now, throttle=self.throttle))
+
+        self.assertEqual(1, get_last_heartbeat_time_mock.call_count)
+        self.assertEqual(1, record_heartbeat_mock.call_count)
+
+    @override_settings(NARRATIVE_HEARTBEAT_CACHE='default')
+    @patch('narrative.batteries.uptime.record_heartbeat')
+    @patch('narrative.batteries.uptime.get_last_heartbeat_time')
+    def test_shared_cache_elects_one_writer(self, get_last_heartbeat_time_mock, record_heartbeat_mock):
+        """
+        Verify that when the processes share a cache, only one of them
+        writes the heartbeat and none of them read the database.
+        """
+        cache.clear()
+        mock_now = datetime.datetime.utcnow()
+
+        # Each thread has its own throttle, as if it were its own process
+        run_in_threads(50, lambda: create_heartbeat(get_utc_now=lambda: mock_now, throttle=HeartbeatThrottle()))
+
+        self.assertFalse(get_last_heartbeat_time_mock.called)
+        self.assertEqual(1, record_heartbeat_mock.call_count)
+
+    @override_settings(NARRATIVE_HEARTBEAT_CACHE='default')
+    @patch('narrative.batteries.uptime.record_heartbeat', side_effect=[DatabaseError, None])
+    def test_failed_write_frees_the_interval(self, record_heartbeat_mock):
+        """
+        Verify that a heartbeat that could not be written does not keep
+        the next caller from writing one in the same interval.
+        """
+        cache.clear()
+        mock_now = datetime.datetime.utcnow()
+
+        with self.assertRaises(DatabaseError):
+            create_heartbeat(get_utc_now=lambda: mock_now, throttle=self.throttle)
+
+        self.assertTrue(create_heartbeat(get_utc_now=lambda: mock_now, throttle=self.throttle))
+        self.assertEqual(2, record_heartbeat_mock.call_count)
+
+
+class TestRecordHeartbeat(TestCase):
+    def test_beats_share_a_bucket_per_minute(self):
+        minute = datetime.datetime(2013, 7, 15, 12, 0, 0)
+
+        for second in (0, 20, 40):
+            record_heartbeat(DEFAULT_SERVICE_NAME, minute + datetime.timedelta(seconds=second))
+
+        record_heartbeat(DEFAULT_SERVICE_NAME, minute + datetime.timedelta(minutes=1, seconds=5))
+
+        self.assertEqual(
+            [(minute, 3), (minute + datetime.timedelta(minutes=1), 1)],
+            list(HeartbeatBucket.objects.order_by('bucket_start').values_list('bucket_start', 'beat_count')))
 
 
 class TestDetectTemporalClusters(unittest.TestCase):
@@ -32,7 +170,15 @@ class TestDetectTemporalClusters(unittest.TestCase):
 
         self.assertEqual(
             detect_temporal_clusters(time_list)[0],
-            [[1, 2, 3], [14, 15, 16, 17, 18], [45, 46, 47, 48, 49, 50]],
+            [(1, 3, 3), (14, 18, 5), (45, 50, 6)],
+            'There should be three clusters')
+
+    def test_3_clusters_without_numpy(self):
+        time_list = [1, 2, 3, 14, 15, 16, 17, 18, 45, 46, 47, 48, 49, 50]
+
+        self.assertEqual(
+            detect_temporal_clusters(time_list, use_numpy=False)[0],
+            [(1, 3, 3), (14, 18, 5), (45, 50, 6)],
             'There should be three clusters')
 
     def test_1_element(self):
@@ -43,11 +189,61 @@ class TestDetectTemporalClusters(unittest.TestCase):
 
         self.assertEqual(
             detect_temporal_clusters(time_list)[0],
-            [time_list],
+            [(1, 1, 1)],
             'There should be one cluster')
 
+    def test_no_elements(self):
+        self.assertEqual(detect_temporal_clusters([]), ([], 0))
+
+    def test_weighted_counts(self):
+        """
+        Verify that the cluster counts sum the count_list when one is given.
+        """
+        time_list = [0, 60, 120, 600, 660]
+        count_list = [3, 3, 1, 2, 3]
+
+        self.assertEqual(
+            [(0, 120, 7), (600, 660, 5)],
+            split_temporal_clusters(time_list, 60, count_list=count_list))
+        self.assertEqual(
+            [(0, 120, 7), (600, 660, 5)],
+            split_temporal_clusters(time_list, 60, count_list=count_list, use_numpy=False))
 
-class TestGetUptimeEvents(unittest.TestCase):
+
+class TestComputeIntervalList(unittest.TestCase):
+    def test_true_median(self):
+        """
+        Verify that the threshold is the true median interval, even though
+        the intervals themselves are not sorted.
+        """
+        time_list = [0, 5, 6, 7, 17, 27]
+
+        self.assertEqual(5, compute_interval_list(time_list)[1])
+        self.assertEqual(5, compute_interval_list(time_list, use_numpy=False)[1])
+
+    def test_percentile(self):
+        time_list = [0, 1, 3, 6, 10]
+
+        self.assertEqual(2.5, compute_interval_list(time_list)[1])
+        self.assertEqual(2.5, compute_interval_list(time_list, use_numpy=False)[1])
+        self.assertEqual(3.25, compute_interval_list(time_list, percent=75)[1])
+        self.assertEqual(3.25, compute_interval_list(time_list, percent=75, use_numpy=False)[1])
+
+
+class TestUnixTimestamp(unittest.TestCase):
+    def test_naive_times_are_utc(self):
+        try:
+            with patch.dict('os.environ', {'TZ': 'America/New_York'}):
+                time.tzset()
+                self.assertEqual(60, unix_timestamp(datetime.datetime(1970, 1, 1, 0, 1)))
+        finally:
+            time.tzset()
+
+    def test_aware_times(self):
+        self.assertEqual(60, unix_timestamp(utc.localize(datetime.datetime(1970, 1, 1, 0, 1))))
+
+
+class TestGetUptimeEvents(TestCase):
     def test_up_down_history(self):
         # Simulate 2 periods of downtime
         simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
@@ -74,11 +270,6 @@ class TestGetUptimeEvents(unittest.TestCase):
             get_uptime_history())
 
     def test_no_events(self):
-        # Make sure we have no heartbeats
-        Datum.objects.filter(
-            origin=heartbeat_details['origin'],
-            datum_name=heartbeat_details['datum_name']).delete()
-
         mock_now = datetime.datetime(2013, 8, 21)
 
         expected_uptime_events = [
@@ -88,3 +279,204 @@ class TestGetUptimeEvents(unittest.TestCase):
         self.assertEqual(
             expected_uptime_events,
             get_uptime_history(utcnow=lambda: mock_now))
+
+    def test_incremental_history(self):
+        """
+        Verify that heartbeats are folded into the persisted segments
+        as they arrive, and that processed heartbeats are not reloaded.
+        """
+        simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
+        time_down_start = simulation_start_time + datetime.timedelta(minutes=10)
+        time_down_end = time_down_start + datetime.timedelta(minutes=10)
+        mock_now = time_down_end + datetime.timedelta(minutes=10)
+
+        simulate_uptime(simulation_start_time, time_down_start)
+
+        self.assertEqual(
+            [(UptimeEventTypes.UP, simulation_start_time)],
+            get_uptime_history())
+
+        uptime_state = UptimeState.objects.get(service_name=DEFAULT_SERVICE_NAME)
+
+        # Heartbeats are counted per minute, so that is the interval the threshold is learned from
+        self.assertEqual(time_down_start, uptime_state.watermark)
+        self.assertEqual(60, uptime_state.cluster_threshold_seconds)
+
+        simulate_uptime(time_down_end, mock_now)
+
+        expected_uptime_events = [
+            (UptimeEventTypes.UP, simulation_start_time),
+            (UptimeEventTypes.DOWN, time_down_start),
+            (UptimeEventTypes.UP, time_down_end),
+        ]
+
+        self.assertEqual(expected_uptime_events, get_uptime_history())
+
+        self.assertEqual(
+            [31, 31],
+            list(UptimeSegment.objects.order_by('start').values_list('heartbeat_count', flat=True)))
+
+        # Processed heartbeats are never reloaded, so the history outlives them
+        HeartbeatBucket.objects.all().delete()
+
+        self.assertEqual(expected_uptime_events, get_uptime_history())
+
+    def test_processed_buckets_are_pruned(self):
+        simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
+        simulate_uptime(simulation_start_time, simulation_start_time + datetime.timedelta(minutes=10))
+
+        with self.settings(NARRATIVE_HEARBEAT_TTL=datetime.timedelta(minutes=5)):
+            update_uptime_segments()
+
+        self.assertEqual(
+            simulation_start_time + datetime.timedelta(minutes=5),
+            HeartbeatBucket.objects.order_by('bucket_start').values_list('bucket_start', flat=True).first())
+
+    def test_history_per_service(self):
+        """
+        Verify that each service gets its own history, and that all of
+        them are computed together.
+        """
+        simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
+        time_down_start = simulation_start_time + datetime.timedelta(minutes=10)
+        time_down_end = time_down_start + datetime.timedelta(minutes=10)
+        last_heartbeat = time_down_end + datetime.timedelta(minutes=10)
+        mock_now = last_heartbeat + datetime.timedelta(minutes=10)
+
+        simulate_uptime(simulation_start_time, last_heartbeat, service_name='web')
+        simulate_uptime(simulation_start_time, time_down_start, service_name='worker')
+        simulate_uptime(time_down_end, last_heartbeat, service_name='worker')
+
+        self.assertEqual(
+            {
+                'web': [(UptimeEventTypes.UP, simulation_start_time)],
+                'worker': [
+                    (UptimeEventTypes.UP, simulation_start_time),
+                    (UptimeEventTypes.DOWN, time_down_start),
+                    (UptimeEventTypes.UP, time_down_end),
+                ],
+                'idle': [(UptimeEventTypes.UP, mock_now)],
+            },
+            get_uptime_history_many(['web', 'worker', 'idle'], utcnow=lambda: mock_now))
+
+        self.assertEqual(simulation_start_time, time_site_came_up(service_name='worker'))
+
+    def test_time_site_came_up(self):
+        simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
+        simulate_uptime(simulation_start_time, simulation_start_time + datetime.timedelta(minutes=10))
+
+        self.assertEqual(simulation_start_time, time_site_came_up())
+
+        with self.assertNumQueries(1):
+            self.assertEqual(simulation_start_time, time_site_came_up())
+
+    def test_time_site_came_up_no_events(self):
+        mock_now = datetime.datetime(2013, 8, 21)
+
+        self.assertEqual(mock_now, time_site_came_up(utcnow=lambda: mock_now))
+
+    def test_window_function_gap_detection(self):
+        """
+        Verify that finding the gaps in the database builds the same
+        segments as doing it in python.
+        """
+        simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
+        first_time_down_start = simulation_start_time + datetime.timedelta(minutes=10)
+        first_time_down_end = first_time_down_start + datetime.timedelta(minutes=10)
+        second_time_down_start = first_time_down_end + datetime.timedelta(minutes=10)
+        second_time_down_end = second_time_down_start + datetime.timedelta(minutes=10)
+        mock_now = second_time_down_end + datetime.timedelta(minutes=10)
+
+        # The first pass learns the threshold
+        simulate_uptime(simulation_start_time, first_time_down_start)
+        update_uptime_segments()
+
+        simulate_uptime(first_time_down_end, second_time_down_start)
+        simulate_uptime(second_time_down_end, mock_now)
+        update_uptime_segments()
+
+        database_segments = list(UptimeSegment.objects.order_by('start').values_list(
+            'start', 'end', 'heartbeat_count'))
+
+        UptimeState.objects.all().delete()
+        update_uptime_segments(use_window_functions=False)
+
+        python_segments = list(UptimeSegment.objects.order_by('start').values_list(
+            'start', 'end', 'heartbeat_count'))
+
+        self.assertEqual(python_segments, database_segments)
+        self.assertEqual(
+            [
+                (simulation_start_time, first_time_down_start, 31),
+                (first_time_down_end, second_time_down_start, 31),
+                (second_time_down_end, mock_now, 31),
+            ],
+            database_segments)
+
+    def test_threshold_relearned_from_small_sample(self):
+        """
+        Verify that a threshold learned from a few heartbeats is learned
+        again once there are more of them.
+        """
+        simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
+
+        simulate_uptime(
+            simulation_start_time, simulation_start_time + datetime.timedelta(minutes=10),
+            interval=datetime.timedelta(minutes=5))
+        update_uptime_segments()
+
+        uptime_state = UptimeState.objects.get(service_name=DEFAULT_SERVICE_NAME)
+
+        self.assertEqual(300, uptime_state.cluster_threshold_seconds)
+        self.assertEqual(2, uptime_state.cluster_threshold_sample_size)
+
+        simulate_uptime(
+            simulation_start_time + datetime.timedelta(minutes=11), simulation_start_time + datetime.timedelta(hours=1))
+        update_uptime_segments()
+
+        uptime_state = UptimeState.objects.get(service_name=DEFAULT_SERVICE_NAME)
+
+        self.assertEqual(60, uptime_state.cluster_threshold_seconds)
+        self.assertEqual(52, uptime_state.cluster_threshold_sample_size)
+
+    @override_settings(NARRATIVE_UPTIME_THRESHOLD_MIN_SAMPLE=1)
+    def test_threshold_bounded_and_relearned_when_old(self):
+        """
+        Verify that the threshold is kept below the maximum, and is learned
+        again once it is old, from the latest heartbeats.
+        """
+        simulation_start_time = datetime.datetime(2013, 7, 15, 12, 0, 0)
+
+        for hours in range(3):
+            record_heartbeat(DEFAULT_SERVICE_NAME, simulation_start_time + datetime.timedelta(hours=hours * 3))
+
+        update_uptime_segments()
+
+        self.assertEqual(3600, UptimeState.objects.get(service_name=DEFAULT_SERVICE_NAME).cluster_threshold_seconds)
+
+        simulate_uptime(
+            simulation_start_time + datetime.timedelta(hours=7),
+            simulation_start_time + datetime.timedelta(hours=8))
+
+        # Still fresh, so the threshold stands
+        update_uptime_segments()
+        self.assertEqual(3600, UptimeState.objects.get(service_name=DEFAULT_SERVICE_NAME).cluster_threshold_seconds)
+
+        UptimeState.objects.update(cluster_threshold_learned=datetime.datetime.utcnow() - datetime.timedelta(days=2))
+        update_uptime_segments()
+
+        self.assertEqual(60, UptimeState.objects.get(service_name=DEFAULT_SERVICE_NAME).cluster_threshold_seconds)
+
+
+class TestSupportsWindowFunctions(unittest.TestCase):
+    def test_postgresql(self):
+        self.assertTrue(supports_window_functions(Mock(vendor='postgresql')))
+
+    def test_sqlite(self):
+        self.assertTrue(supports_window_functions(Mock(
+            vendor='sqlite', Database=Mock(sqlite_version_info=(3, 25, 0)))))
+        self.assertFalse(supports_window_functions(Mock(
+            vendor='sqlite', Database=Mock(sqlite_version_info=(3, 24, 0)))))
+
+    def test_other_backends(self):
+        self.assertFalse(supports_window_functions(Mock(vendor='mysql')))
@@ -1,8 +1,30 @@
+import calendar
 import datetime
+from functools import reduce
+import itertools
+import math
+import operator
+import threading
 
 from django.conf import settings
+from django.db import connection, IntegrityError, transaction
+from django.db.models import F, Max, Q
 
-from narrative.models import Datum, DatumLogLevel, log_datum
+from narrative.batteries.models import HeartbeatBucket, UptimeSegment, UptimeState
+
+try:
+    from django.core.cache import caches
+except ImportError:  # pragma: no cover
+    # Django < 1.7
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
 
 
 class UptimeEventTypes:
@@ -10,47 +32,213 @@ class UptimeEventTypes:
     DOWN = 1
 
 
+# The service tracked when no service name is given
+DEFAULT_SERVICE_NAME = 'external_heartbeat'
+
+
+# Heartbeats used to be logged as datums with these details; they are kept for
+# code written against them.  The origin names the default service, whose
+# buckets now hold those heartbeats, and the ttl is how long processed
+# buckets are kept.
 heartbeat_details = {
-    'origin': 'external_heartbeat',
+    'origin': DEFAULT_SERVICE_NAME,
     'datum_name': 'beat',
     'ttl': getattr(settings, 'NARRATIVE_HEARBEAT_TTL', None),
 }
 
 
-def create_heartbeat(get_utc_now=datetime.datetime.utcnow):
+class HeartbeatThrottle(object):
+    """
+    Remembers when this process last knew of a heartbeat for each service,
+    so that create_heartbeat only has to look any further once per
+    NARRATIVE_HEARTBEAT_MIN_INTERVAL, no matter how many threads call it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_heartbeat_times = {}
+
+    def claim(self, service_name, utc_now, min_interval):
+        """
+        Return True if the caller should go on to create the heartbeat; only
+        the first caller in each interval gets True.
+        """
+        with self.lock:
+            last_heartbeat_time = self.last_heartbeat_times.get(service_name)
+
+            if last_heartbeat_time is not None and utc_now - last_heartbeat_time < min_interval:
+                return False
+
+            self.last_heartbeat_times[service_name] = utc_now
+
+            return True
+
+    def release(self, service_name, claim_time):
+        """
+        Give up a claim that did not end in a heartbeat, unless a later one has replaced it.
+        """
+        with self.lock:
+            if self.last_heartbeat_times.get(service_name) == claim_time:
+                del self.last_heartbeat_times[service_name]
+
+    def heartbeat_seen(self, service_name, heartbeat_time):
+        """
+        Note a heartbeat created elsewhere, so the next claim waits for it to go stale.
+        """
+        with self.lock:
+            self.last_heartbeat_times[service_name] = heartbeat_time
+
+
+heartbeat_throttle = HeartbeatThrottle()
+
+
+def get_last_heartbeat_time(service_name):
+    return HeartbeatBucket.objects.filter(
+        service_name=service_name).order_by('-bucket_start').values_list('bucket_start', flat=True).first()
+
+
+def record_heartbeat(service_name, heartbeat_time):
     """
-    Create a datum recording the heartbeat, if sufficient time
+    Count a heartbeat in the service's bucket for the minute it arrived in.
+    """
+    bucket_start = heartbeat_time.replace(second=0, microsecond=0)
+    bucket_queryset = HeartbeatBucket.objects.filter(service_name=service_name, bucket_start=bucket_start)
+
+    if not bucket_queryset.update(beat_count=F('beat_count') + 1):
+        try:
+            with transaction.atomic():
+                HeartbeatBucket.objects.create(service_name=service_name, bucket_start=bucket_start)
+        except IntegrityError:
+            # Someone else created the bucket first
+            bucket_queryset.update(beat_count=F('beat_count') + 1)
+
+
+def create_heartbeat(get_utc_now=datetime.datetime.utcnow, throttle=heartbeat_throttle,
+                     service_name=DEFAULT_SERVICE_NAME):
+    """
+    Record a heartbeat for the service, if sufficient time
     (as specified by NARRATIVE_HEARTBEAT_MIN_INTERVAL) has passed
-    since the last heartbeat was created.
+    since the last heartbeat was recorded.  Returns True if one was.
+
+    The database is read at most once per interval per process.  If
+    NARRATIVE_HEARTBEAT_CACHE names a cache shared by all processes,
+    an atomic add on it elects the one process that writes the
+    heartbeat and the database is not read at all.
     """
-    start_of_non_creation_window = get_utc_now() - settings.NARRATIVE_HEARTBEAT_MIN_INTERVAL
+    utc_now = get_utc_now()
+    min_interval = settings.NARRATIVE_HEARTBEAT_MIN_INTERVAL
+
+    if not throttle.claim(service_name, utc_now, min_interval):
+        return False
+
+    cache_alias = getattr(settings, 'NARRATIVE_HEARTBEAT_CACHE', None)
+
+    heartbeat_cache = get_cache(cache_alias) if cache_alias else None
+    heartbeat_cache_key = 'narrative-heartbeat-{0}'.format(service_name)
+
+    if heartbeat_cache is not None:
+        if not heartbeat_cache.add(heartbeat_cache_key, utc_now, int(min_interval.total_seconds())):
+            # Another process is recording the heartbeat for this interval
+            return False
+    else:
+        last_heartbeat_time = get_last_heartbeat_time(service_name)
+
+        if last_heartbeat_time is not None and last_heartbeat_time >= utc_now - min_interval:
+            # Another process recorded a recent heartbeat
+            throttle.heartbeat_seen(service_name, last_heartbeat_time)
+            return False
 
-    if not Datum.objects.filter(
-            origin=heartbeat_details['origin'],
-            datum_name=heartbeat_details['datum_name'],
-            timestamp__gte=start_of_non_creation_window).exists():
-        # No recent heartbeat, so create a new one
-        log_datum(
-            origin=heartbeat_details['origin'],
-            datum_name=heartbeat_details['datum_name'],
-            ttl=heartbeat_details['ttl'],
-            log_level=DatumLogLevel.INFO)
+    # No recent heartbeat, so record a new one
+    try:
+        record_heartbeat(service_name, utc_now)
+    except Exception:
+        # Give up the claim on this interval, so the next caller records the heartbeat instead
+        if heartbeat_cache is not None:
+            heartbeat_cache.delete(heartbeat_cache_key)
 
+        throttle.release(service_name, utc_now)
+        raise
 
-def compute_interval_list(time_list):
+    return True
+
+
+def percentile(value_list, percent):
+    """
+    Return the given percentile of value_list, linearly interpolating
+    between the closest ranks the same way numpy.percentile does.
+    """
+    sorted_values = sorted(value_list)
+
+    rank = (len(sorted_values) - 1) * percent / 100.0
+    lower = int(math.floor(rank))
+    upper = int(math.ceil(rank))
+
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def compute_interval_list(time_list, percent=50, use_numpy=True):
     """
     Given a series of times, return the intervals between them as well
-    as the median interval.
+    as the median interval (or whichever percentile is asked for).
 
     NOTE: assumes that the time_list is sorted in ascending order.
     """
+    if numpy is not None and use_numpy:
+        interval_list = numpy.diff(numpy.asarray(time_list))
+
+        return interval_list, numpy.percentile(interval_list, percent).item()
+
     interval_list = [time_list[idx] - time_list[idx - 1] for idx in range(1, len(time_list))]
-    interval_list_len = len(interval_list)
 
-    return interval_list, interval_list[int(interval_list_len / 2)]
+    return interval_list, percentile(interval_list, percent)
 
 
-def detect_temporal_clusters(time_list):
+def split_temporal_clusters(time_list, threshold, count_list=None, use_numpy=True):
+    """
+    Break the times in the time_list into clusters, starting a new cluster
+    wherever the interval between two times is bigger than the threshold.
+    Each cluster is returned as a (start, end, count) tuple, where count
+    sums the count_list entries of its times (one per time by default).
+
+    Note: assumes that time_list is sorted in ascending order.
+    """
+    if len(time_list) == 0:
+        return []
+
+    if numpy is not None and use_numpy:
+        times = numpy.asarray(time_list)
+
+        # The index of the first time in each cluster but the first one
+        split_points = numpy.nonzero(numpy.diff(times) > threshold)[0] + 1
+
+        starts = numpy.concatenate(([0], split_points))
+        ends = numpy.concatenate((split_points - 1, [len(times) - 1]))
+
+        if count_list is None:
+            counts = ends - starts + 1
+        else:
+            running_counts = numpy.concatenate(([0], numpy.cumsum(count_list)))
+            counts = running_counts[ends + 1] - running_counts[starts]
+
+        return list(zip(times[starts].tolist(), times[ends].tolist(), counts.tolist()))
+
+    clusters = []
+
+    for idx in range(len(time_list)):
+        count = 1 if count_list is None else count_list[idx]
+
+        if idx == 0 or time_list[idx] - time_list[idx - 1] > threshold:
+            # The interval past is too much; start a new cluster
+            clusters.append([time_list[idx], time_list[idx], count])
+        else:
+            # This time was close enough to the last one to be in
+            # in the same cluster
+            clusters[-1][1] = time_list[idx]
+            clusters[-1][2] += count
+
+    return [tuple(cluster) for cluster in clusters]
+
+
+def detect_temporal_clusters(time_list, use_numpy=True):
     """
     Break the times in the time_list into a series of clusters based
     on changes in the median interval between times.
@@ -59,86 +247,440 @@ def detect_temporal_clusters(time_list):
     list, take the median interval, then tweat any interval much bigger
     than that as indicating the start of a new cluster.
 
+    Returns the clusters as (start, end, count) tuples along with the
+    threshold used.
+
     Note: assumes that time_list is sorted in ascending order.
     """
-    time_list_len = len(time_list)
+    if len(time_list) > 1:
+        interval_list, new_cluster_threshold = compute_interval_list(time_list, use_numpy=use_numpy)
+    else:
+        new_cluster_threshold = 0
+
+    return split_temporal_clusters(time_list, new_cluster_threshold, use_numpy=use_numpy), new_cluster_threshold
+
+
+def unix_timestamp(dt):
+    """
+    Return the whole seconds since the epoch of dt; a naive dt is taken to be in UTC.
+    """
+    return calendar.timegm(dt.utctimetuple())
+
 
-    if time_list_len > 1:
-        interval_list, new_cluster_threshold = compute_interval_list(time_list)
+# How each backend turns a timestamp column into whole seconds since the epoch
+epoch_seconds_sql = {
+    'postgresql': 'FLOOR(EXTRACT(EPOCH FROM {0}))',
+    'sqlite': "CAST(STRFTIME('%%s', {0}) AS INTEGER)",
+}
 
-        clusters = [[time_list[0]]]
 
-        for idx in range(1, len(time_list)):
-            if interval_list[idx - 1] > new_cluster_threshold:
-                # The interval past is too much; start a new cluster
-                clusters.append([time_list[idx]])
-            else:
-                # This time was close enough to the last one to be in
-                # in the same cluster
-                clusters[-1].append(time_list[idx])
+def supports_window_functions(connection):
+    """
+    Determine if the database behind connection can run the LAG() based
+    gap detection.
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    elif connection.vendor == 'sqlite':
+        # Window functions arrived in SQLite 3.25
+        return connection.Database.sqlite_version_info >= (3, 25, 0)
 
-        return clusters, new_cluster_threshold
-    elif time_list_len == 1:
-        return [time_list], 0
-    return [], 0
+    return False
 
 
-def get_uptime_history(utcnow=datetime.datetime.utcnow):
+def new_heartbeat_filter(uptime_states):
     """
-    Return a history of uptime data; the data are in descending order,
-    going from most recent to least recent.  Each datum is a tuple:
-    (UP/Down datetime) where UP/DOWN is a value from UptimeEventType.
+    Build a filter matching the heartbeat buckets newer than the watermark
+    of each of the uptime_states.
     """
-    def unix_timestamp(dt):
-        return int(dt.strftime('%s'))
+    def new_heartbeats(uptime_state):
+        if uptime_state.watermark is None:
+            return Q(service_name=uptime_state.service_name)
 
-    def from_unix_timestamp(timestamp):
-        return datetime.datetime.utcfromtimestamp(timestamp)
+        return Q(service_name=uptime_state.service_name, bucket_start__gt=uptime_state.watermark)
 
-    # Get a list of all heartbeats since the pusher went dark
-    heartbeat_times = Datum.objects.filter(
-        origin=heartbeat_details['origin'], datum_name=heartbeat_details['datum_name']).values('timestamp')
+    return reduce(operator.or_, [new_heartbeats(uptime_state) for uptime_state in uptime_states])
 
-    # Pull out the heartbeat times
-    heartbeat_times = [
-        unix_timestamp(ht['timestamp']) for ht in heartbeat_times
-    ]
 
-    # Put in ascending order
-    heartbeat_times.sort(reverse=False)
+def cluster_heartbeats_in_database(uptime_states):
+    """
+    Find the clusters among the heartbeats newer than each service's
+    watermark without pulling them out of the database; LAG() and LEAD()
+    pair each bucket with its neighbours, and only the buckets that start
+    or end a cluster are returned.  This is one statement for all services,
+    so the gaps and the bounds and counts of the clusters are all read
+    from the same snapshot of the buckets, however many arrive meanwhile.
+
+    Returns a dict of service name to a list of (start, end, count)
+    clusters, where start and end are the starts of the first and last
+    buckets in the cluster.
+    """
+    quote_name = connection.ops.quote_name
+    bucket_start = quote_name('bucket_start')
+    epoch_seconds = epoch_seconds_sql[connection.vendor].format(bucket_start)
+
+    threshold_cases = []
+    threshold_params = []
+    where_clauses = []
+    where_params = []
+
+    for uptime_state in uptime_states:
+        threshold_cases.append('WHEN %s THEN %s')
+        threshold_params.extend([uptime_state.service_name, uptime_state.cluster_threshold_seconds])
+
+        if uptime_state.watermark is None:
+            where_clauses.append('service_name = %s')
+            where_params.append(uptime_state.service_name)
+        else:
+            where_clauses.append('(service_name = %s AND {0} > %s)'.format(bucket_start))
+            where_params.extend([
+                uptime_state.service_name, connection.ops.value_to_db_datetime(uptime_state.watermark)])
+
+    cursor = connection.cursor()
+    cursor.execute(
+        '''
+        WITH buckets AS (
+            SELECT
+                service_name,
+                {bucket_start},
+                beat_count,
+                CASE service_name {threshold_cases} END AS threshold,
+                {epoch_seconds} AS heartbeat_time,
+                LAG({epoch_seconds}) OVER service_buckets AS previous_heartbeat_time,
+                LEAD({epoch_seconds}) OVER service_buckets AS next_heartbeat_time,
+                SUM(beat_count) OVER (
+                    PARTITION BY service_name ORDER BY {bucket_start} ROWS UNBOUNDED PRECEDING
+                ) - beat_count AS beats_before
+            FROM {bucket_table}
+            WHERE {where_clause}
+            -- Adding a frame to a named window needs SQLite 3.28, so the running sum spells its window out
+            WINDOW service_buckets AS (PARTITION BY service_name ORDER BY {bucket_start})
+        ),
+        boundaries AS (
+            SELECT
+                service_name,
+                {bucket_start},
+                beats_before,
+                beat_count,
+                (previous_heartbeat_time IS NULL OR heartbeat_time - previous_heartbeat_time > threshold)
+                    AS starts_cluster,
+                (next_heartbeat_time IS NULL OR next_heartbeat_time - heartbeat_time > threshold)
+                    AS ends_cluster
+            FROM buckets
+        )
+        SELECT service_name, {bucket_start}, beats_before, beat_count, starts_cluster, ends_cluster
+        FROM boundaries
+        WHERE starts_cluster OR ends_cluster
+        ORDER BY service_name, {bucket_start}
+        '''.format(
+            threshold_cases=' '.join(threshold_cases),
+            epoch_seconds=epoch_seconds,
+            bucket_table=quote_name(HeartbeatBucket._meta.db_table),
+            where_clause=' OR '.join(where_clauses),
+            bucket_start=bucket_start),
+        threshold_params + where_params)
+
+    clusters = {}
+
+    for service_name, boundaries in itertools.groupby(cursor.fetchall(), key=operator.itemgetter(0)):
+        service_clusters = clusters[service_name] = []
+
+        for service_name, bucket_start, beats_before, beat_count, starts_cluster, ends_cluster in boundaries:
+            if starts_cluster:
+                cluster_start, cluster_beats_before = bucket_start, beats_before
+
+            if ends_cluster:
+                service_clusters.append((
+                    cluster_start, bucket_start, int(beats_before + beat_count - cluster_beats_before)))
+
+    return clusters
+
+
+def is_cluster_threshold_due(uptime_state, utc_now):
+    """
+    Determine if the service's cluster threshold has to be learned (again).
+    """
+    if uptime_state.cluster_threshold_seconds is None or uptime_state.cluster_threshold_learned is None:
+        return True
 
-    clusters, threshold = detect_temporal_clusters(heartbeat_times)
+    if uptime_state.cluster_threshold_sample_size < getattr(settings, 'NARRATIVE_UPTIME_THRESHOLD_MIN_SAMPLE', 30):
+        return True
 
-    if len(clusters) > 0:
-        # Put in descending order of clusters; the elements within the clusters
-        # are still in ascending order.
-        heartbeat_times.reverse()
+    relearn_interval = getattr(
+        settings, 'NARRATIVE_UPTIME_THRESHOLD_RELEARN_INTERVAL', datetime.timedelta(days=1))
 
-        history = []
+    return uptime_state.cluster_threshold_learned + relearn_interval <= utc_now
+
+
+def learn_cluster_thresholds(uptime_states, utc_now):
+    """
+    Learn the cluster threshold of each service that has none, learned it
+    from fewer than NARRATIVE_UPTIME_THRESHOLD_MIN_SAMPLE intervals (30), or
+    learned it more than NARRATIVE_UPTIME_THRESHOLD_RELEARN_INTERVAL ago (a
+    day), as the median interval between its latest
+    NARRATIVE_UPTIME_THRESHOLD_WINDOW heartbeat buckets (1440).
+
+    The threshold is kept between the length of a bucket and
+    NARRATIVE_UPTIME_MAX_CLUSTER_THRESHOLD (an hour), so a skewed sample
+    cannot make every gap, or none at all, count as downtime.
+    """
+    window = getattr(settings, 'NARRATIVE_UPTIME_THRESHOLD_WINDOW', 1440)
+    max_threshold = int(getattr(
+        settings, 'NARRATIVE_UPTIME_MAX_CLUSTER_THRESHOLD', datetime.timedelta(hours=1)).total_seconds())
+
+    for uptime_state in uptime_states:
+        if not is_cluster_threshold_due(uptime_state, utc_now):
+            continue
 
-        for idx in range(0, len(clusters) - 1):
-            cluster = clusters[idx]
-            uptime = from_unix_timestamp(cluster[0])
-            downtime = from_unix_timestamp(cluster[-1])
+        heartbeat_times = sorted(
+            unix_timestamp(bucket_start)
+            for bucket_start in HeartbeatBucket.objects.filter(service_name=uptime_state.service_name).order_by(
+                '-bucket_start').values_list('bucket_start', flat=True)[:window])
 
-            history.append((UptimeEventTypes.UP, uptime))
-            history.append((UptimeEventTypes.DOWN, downtime))
+        # This needs at least two heartbeats
+        if len(heartbeat_times) < 2:
+            continue
 
-        # There is an edge case with the last cluster, where this is the most recent heartbeat
+        interval_list, threshold = compute_interval_list(heartbeat_times)
+
+        # Heartbeats are counted per minute, so no gap is shorter than that
+        uptime_state.cluster_threshold_seconds = min(max(int(threshold), 60), max_threshold)
+        uptime_state.cluster_threshold_sample_size = len(interval_list)
+        uptime_state.cluster_threshold_learned = utc_now
+        uptime_state.save(update_fields=[
+            'cluster_threshold_seconds', 'cluster_threshold_sample_size', 'cluster_threshold_learned'])
+
+
+def cluster_heartbeats_in_python(uptime_states):
+    """
+    Find the clusters among the heartbeats newer than each service's
+    watermark; the buckets of all services are loaded with one query.
+
+    Returns a dict of service name to a list of (start, end, count)
+    clusters, as with cluster_heartbeats_in_database.
+    """
+    uptime_states = dict((uptime_state.service_name, uptime_state) for uptime_state in uptime_states)
+
+    # Let the database put the heartbeats in ascending order
+    new_buckets = HeartbeatBucket.objects.filter(new_heartbeat_filter(uptime_states.values())).order_by(
+        'service_name', 'bucket_start').values_list('service_name', 'bucket_start', 'beat_count')
+
+    clusters = {}
+
+    for service_name, buckets in itertools.groupby(new_buckets, key=operator.itemgetter(0)):
+        uptime_state = uptime_states[service_name]
+
+        buckets = list(buckets)
+        bucket_starts = [bucket_start for service_name, bucket_start, beat_count in buckets]
+        heartbeat_times = [unix_timestamp(bucket_start) for bucket_start in bucket_starts]
+        beat_counts = [beat_count for service_name, bucket_start, beat_count in buckets]
+
+        # Map the cluster bounds back to the bucket starts they were computed from
+        bucket_starts_by_time = dict(zip(heartbeat_times, bucket_starts))
+
+        clusters[service_name] = [
+            (bucket_starts_by_time[start], bucket_starts_by_time[end], count)
+            for start, end, count in split_temporal_clusters(
+                heartbeat_times, uptime_state.cluster_threshold_seconds or 0, count_list=beat_counts)
+        ]
+
+    return clusters
+
+
+def get_uptime_states(service_names):
+    """
+    Lock and return the UptimeState of each service, keyed by service name,
+    creating any that do not exist yet.
+    """
+    uptime_states = dict(
+        (uptime_state.service_name, uptime_state)
+        for uptime_state in UptimeState.objects.select_for_update().filter(service_name__in=service_names))
+
+    for service_name in set(service_names) - set(uptime_states):
+        uptime_states[service_name], created = UptimeState.objects.get_or_create(service_name=service_name)
+
+    return uptime_states
+
+
+def get_last_segments(uptime_states):
+    """
+    Return the most recent UptimeSegment of each of the uptime_states,
+    keyed by the UptimeState id.
+    """
+    latest_starts = UptimeSegment.objects.filter(uptime_state__in=uptime_states).values(
+        'uptime_state').annotate(latest_start=Max('start'))
+
+    if len(latest_starts) == 0:
+        return {}
+
+    last_segments = UptimeSegment.objects.filter(reduce(operator.or_, [
+        Q(uptime_state=latest_start['uptime_state'], start=latest_start['latest_start'])
+        for latest_start in latest_starts
+    ]))
+
+    return dict((segment.uptime_state_id, segment) for segment in last_segments)
+
+
+def prune_heartbeat_buckets(uptime_states):
+    """
+    Delete the heartbeat buckets that were folded into the segments longer
+    than NARRATIVE_HEARBEAT_TTL ago; the segments are all we need of them.
+    """
+    ttl = getattr(settings, 'NARRATIVE_HEARBEAT_TTL', None)
+    uptime_states = [uptime_state for uptime_state in uptime_states if uptime_state.watermark is not None]
+
+    if ttl and uptime_states:
+        HeartbeatBucket.objects.filter(reduce(operator.or_, [
+            Q(service_name=uptime_state.service_name, bucket_start__lt=uptime_state.watermark - ttl)
+            for uptime_state in uptime_states
+        ])).delete()
+
+
+def update_uptime_segments_many(service_names, use_window_functions=True):
+    """
+    Fold any heartbeats newer than each service's watermark into its
+    persisted uptime segments; heartbeats that have already been
+    processed are never loaded again.  The cluster thresholds are learned
+    first where they are due (see learn_cluster_thresholds); once a
+    service's threshold is known, backends with window functions find its
+    gaps in the database so only the cluster boundaries are transferred.
+
+    Returns a dict of service name to the updated UptimeState.
+    """
+    with transaction.atomic():
+        uptime_states = get_uptime_states(service_names)
+        last_segments = get_last_segments(uptime_states.values())
+
+        learn_cluster_thresholds(uptime_states.values(), datetime.datetime.utcnow())
+
+        # A service without enough heartbeats to learn a threshold from has no gaps for the database to look for
+        use_window_functions = use_window_functions and supports_window_functions(connection)
+
+        database_states = [
+            uptime_state for uptime_state in uptime_states.values()
+            if use_window_functions and uptime_state.cluster_threshold_seconds is not None
+        ]
+        python_states = [
+            uptime_state for uptime_state in uptime_states.values() if uptime_state not in database_states
+        ]
+
+        clusters = {}
+
+        if database_states:
+            clusters.update(cluster_heartbeats_in_database(database_states))
+
+        if python_states:
+            clusters.update(cluster_heartbeats_in_python(python_states))
+
+        new_segments = []
+
+        for service_name, service_clusters in clusters.items():
+            uptime_state = uptime_states[service_name]
+            last_segment = last_segments.get(uptime_state.id)
+            threshold = uptime_state.cluster_threshold_seconds or 0
+
+            # Every cluster ends on a bucket start, so this is exactly the last bucket processed
+            uptime_state.watermark = service_clusters[-1][1]
+            uptime_state.save()
+
+            if last_segment is not None and (
+                    service_clusters[0][0] - last_segment.end).total_seconds() <= threshold:
+                # The first new cluster is close enough to carry on the last segment
+                start, end, count = service_clusters.pop(0)
+
+                last_segment.end = end
+                last_segment.heartbeat_count += count
+                last_segment.save(update_fields=['end', 'heartbeat_count'])
+
+            new_segments.extend([
+                UptimeSegment(
+                    uptime_state=uptime_state,
+                    start=cluster_start,
+                    end=cluster_end,
+                    heartbeat_count=cluster_count)
+                for cluster_start, cluster_end, cluster_count in service_clusters
+            ])
+
+        UptimeSegment.objects.bulk_create(new_segments)
+
+        prune_heartbeat_buckets([uptime_states[service_name] for service_name in clusters])
+
+    return uptime_states
+
+
+def update_uptime_segments(use_window_functions=True, service_name=DEFAULT_SERVICE_NAME):
+    """
+    Fold any new heartbeats of a single service into its uptime segments.
+    """
+    return update_uptime_segments_many([service_name], use_window_functions=use_window_functions)[service_name]
+
+
+def build_uptime_history(segments, threshold, utcnow):
+    """
+    Turn a service's uptime segments, in ascending order, into its uptime history.
+    """
+    if len(segments) > 0:
+        history = []
+
+        for segment in segments[:-1]:
+            history.append((UptimeEventTypes.UP, segment.start))
+            history.append((UptimeEventTypes.DOWN, segment.end))
+
+        # There is an edge case with the last segment, where this is the most recent heartbeat
         # and it was in the last few seconds; in this case, we cannot assume this was a downtime datum
-        last_cluster = clusters[-1]
-        uptime = from_unix_timestamp(last_cluster[0])
-        downtime = from_unix_timestamp(last_cluster[-1])
+        last_segment = segments[-1]
 
-        history.append((UptimeEventTypes.UP, uptime))
+        history.append((UptimeEventTypes.UP, last_segment.start))
 
-        if (utcnow() - downtime).total_seconds() < threshold:
-            history.append((UptimeEventTypes.DOWN, downtime))
+        if (utcnow() - last_segment.end).total_seconds() < (threshold or 0):
+            history.append((UptimeEventTypes.DOWN, last_segment.end))
 
         return history
     else:
         return [(UptimeEventTypes.UP, utcnow())]
 
 
-def time_site_came_up(utcnow=datetime.datetime.utcnow):
-    return get_uptime_history(utcnow=utcnow)[0][1]
+def get_uptime_history_many(service_names, utcnow=datetime.datetime.utcnow):
+    """
+    Return the uptime history of each of the services, keyed by service
+    name; see get_uptime_history.  The new heartbeats of all services are
+    processed together and their segments are read with one query.
+    """
+    uptime_states = update_uptime_segments_many(service_names)
+
+    segments = UptimeSegment.objects.filter(
+        uptime_state__in=uptime_states.values()).order_by('uptime_state', 'start')
+
+    segments_by_state = dict(
+        (uptime_state_id, list(state_segments))
+        for uptime_state_id, state_segments in itertools.groupby(segments, key=operator.attrgetter('uptime_state_id')))
+
+    return dict(
+        (service_name, build_uptime_history(
+            segments_by_state.get(uptime_state.id, []), uptime_state.cluster_threshold_seconds, utcnow))
+        for service_name, uptime_state in uptime_states.items()
+    )
+
+
+def get_uptime_history(utcnow=datetime.datetime.utcnow, service_name=DEFAULT_SERVICE_NAME):
+    """
+    Return a history of uptime data; the data are in ascending order,
+    going from least recent to most recent.  Each datum is a tuple:
+    (UP/Down datetime) where UP/DOWN is a value from UptimeEventType.
+    """
+    return get_uptime_history_many([service_name], utcnow=utcnow)[service_name]
+
+
+def time_site_came_up(utcnow=datetime.datetime.utcnow, service_name=DEFAULT_SERVICE_NAME):
+    """
+    Return the start of the service's earliest uptime segment.  Once a
+    segment exists this never changes, so it is a single row read; the
+    heartbeats are only processed while no segment exists yet.
+    """
+    first_segment = UptimeSegment.objects.filter(uptime_state__service_name=service_name).order_by('start').first()
+
+    if first_segment is None:
+        first_segment = update_uptime_segments(
+            service_name=service_name).uptimesegment_set.order_by('start').first()
+
+    return first_segment.start if first_segment else utcnow()
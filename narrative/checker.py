@@ -1,5 +1,7 @@
 import time
 
+from .executor import collect_notifications
+from .metrics import load_metrics_sinks, measure_periodical_run
 from .models import AssertionMeta, EventMeta
 
 
@@ -21,6 +23,32 @@ def detect_enabled_events(verbose=False):
         verbose, process_method_name='detect_and_handle', true_copy='DETECTED', false_copy='NOT DETECTED')
 
 
+def process_periodical(periodical_meta, verbose, process_method_name, true_copy, false_copy, metrics_sinks):
+    """
+    Run one periodical, measuring the run; see narrative.metrics.
+    """
+    if verbose:
+        print('Checking {0} {1}...'.format(
+            periodical_meta.__class__.__name__,
+            periodical_meta.display_name))
+
+    periodical_class = periodical_meta.load_class()
+
+    if not periodical_class:
+        print('     Error loading class "{0}"'.format(
+            periodical_meta.class_load_path))
+        return
+
+    with measure_periodical_run(periodical_meta, metrics_sinks) as run:
+        periodical_obj = periodical_class(periodical_meta)
+        run.succeeded = bool(getattr(periodical_obj, process_method_name)())
+
+    if verbose:
+        print('     {0} ({1:.3f} seconds, {2} queries, {3})'.format(
+            true_copy if run.succeeded else false_copy, run.duration_seconds, run.query_count,
+            ', '.join('{0} {1}'.format(count, name.replace('_', ' ')) for name, count in sorted(run.counters.items()))))
+
+
 def process_periodicals(
         periodical_meta_list, verbose, process_method_name,
         true_copy='PASSED', false_copy='FAILED'):
@@ -30,27 +58,21 @@ def process_periodicals(
     start_time = time.time()
 
     check_count = 0
-
-    for periodical_meta in periodical_meta_list:
-        if periodical_meta.should_check():
-            if verbose:
-                print('Checking {0} {1}...'.format(
-                    periodical_meta.__class__.__name__,
-                    periodical_meta.display_name))
-
-                periodical_class = periodical_meta.load_class()
-
-                if periodical_class:
-                    periodical_obj = periodical_class(periodical_meta)
-                    success = getattr(periodical_obj, process_method_name)()
-
-                    if verbose:
-                        print('     {0}'.format(true_copy if success else false_copy))
-                else:
-                    print('     Error loading class "{0}"'.format(
-                        periodical_meta.class_load_path))
-
-            check_count += 1
+    metrics_sinks = load_metrics_sinks()
+
+    try:
+        # Admins get one digest of everything deferred to them during the run
+        with collect_notifications():
+            for periodical_meta in periodical_meta_list:
+                if periodical_meta.should_check():
+                    process_periodical(
+                        periodical_meta, verbose, process_method_name, true_copy, false_copy, metrics_sinks)
+
+                    check_count += 1
+    finally:
+        # Keep the metrics of the runs that finished, even if a later one raised
+        for metrics_sink in metrics_sinks:
+            metrics_sink.flush()
 
     end_time = time.time()
 
@@ -6,7 +6,13 @@ def construct_escalating_response(issue, response_map):
     'response_map' that maps a given response to a specific
     escalation_number (ie, how many previous responses there
     has been to this issue).
+
+    The escalation number is read from the issue without a query;
+    the steps are only loaded if there is a response for it.
     """
-    non_pass_steps = issue.get_non_pass_steps()
+    response = response_map.get(issue.non_pass_step_count)
+
+    if response is None:
+        return None
 
-    return response_map.get(len(non_pass_steps), lambda x: None)(non_pass_steps)
+    return response(issue.get_non_pass_steps())
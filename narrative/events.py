@@ -1,7 +1,9 @@
 import abc
+import collections
 import copy
 import datetime
 import json
+import uuid
 
 import six
 
@@ -9,10 +11,15 @@ from narrative.models import Datum
 from narrative.executor import Executor
 
 
+# Number of summary datums looked up per query; keeps the IN lists within database limits
+SUMMARY_DATUM_CHUNK_SIZE = 500
+
+
 class Event(six.with_metaclass(abc.ABCMeta, object)):
 
     def __init__(self, event_meta):
         self.event_meta = event_meta
+        self._executor = None
 
     @property
     def args(self):
@@ -22,6 +29,18 @@ class Event(six.with_metaclass(abc.ABCMeta, object)):
     def detect(self, *args, **kwargs):
         pass
 
+    def detect_many(self, *args, **kwargs):
+        """
+        Return the instance summaries of all of the occurrences of this
+        event detected.  Events that can detect many occurrences at once
+        override this; their occurrences are then handled in bulk by
+        detect_and_handle.
+        """
+        if self.detect(*args, **kwargs):
+            return [self.instance_summary(*args, **kwargs)]
+
+        return []
+
     @abc.abstractmethod
     def instance_summary(self, *args, **kwargs):
         """
@@ -37,7 +56,13 @@ class Event(six.with_metaclass(abc.ABCMeta, object)):
 
     @property
     def executor(self):
-        return Executor()
+        """
+        The Executor this event notifies with; one per instance.
+        """
+        if self._executor is None:
+            self._executor = Executor()
+
+        return self._executor
 
     @property
     def origin_name(self):
@@ -46,21 +71,24 @@ class Event(six.with_metaclass(abc.ABCMeta, object)):
     def get_utc_now(self):
         return datetime.datetime.utcnow()
 
-    def event_instance_detected(self):
+    def event_instance_detected(self, *args, **kwargs):
         """
         This method is called when the event instance is first detected.
         """
         pass
 
+    def get_summary_datum_kwargs(self):
+        return {
+            'origin': self.origin_name,
+            'datum_name': self.event_meta.display_name,
+        }
+
     def get_or_create_summary_datum(self, *args, **kwargs):
         """
         Create the summary datum to represent this occurrence of this event.
         """
-        datum_kwargs = {
-            'origin': self.origin_name,
-            'datum_name': self.event_meta.display_name,
-            'datum_note_json': json.dumps(self.instance_summary(*args, **kwargs)),
-        }
+        datum_kwargs = self.get_summary_datum_kwargs()
+        datum_kwargs['datum_note_json'] = json.dumps(self.instance_summary(*args, **kwargs))
 
         defaults = copy.copy(datum_kwargs)
 
@@ -75,12 +103,70 @@ class Event(six.with_metaclass(abc.ABCMeta, object)):
 
         return created
 
+    def create_summary_datums(self, instance_summaries):
+        """
+        Create the summary datums for the occurrences that do not have one
+        yet, returning the summaries of those occurrences.  Existing datums
+        are looked up with one query per chunk of summaries, and the new
+        ones are inserted in bulk.
+
+        Nothing in the database keeps the summary datums unique, and a
+        chunk is checked well before it is inserted; two runs of the same
+        event at once can both create a datum for an occurrence, and both
+        hand it to event_instance_detected.  Events whose handling must
+        happen once should only be checked by one worker at a time.
+        """
+        datum_kwargs = self.get_summary_datum_kwargs()
+
+        if self.summary_datum_ttl:
+            datum_kwargs['ttl'] = self.summary_datum_ttl
+
+        # Summaries keyed by their json, in the order they were detected
+        summaries_by_note_json = collections.OrderedDict(
+            (json.dumps(instance_summary), instance_summary) for instance_summary in instance_summaries)
+        note_jsons = list(summaries_by_note_json)
+        new_summaries = []
+
+        for index in range(0, len(note_jsons), SUMMARY_DATUM_CHUNK_SIZE):
+            chunk_note_jsons = note_jsons[index:index + SUMMARY_DATUM_CHUNK_SIZE]
+            existing_note_jsons = set(Datum.objects.filter(
+                origin=datum_kwargs['origin'], datum_name=datum_kwargs['datum_name'],
+                datum_note_json__in=chunk_note_jsons).values_list('datum_note_json', flat=True))
+
+            new_note_jsons = [note_json for note_json in chunk_note_jsons if note_json not in existing_note_jsons]
+
+            # bulk_create skips Datum.save, so the thread ids are set here
+            Datum.objects.bulk_create([
+                Datum(datum_note_json=note_json, thread_id=str(uuid.uuid4()), **datum_kwargs)
+                for note_json in new_note_jsons
+            ])
+
+            new_summaries.extend(summaries_by_note_json[note_json] for note_json in new_note_jsons)
+
+        return new_summaries
+
+    def detect_many_and_handle(self, *args, **kwargs):
+        """
+        Detect all occurrences of the event, create datums for the new ones
+        and handle each of those; its summary is passed to
+        event_instance_detected as instance_summary.
+        """
+        instance_summaries = self.detect_many(*args, **kwargs)
+
+        for instance_summary in self.create_summary_datums(instance_summaries):
+            self.event_instance_detected(*args, instance_summary=instance_summary, **kwargs)
+
+        return bool(instance_summaries)
+
     def detect_and_handle(self, *args, **kwargs):
         """
         Check if the event has occured.  If so,
         check if a datum already exists noting this event.  If not,
         create a datum, and perform any needed handling of the event.
         """
+        if six.get_unbound_function(type(self).detect_many) is not six.get_unbound_function(Event.detect_many):
+            return self.detect_many_and_handle(*args, **kwargs)
+
         if self.detect(*args, **kwargs):
             created = self.get_or_create_summary_datum(*args, **kwargs)
 
@@ -1,11 +1,24 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import datetime
+import functools
+from multiprocessing.pool import ThreadPool
+import threading
+
 from django.contrib.auth.models import Group
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.template.loader import render_to_string
+import six
+
+from .metrics import record_metric
+from .plans import is_step_group, iter_plan_steps
+from .utils import format_error_traceback
 
 
 # misc utility methods ---
-def blast_email(subject, message_txt, message_html, recipients):
+def build_email(subject, message_txt, message_html, recipients):
     email = EmailMultiAlternatives(
         subject, message_txt, settings.NARRATIVE_REPLY_EMAIL_ADDRESS,
         recipients, headers={'Reply-To': settings.NARRATIVE_REPLY_EMAIL_ADDRESS})
@@ -13,40 +26,407 @@ def blast_email(subject, message_txt, message_html, recipients):
     if message_html:
         email.attach_alternative(message_html, 'text/html')
 
-    email.send()
+    return email
+
+
+def blast_email(subject, message_txt, message_html, recipients):
+    build_email(subject, message_txt, message_html, recipients).send()
+    record_metric('emails_sent')
+
+
+class NotificationDigest(object):
+    """
+    Collects the admin notifications sent while it is active, so each
+    recipient gets a single digest instead of an email per notification.
+    Notifications are grouped by subject, and repeats of the same message
+    are only counted.  It may be added to from several threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = False
+
+        # recipient -> subject -> (message_txt, message_html) -> count
+        self.notifications = OrderedDict()
+
+    def add(self, subject, message_txt, message_html, recipients):
+        """
+        Add a notification to the digest; returns False, without adding it,
+        if the digest has already been sent.
+        """
+        with self.lock:
+            if self.sent:
+                return False
+
+            for recipient in recipients:
+                messages = self.notifications.setdefault(recipient, OrderedDict()).setdefault(subject, OrderedDict())
+                messages[(message_txt, message_html)] = messages.get((message_txt, message_html), 0) + 1
+
+            return True
+
+    def build_messages(self):
+        """
+        Build the digest email for each recipient; a recipient with only a
+        single notification gets it as it would have been sent on its own.
+        """
+        emails = []
+
+        for recipient, subjects in self.notifications.items():
+            if len(subjects) == 1:
+                subject, messages = list(subjects.items())[0]
+
+                if list(messages.values()) == [1]:
+                    message_txt, message_html = list(messages)[0]
+                    emails.append(build_email(subject, message_txt, message_html, [recipient]))
+                    continue
+
+            message_kwargs = {
+                'notification_count': sum(sum(messages.values()) for messages in subjects.values()),
+                'subjects': [
+                    {
+                        'subject': digest_subject,
+                        'messages': [
+                            {'message_txt': digest_message_txt, 'message_html': digest_message_html, 'count': count}
+                            for (digest_message_txt, digest_message_html), count in digest_messages.items()
+                        ],
+                    }
+                    for digest_subject, digest_messages in subjects.items()
+                ],
+            }
+
+            emails.append(build_email(
+                'Narrative digest: {0} notifications'.format(message_kwargs['notification_count']),
+                render_to_string('notification_digest.txt', message_kwargs),
+                render_to_string('notification_digest.html', message_kwargs),
+                [recipient]))
+
+        return emails
+
+    def send(self):
+        """
+        Send the digests over a single connection to the mail server.
+        """
+        with self.lock:
+            emails = self.build_messages()
+            self.notifications = OrderedDict()
+            self.sent = True
+
+        if emails:
+            get_connection().send_messages(emails)
+
+        return len(emails)
+
+
+_active_digests = threading.local()
+
+
+def get_active_digest():
+    """
+    Return the innermost NotificationDigest collecting on this thread, if any.
+    """
+    digests = getattr(_active_digests, 'stack', None)
+
+    return digests[-1] if digests else None
+
+
+@contextmanager
+def use_digest(digest):
+    """
+    Collect the admin notifications sent on this thread within the block into digest.
+    """
+    if not hasattr(_active_digests, 'stack'):
+        _active_digests.stack = []
+
+    _active_digests.stack.append(digest)
+
+    try:
+        yield digest
+    finally:
+        _active_digests.stack.pop()
+
+
+def bind_active_digest(func):
+    """
+    Wrap func so the notifications it sends go to the digest collecting on
+    the calling thread, whichever thread of this process it then runs on.
+    """
+    digest = get_active_digest()
+
+    if digest is None:
+        return func
+
+    @functools.wraps(func)
+    def run_with_digest(*args, **kwargs):
+        with use_digest(digest):
+            return func(*args, **kwargs)
+
+    return run_with_digest
+
+
+@contextmanager
+def collect_notifications():
+    """
+    Collect the admin notifications sent on this thread within the block
+    into a NotificationDigest, and send it when the block exits.
+
+    The digest is thread local; work handed to other threads has to be
+    wrapped with bind_active_digest to be collected, as the plan group,
+    parallel diagnosis and solution job threads are.  Worker processes
+    (sharded model assertions and run_solution_jobs with processes) cannot
+    reach it, so they email as usual, as does any thread that outlives the
+    block.
+    """
+    with use_digest(NotificationDigest()) as digest:
+        try:
+            yield digest
+        finally:
+            digest.send()
+
+
+class AdminRecipientCache(object):
+    """
+    Remembers the email addresses of the admin group for
+    NARRATIVE_ADMIN_RECIPIENT_TTL (a minute by default); any change to
+    the group's membership drops them immediately.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.admin_emails = None
+        self.expires = None
+
+    def get_admin_emails(self, get_utc_now=datetime.datetime.utcnow):
+        utc_now = get_utc_now()
+
+        with self.lock:
+            if self.admin_emails is not None and utc_now < self.expires:
+                return self.admin_emails
+
+        admin_group = Group.objects.get(name=settings.NARRATIVE_ADMIN_GROUP_NAME)
+        admin_emails = list(admin_group.user_set.values_list('email', flat=True))
+
+        with self.lock:
+            self.admin_emails = admin_emails
+            self.expires = utc_now + getattr(
+                settings, 'NARRATIVE_ADMIN_RECIPIENT_TTL', datetime.timedelta(minutes=1))
+
+        return admin_emails
+
+    def invalidate(self, *args, **kwargs):
+        with self.lock:
+            self.admin_emails = None
+
+
+admin_recipient_cache = AdminRecipientCache()
+
 
+def invalidate_on_membership_change(sender, instance, model, **kwargs):
+    # Adding users to a group and groups to a user both land here
+    if isinstance(instance, Group) or model is Group:
+        admin_recipient_cache.invalidate()
+
+
+m2m_changed.connect(invalidate_on_membership_change, dispatch_uid='narrative_admin_membership')
+post_save.connect(admin_recipient_cache.invalidate, sender=Group, dispatch_uid='narrative_admin_group_saved')
+post_delete.connect(admin_recipient_cache.invalidate, sender=Group, dispatch_uid='narrative_admin_group_deleted')
+
+
+class InvalidPlanError(ValueError):
+    """
+    Raised when compiling a plan with a step the Executor does not support,
+    or with an empty step group.
+    """
+    def __init__(self, step):
+        self.step = step
+
+        super(InvalidPlanError, self).__init__('Invalid step: {0}'.format(step))
+
+
+class PlanExecutionError(Exception):
+    """
+    Raised when steps of a step group fail; carries the traceback of each failed step.
+    """
+    def __init__(self, step_errors):
+        self.step_errors = step_errors
+
+        super(PlanExecutionError, self).__init__('{0} step(s) failed'.format(len(step_errors)) + ''.join(
+            '\n\nStep {0} failed:\n{1}'.format(step, error_traceback) for step, error_traceback in step_errors))
+
+
+class CompiledPlan(object):
+    """
+    A plan validated against an executor, with the handler of each step
+    looked up once; executing it again does no further validation or lookups.
+    Each item is a (step, handler) pair, or a list of them for a step group.
+    """
+    def __init__(self, executor, plan):
+        self.executor = executor
+        self.items = [self.compile_item(item) for item in plan]
+
+    def compile_item(self, item):
+        if len(item) == 0:
+            # An empty step group has nothing to run
+            raise InvalidPlanError(item)
+
+        return [self.compile_step(step) for step in item] if is_step_group(item) else self.compile_step(item)
+
+    def compile_step(self, step):
+        action, kwargs = step
+        handler = self.executor.get_handler(action)
+
+        if handler is None:
+            raise InvalidPlanError(step)
+
+        return (step, handler)
+
+    def execute(self):
+        for item in self.items:
+            if isinstance(item, list):
+                self.execute_step_group(item)
+            else:
+                self.execute_step(*item)
+
+    def execute_step(self, step, handler):
+        action, kwargs = step
+
+        self.executor.run_handler(action, handler, kwargs)
+
+    def execute_step_group(self, step_group):
+        """
+        Run the steps of a group concurrently on up to NARRATIVE_PLAN_GROUP_WORKERS
+        threads.  Every step is run even if others fail; the failures are then
+        raised together as a PlanExecutionError.
+        """
+        def run_step(compiled_step):
+            try:
+                self.execute_step(*compiled_step)
+            except Exception:
+                return (compiled_step[0], format_error_traceback())
+
+        pool = ThreadPool(min(len(step_group), getattr(settings, 'NARRATIVE_PLAN_GROUP_WORKERS', 8)))
+
+        try:
+            step_errors = [
+                step_error for step_error in pool.map(bind_active_digest(run_step), step_group) if step_error]
+        finally:
+            pool.close()
+            pool.join()
+
+        if step_errors:
+            raise PlanExecutionError(step_errors)
+
+
+class ExecutorMeta(type):
+    """
+    Builds the action dispatch table of each Executor class once, when the
+    class is created: action name -> name of its do_* method, or a handler
+    function registered with register_action.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(ExecutorMeta, cls).__init__(name, bases, attrs)
+
+        cls.action_handlers = {}
+
+        for base in reversed(cls.__mro__[1:]):
+            cls.action_handlers.update(getattr(base, 'action_handlers', {}))
+
+        cls.action_handlers.update(
+            (attr_name[len('do_'):], attr_name)
+            for attr_name, attr in attrs.items() if attr_name.startswith('do_') and callable(attr))
+
+
+class Executor(six.with_metaclass(ExecutorMeta, object)):
+    # Action name -> semaphore limiting how many steps run that action at once
+    action_semaphores = {}
+
+    @classmethod
+    def register_action(cls, action_name, handler=None):
+        """
+        Make an action available to this Executor class and its subclasses
+        without subclassing; the handler is called with the executor and the
+        step's kwargs.  Subclasses that handle the action themselves keep
+        their own handler.  Can be used as a decorator.
+        """
+        if handler is None:
+            return lambda handler: cls.register_action(action_name, handler)
+
+        def register(executor_class, inherited_handler):
+            if executor_class.action_handlers.get(action_name) == inherited_handler:
+                executor_class.action_handlers[action_name] = handler
+
+                for subclass in executor_class.__subclasses__():
+                    register(subclass, inherited_handler)
+
+        register(cls, cls.action_handlers.get(action_name))
+
+        return handler
 
-class Executor(object):
     def get_action_handler(self, action_name):
         return 'do_{0}'.format(action_name)
 
+    def get_handler(self, action_name):
+        """
+        Return the callable that performs the action, or None if it is not supported.
+        """
+        handler = self.action_handlers.get(action_name)
+
+        if handler is None:
+            return None
+        elif isinstance(handler, six.string_types):
+            return getattr(self, handler)
+        else:
+            return functools.partial(handler, self)
+
     def can_execute(self, action_sequence):
         """"
-        Examine all of the steps in an action sequence and verify
-        that they are supported by the Executor.
+        Examine all of the steps in an action sequence, including those in
+        step groups, and verify that they are supported by the Executor.
         """
-        for step in action_sequence:
+        for step in iter_plan_steps(action_sequence):
+            if len(step) == 0:
+                # An empty step group
+                return (False, step)
+
             action, kwargs = step
 
-            if not hasattr(self, self.get_action_handler(action)):
+            if action not in self.action_handlers:
                 return (False, step)
         else:
             return (True, None)
 
+    def compile(self, action_sequence):
+        """
+        Validate a plan and look up the handler of each of its steps, returning
+        a CompiledPlan that can be executed any number of times.
+        """
+        return CompiledPlan(self, action_sequence)
+
     def execute(self, action_sequence):
-        for step in action_sequence:
-            action, kwargs = step
+        self.compile(action_sequence).execute()
 
-            getattr(self, self.get_action_handler(action))(**kwargs)
+    def execute_step(self, step):
+        action, kwargs = step
+
+        self.run_handler(action, self.get_handler(action), kwargs)
+
+    def run_handler(self, action, handler, kwargs):
+        semaphore = self.action_semaphores.get(action)
+
+        if semaphore is None:
+            handler(**kwargs)
+        else:
+            with semaphore:
+                handler(**kwargs)
 
     # do_* methods for executing particular operations such as notifying individuals ---
     def do_defer_to_admins(self, subject, message, message_html=None):
-        admin_group = Group.objects.get(name=settings.NARRATIVE_ADMIN_GROUP_NAME)
-        admins = admin_group.user_set.all()
+        admin_emails = admin_recipient_cache.get_admin_emails()
 
-        admin_emails = [admin.email for admin in admins]
+        digest = get_active_digest()
 
-        blast_email(subject, message, message_html, admin_emails)
+        if digest is not None and digest.add(subject, message, message_html, admin_emails):
+            # It is sent along with everything else collected during this run, once the run is no longer measured
+            record_metric('notifications_deferred')
+        else:
+            blast_email(subject, message, message_html, admin_emails)
 
     def do_defer_multiple_solutions_to_admins(self, resolution_steps, assertion_display_name):
         subject = 'Impasse: "{0}" has Multiple resolution steps proposed'.format(
@@ -0,0 +1,301 @@
+"""
+Queued execution of solution plans.
+
+With NARRATIVE_QUEUE_SOLUTIONS enabled, Assertion.execute_solution stores
+each validated solution as a SolutionJob instead of running its plan inline,
+so slow steps no longer hold up check_assertions.  The run_solution_jobs
+command then executes the jobs with a pool of worker threads or processes.
+
+Settings:
+    NARRATIVE_SOLUTION_JOB_WORKERS - number of workers (4)
+    NARRATIVE_SOLUTION_JOB_TIMEOUT - time a plan may run before the attempt fails (5 minutes)
+    NARRATIVE_SOLUTION_JOB_MAX_ATTEMPTS - attempts before a job is given up on (3)
+    NARRATIVE_SOLUTION_JOB_RETRY_DELAY - wait before the first retry; doubled for each one after (1 minute)
+    NARRATIVE_SOLUTION_JOB_HEARTBEAT - how often the worker running a job's plan marks the job
+        as alive (15 seconds); a running job not marked for four times that is abandoned
+    NARRATIVE_ACTION_CONCURRENCY - dict of action name to the number of workers that
+        may run that action at once; actions not listed are unlimited
+"""
+import datetime
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+
+from django.conf import settings
+from django.db import connection, DatabaseError
+from django.db.models import F, Q
+from pytz import utc as utc_tz
+from six.moves import queue
+
+from .executor import bind_active_digest
+from .models import load_class, SolutionJob, SolutionJobStatusType
+from .utils import format_error_traceback
+
+
+def get_job_timeout():
+    return getattr(settings, 'NARRATIVE_SOLUTION_JOB_TIMEOUT', datetime.timedelta(minutes=5))
+
+
+def get_job_heartbeat():
+    return getattr(settings, 'NARRATIVE_SOLUTION_JOB_HEARTBEAT', datetime.timedelta(seconds=15))
+
+
+def get_class_load_path(cls):
+    return '{0}.{1}'.format(cls.__module__, cls.__name__)
+
+
+def enqueue_solution(solution, executor):
+    """
+    Store a validated solution for the workers to execute with executor's class.
+    """
+    return SolutionJob.objects.create(
+        solution=solution,
+        executor_class_load_path=get_class_load_path(executor.__class__),
+        max_attempts=getattr(settings, 'NARRATIVE_SOLUTION_JOB_MAX_ATTEMPTS', 3))
+
+
+# Action name -> semaphore limiting how many workers run it at once; set up by init_worker
+action_semaphores = {}
+
+
+def init_worker(semaphores):
+    action_semaphores.clear()
+    action_semaphores.update(semaphores)
+
+
+def execute_plan(executor_class_load_path, plan):
+    """
+    Execute each step of the plan, respecting the per action concurrency limits.
+    """
+    executor = load_class(executor_class_load_path)()
+    executor.action_semaphores = action_semaphores
+
+    executor.compile(plan).execute()
+
+
+def record_job_heartbeat(job_id, attempt, utc_now):
+    """
+    Mark the attempt at the job as alive; see requeue_abandoned_jobs.
+    """
+    return SolutionJob.objects.filter(
+        id=job_id, attempts=attempt, status=SolutionJobStatusType.RUNNING).update(heartbeat=utc_now)
+
+
+def beat_while_running(job_id, attempt, plan_thread):
+    """
+    Record the heartbeat of the attempt at the job until its plan finishes,
+    whether or not the runner is still waiting for it.
+    """
+    interval_seconds = get_job_heartbeat().total_seconds()
+
+    try:
+        while True:
+            plan_thread.join(interval_seconds)
+
+            if not plan_thread.is_alive():
+                return
+
+            try:
+                record_job_heartbeat(job_id, attempt, datetime.datetime.utcnow())
+            except DatabaseError:
+                # A missed beat only brings the job closer to being requeued
+                pass
+    finally:
+        # The heartbeat thread has a connection of its own
+        connection.close()
+
+
+def execute_solution_job(job_id, attempt, executor_class_load_path, plan, timeout_seconds):
+    """
+    Run a job's plan in a worker; returns the job id, the error traceback
+    of the attempt if it failed, and whether the plan is still running.  A
+    plan still running after the timeout is left to finish in the
+    background, and the attempt counts as failed.  This always returns,
+    whatever goes wrong, so the runner is never left waiting on it.  The
+    heartbeat of the attempt is recorded for as long as the plan runs.
+    """
+    outcome = {}
+
+    def run():
+        try:
+            execute_plan(executor_class_load_path, plan)
+        except Exception:
+            outcome['error_traceback'] = format_error_traceback()
+
+    try:
+        plan_thread = threading.Thread(target=bind_active_digest(run))
+        plan_thread.daemon = True
+        plan_thread.start()
+
+        heartbeat_thread = threading.Thread(target=beat_while_running, args=(job_id, attempt, plan_thread))
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        plan_thread.join(timeout_seconds)
+    except Exception:
+        return (job_id, format_error_traceback(), False)
+
+    if plan_thread.is_alive():
+        return (job_id, 'Timed out after {0} seconds'.format(timeout_seconds), True)
+
+    return (job_id, outcome.get('error_traceback'), False)
+
+
+def requeue_abandoned_jobs(utc_now):
+    """
+    Put jobs whose plan is no longer running back in the queue.  The worker
+    running a plan records the job's heartbeat while the plan runs, even
+    after a timed out attempt is finished (see finish_solution_job), so a
+    running job without a heartbeat for four heartbeat intervals has been
+    abandoned: its runner died, or its timed out plan has since stopped.
+    Abandoned jobs that are out of attempts are failed, and the failure is
+    recorded on their solutions.
+    """
+    last_alive = utc_now - 4 * get_job_heartbeat()
+    abandoned_jobs = SolutionJob.objects.filter(
+        Q(heartbeat__lt=last_alive) | Q(heartbeat__isnull=True, started__lt=last_alive),
+        status=SolutionJobStatusType.RUNNING)
+
+    for job in abandoned_jobs.filter(attempts__gte=F('max_attempts')).select_related('solution'):
+        finish_solution_job(job, job.error_traceback or 'Abandoned by its runner', utc_now)
+
+    return abandoned_jobs.update(status=SolutionJobStatusType.PENDING)
+
+
+def claim_solution_job(utc_now):
+    """
+    Claim the next job that is due, returning None if there are none.  Each
+    job can only be claimed by one runner.
+    """
+    while True:
+        job = SolutionJob.objects.filter(
+            status=SolutionJobStatusType.PENDING, next_attempt__lte=utc_now).order_by(
+            'next_attempt', 'id').select_related('solution').first()
+
+        if job is None:
+            return None
+
+        claimed = SolutionJob.objects.filter(id=job.id, status=SolutionJobStatusType.PENDING).update(
+            status=SolutionJobStatusType.RUNNING, started=utc_now, heartbeat=utc_now, attempts=F('attempts') + 1)
+
+        if claimed:
+            job.status = SolutionJobStatusType.RUNNING
+            job.started = utc_now
+            job.heartbeat = utc_now
+            job.attempts += 1
+
+            return job
+
+
+def finish_solution_job(job, error_traceback, utc_now, plan_running=False):
+    """
+    Record the outcome of an attempt at the job; failed attempts are retried
+    with an exponential backoff until the job runs out of attempts.  Once the
+    job is done, the solution is marked as enacted.
+
+    A timed out attempt whose plan is still running in the background is not
+    retried alongside it; the job is left running, with the failure recorded,
+    and requeue_abandoned_jobs puts it back in the queue once the plan has
+    stopped recording the job's heartbeat.
+    """
+    job.error_traceback = error_traceback
+    job.finished = utc_now
+
+    if error_traceback is None:
+        job.status = SolutionJobStatusType.SUCCEEDED
+    elif job.attempts < job.max_attempts:
+        if not plan_running:
+            retry_delay = getattr(settings, 'NARRATIVE_SOLUTION_JOB_RETRY_DELAY', datetime.timedelta(minutes=1))
+
+            job.status = SolutionJobStatusType.PENDING
+            job.next_attempt = utc_now + retry_delay * 2 ** (job.attempts - 1)
+    else:
+        job.status = SolutionJobStatusType.FAILED
+
+    job.save()
+
+    if job.status in (SolutionJobStatusType.SUCCEEDED, SolutionJobStatusType.FAILED):
+        solution = job.solution
+        solution.error_traceback = error_traceback
+        solution.enacted = utc_tz.localize(utc_now)
+        solution.save()
+
+
+def run_solution_jobs(
+        worker_count=None, use_processes=False, verbose=False, get_utc_now=datetime.datetime.utcnow):
+    """
+    Execute the queued solution jobs that are due, until there are none
+    left.  Only the workers run plans; claiming jobs and recording their
+    outcomes is done here.  Returns the number of attempts made.
+    """
+    worker_count = worker_count or getattr(settings, 'NARRATIVE_SOLUTION_JOB_WORKERS', 4)
+    timeout_seconds = get_job_timeout().total_seconds()
+
+    requeue_abandoned_jobs(get_utc_now())
+
+    if use_processes:
+        semaphore_class = multiprocessing.BoundedSemaphore
+
+        # Forked workers must not share the database connection
+        connection.close()
+    else:
+        semaphore_class = threading.BoundedSemaphore
+
+    semaphores = dict(
+        (action, semaphore_class(limit))
+        for action, limit in getattr(settings, 'NARRATIVE_ACTION_CONCURRENCY', {}).items())
+
+    pool_class = multiprocessing.Pool if use_processes else ThreadPool
+
+    # Worker threads add their notifications to any digest collecting here; worker processes cannot
+    execute_job = execute_solution_job if use_processes else bind_active_digest(execute_solution_job)
+    pool = pool_class(worker_count, initializer=init_worker, initargs=(semaphores,))
+
+    outcomes = queue.Queue()
+    running_jobs = {}
+    attempt_count = 0
+    workers_lost = False
+
+    try:
+        while True:
+            # Keep every worker busy, but only claim jobs a worker can start on right away
+            while len(running_jobs) < worker_count:
+                job = claim_solution_job(get_utc_now())
+
+                if job is None:
+                    break
+
+                running_jobs[job.id] = job
+                pool.apply_async(
+                    execute_job,
+                    (job.id, job.attempts, job.executor_class_load_path, job.solution.get_plan(), timeout_seconds),
+                    callback=outcomes.put)
+
+            if not running_jobs:
+                break
+
+            try:
+                # Every worker reports back within the timeout, whatever its plan is doing
+                job_id, error_traceback, plan_running = outcomes.get(timeout=2 * timeout_seconds)
+            except queue.Empty:
+                # The workers were lost (a worker process was killed, say); their
+                # jobs are left running for requeue_abandoned_jobs
+                workers_lost = True
+                break
+
+            job = running_jobs.pop(job_id)
+
+            finish_solution_job(job, error_traceback, get_utc_now(), plan_running=plan_running)
+            attempt_count += 1
+
+            if verbose:
+                print('{0}: {1}'.format(job, 'FAILED' if error_traceback else 'SUCCEEDED'))
+    finally:
+        if workers_lost:
+            pool.terminate()
+        else:
+            pool.close()
+
+        pool.join()
+
+    return attempt_count
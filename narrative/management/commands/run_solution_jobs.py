@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from narrative.jobs import run_solution_jobs
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--verbose', action='store_true', dest='verbose', default=False,
+            help='Determines if we should display the outcome of each job'),
+        make_option(
+            '--workers', action='store', type='int', dest='workers', default=None,
+            help='Number of workers; defaults to NARRATIVE_SOLUTION_JOB_WORKERS'),
+        make_option(
+            '--processes', action='store_true', dest='processes', default=False,
+            help='Run the workers as processes rather than threads'),)
+    help = (
+        'Execute any queued solution jobs that are due.')
+
+    def handle(self, *args, **options):
+        run_solution_jobs(
+            worker_count=options['workers'], use_processes=options['processes'], verbose=options['verbose'])
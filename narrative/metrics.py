@@ -0,0 +1,414 @@
+"""
+Metrics for each run of an assertion or event.
+
+process_periodicals measures every periodical it runs: how long the run
+took, how many queries it made, and the counters the run recorded with
+record_metric (records checked, issues opened and resolved, emails sent and
+admin notifications deferred to the digest).
+Each run is handed to the metrics sinks, and the runs are stored as
+PeriodicalRuns in bulk once the checker is done with all of them; runs older
+than the retention period are deleted then.
+
+Settings:
+    NARRATIVE_METRICS_SINKS - class load paths of the sinks to report runs to
+        (['narrative.metrics.LoggingMetricsSink'])
+    NARRATIVE_STATSD_ADDRESS - (host, port) StatsdMetricsSink sends to (('localhost', 8125))
+    NARRATIVE_STATSD_PREFIX - prefix of the statsd metric names ('narrative')
+    NARRATIVE_PROMETHEUS_TEXTFILE_DIRECTORY - directory PrometheusTextfileMetricsSink
+        writes its .prom files to, eg that of the node exporter's textfile collector
+    NARRATIVE_PERIODICAL_RUN_TTL - how long PeriodicalRuns are kept (30 days)
+    NARRATIVE_PERIODICAL_RUN_WINDOW - how far back get_periodical_costs looks (7 days)
+"""
+from contextlib import contextmanager
+import datetime
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from .models import load_class, PeriodicalRun
+
+
+COUNTER_NAMES = ('records_checked', 'issues_opened', 'issues_resolved', 'emails_sent', 'notifications_deferred')
+
+
+class PeriodicalRunMetrics(object):
+    """
+    The metrics of a run in progress.
+    """
+    def __init__(self, periodical_meta):
+        self.periodical_meta = periodical_meta
+        self.started = datetime.datetime.utcnow()
+        self.duration_seconds = 0.0
+        self.query_count = 0
+        self.succeeded = None
+        self.counters = dict((name, 0) for name in COUNTER_NAMES)
+
+    @classmethod
+    def from_periodical_run(cls, periodical_run, periodical_meta):
+        """
+        The metrics of a stored run.
+        """
+        run = cls(periodical_meta)
+        run.started = periodical_run.started
+        run.duration_seconds = periodical_run.duration_seconds
+        run.query_count = periodical_run.query_count
+        run.succeeded = periodical_run.succeeded
+        run.counters = dict((name, getattr(periodical_run, name)) for name in COUNTER_NAMES)
+
+        return run
+
+    @property
+    def kind(self):
+        return self.periodical_meta._meta.model_name
+
+    @property
+    def name(self):
+        return self.periodical_meta.display_name
+
+    def as_dict(self):
+        metrics = {
+            'kind': self.kind,
+            'name': self.name,
+            'started': self.started.isoformat(),
+            'duration_seconds': self.duration_seconds,
+            'query_count': self.query_count,
+            'succeeded': self.succeeded,
+        }
+        metrics.update(self.counters)
+
+        return metrics
+
+    def build_periodical_run(self):
+        return PeriodicalRun(
+            meta=self.periodical_meta, started=self.started, duration_seconds=self.duration_seconds,
+            succeeded=self.succeeded, query_count=self.query_count, **self.counters)
+
+
+_active_runs = threading.local()
+
+
+def get_active_run():
+    """
+    Return the PeriodicalRunMetrics of the run in progress on this thread, if any.
+    """
+    runs = getattr(_active_runs, 'stack', None)
+
+    return runs[-1] if runs else None
+
+
+def record_metric(name, amount=1):
+    """
+    Add to a counter of the run in progress on this thread; outside of
+    a measured run, this does nothing.
+    """
+    run = get_active_run()
+
+    if run is not None:
+        run.counters[name] += amount
+
+
+_query_counts = threading.local()
+
+
+def get_query_count():
+    """
+    The number of queries made on this thread with a counting cursor.
+    """
+    return getattr(_query_counts, 'count', 0)
+
+
+class QueryCountingCursor(object):
+    """
+    Wraps a cursor of the connection and counts the queries run with it;
+    only the count is kept, not the SQL.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        _query_counts.count = get_query_count() + 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _query_counts.count = get_query_count() + 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextmanager
+def count_queries(run):
+    """
+    Count the queries made on this thread's connection within the block.
+    The cursors of the connection are wrapped for the duration of the
+    outermost block, rather than turning on the debug cursor, so a long
+    run does not hold on to the SQL of every query it made.
+    """
+    database = connections[DEFAULT_DB_ALIAS]
+    wrap_cursors = 'cursor' not in database.__dict__
+
+    if wrap_cursors:
+        make_cursor = database.cursor
+        database.cursor = lambda: QueryCountingCursor(make_cursor())
+
+    first_query_count = get_query_count()
+
+    try:
+        yield
+    finally:
+        run.query_count = get_query_count() - first_query_count
+
+        if wrap_cursors:
+            del database.cursor
+
+
+@contextmanager
+def measure_periodical_run(periodical_meta, sinks=()):
+    """
+    Measure the run of the periodical within the block, then report it to
+    the sinks.  Set succeeded on the yielded PeriodicalRunMetrics to the
+    outcome of the run.
+    """
+    run = PeriodicalRunMetrics(periodical_meta)
+
+    if not hasattr(_active_runs, 'stack'):
+        _active_runs.stack = []
+
+    _active_runs.stack.append(run)
+    start_time = time.time()
+
+    try:
+        with count_queries(run):
+            yield run
+    finally:
+        run.duration_seconds = time.time() - start_time
+        _active_runs.stack.pop()
+
+        for sink in sinks:
+            sink.record(run)
+
+
+def load_metrics_sinks():
+    """
+    The sinks for a checker run; the run history is always kept.
+    """
+    sink_class_load_paths = getattr(settings, 'NARRATIVE_METRICS_SINKS', ['narrative.metrics.LoggingMetricsSink'])
+
+    return [PeriodicalRunHistorySink()] + [load_class(class_load_path)() for class_load_path in sink_class_load_paths]
+
+
+class MetricsSink(object):
+    """
+    Receives the metrics of each run; flush is called once all of the
+    periodicals of a check_assertions or detect_events run are done.
+    """
+    def record(self, run):
+        pass
+
+    def flush(self):
+        pass
+
+
+class PeriodicalRunHistorySink(MetricsSink):
+    """
+    Stores the runs as PeriodicalRuns with one bulk insert, and deletes the
+    runs that are past the retention period.
+    """
+    def __init__(self):
+        self.periodical_runs = []
+
+    def record(self, run):
+        self.periodical_runs.append(run.build_periodical_run())
+
+    def flush(self):
+        PeriodicalRun.objects.bulk_create(self.periodical_runs)
+        self.periodical_runs = []
+
+        PeriodicalRun.objects.clear_expired(
+            getattr(settings, 'NARRATIVE_PERIODICAL_RUN_TTL', datetime.timedelta(days=30)))
+
+
+def get_periodical_costs(since=None):
+    """
+    The duration statistics of each periodical that ran since then, most
+    costly, by total time spent running, first.  Each is a dict with the
+    meta, the number of runs, their total and mean duration, and the 50th,
+    95th and 99th percentiles of their durations.
+    """
+    if since is None:
+        since = datetime.datetime.utcnow() - getattr(
+            settings, 'NARRATIVE_PERIODICAL_RUN_WINDOW', datetime.timedelta(days=7))
+
+    duration_stats = PeriodicalRun.objects.get_duration_percentiles(since)
+
+    # Load the metas of each type in one query
+    meta_ids_by_type = {}
+
+    for meta_type_id, meta_id in duration_stats:
+        meta_ids_by_type.setdefault(meta_type_id, []).append(meta_id)
+
+    metas = {}
+
+    for meta_type_id, meta_ids in meta_ids_by_type.items():
+        meta_class = ContentType.objects.get_for_id(meta_type_id).model_class()
+
+        for meta_id, meta in meta_class.objects.in_bulk(meta_ids).items():
+            metas[(meta_type_id, meta_id)] = meta
+
+    costs = [
+        {
+            'meta': metas.get(meta_key),
+            'run_count': stats['run_count'],
+            'total_seconds': stats['total_seconds'],
+            'mean_seconds': stats['total_seconds'] / stats['run_count'],
+            'p50_seconds': stats[50],
+            'p95_seconds': stats[95],
+            'p99_seconds': stats[99],
+        }
+        for meta_key, stats in duration_stats.items()
+    ]
+
+    return sorted(costs, key=lambda cost: cost['total_seconds'], reverse=True)
+
+
+class LoggingMetricsSink(MetricsSink):
+    """
+    Logs each run as a line of json to the narrative.metrics logger.
+    """
+    logger = logging.getLogger('narrative.metrics')
+
+    def record(self, run):
+        self.logger.info(json.dumps(run.as_dict(), sort_keys=True))
+
+
+def slugify_metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]+', '_', name).strip('_').lower()
+
+
+class StatsdMetricsSink(MetricsSink):
+    """
+    Sends each run to a statsd compatible daemon over UDP, as
+    <prefix>.<kind>.<name>.<metric>; the duration as a timer in
+    milliseconds and everything else as counters.
+    """
+    def __init__(self):
+        self.address = getattr(settings, 'NARRATIVE_STATSD_ADDRESS', ('localhost', 8125))
+        self.prefix = getattr(settings, 'NARRATIVE_STATSD_PREFIX', 'narrative')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def build_packet(self, run):
+        metric_prefix = '.'.join([self.prefix, run.kind, slugify_metric_name(run.name)])
+        lines = [
+            '{0}.duration:{1}|ms'.format(metric_prefix, int(run.duration_seconds * 1000)),
+            '{0}.queries:{1}|c'.format(metric_prefix, run.query_count),
+        ]
+        lines.extend(
+            '{0}.{1}:{2}|c'.format(metric_prefix, counter_name, run.counters[counter_name])
+            for counter_name in COUNTER_NAMES)
+
+        return '\n'.join(lines).encode('utf-8')
+
+    def record(self, run):
+        try:
+            self.socket.sendto(self.build_packet(run), self.address)
+        except socket.error:
+            # Metrics are best effort; a missing daemon must not break the checks
+            pass
+
+    def flush(self):
+        self.socket.close()
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusTextfileMetricsSink(MetricsSink):
+    """
+    Writes the metrics of the latest run of each periodical to
+    narrative_<kind>.prom in the textfile directory, for the node
+    exporter's textfile collector to pick up.  The file is replaced in
+    one go, so the collector never reads a partial one; the periodicals
+    that were not run this time keep the values of their latest stored
+    PeriodicalRun.  Each series is labelled with the meta id as well as
+    the name, as names need not be unique.
+    """
+    def __init__(self):
+        self.directory = settings.NARRATIVE_PROMETHEUS_TEXTFILE_DIRECTORY
+        self.runs = []
+
+    def record(self, run):
+        self.runs.append(run)
+
+    def build_textfile(self, runs):
+        metric_values = [
+            ('duration_seconds', lambda run: run.duration_seconds),
+            ('query_count', lambda run: run.query_count),
+            ('last_run_timestamp_seconds', lambda run: (run.started - datetime.datetime(1970, 1, 1)).total_seconds()),
+        ] + [
+            (counter_name, lambda run, counter_name=counter_name: run.counters[counter_name])
+            for counter_name in COUNTER_NAMES
+        ]
+        lines = []
+
+        for metric_name, get_value in metric_values:
+            lines.append('# TYPE narrative_periodical_{0} gauge'.format(metric_name))
+            lines.extend(
+                'narrative_periodical_{0}{{meta_id="{1}",name="{2}"}} {3}'.format(
+                    metric_name, run.periodical_meta.id, escape_label_value(run.name), get_value(run))
+                for run in runs)
+
+        return '\n'.join(lines) + '\n'
+
+    def get_latest_runs(self, runs):
+        """
+        The latest run of every periodical of the kind of these runs, in
+        meta id order; those that are not among them are read back from
+        their PeriodicalRuns.
+        """
+        meta_class = type(runs[0].periodical_meta)
+        stored_runs = PeriodicalRun.objects.get_latest_runs(meta_class)
+
+        # Periodicals deleted since they ran are left out
+        latest_runs = dict(
+            (meta.id, PeriodicalRunMetrics.from_periodical_run(stored_runs[meta.id], meta))
+            for meta in meta_class.objects.filter(id__in=list(stored_runs)))
+
+        for run in runs:
+            latest_runs[run.periodical_meta.id] = run
+
+        return [latest_runs[meta_id] for meta_id in sorted(latest_runs)]
+
+    def flush(self):
+        runs_by_kind = {}
+
+        for run in self.runs:
+            runs_by_kind.setdefault(run.kind, []).append(run)
+
+        for kind, runs in runs_by_kind.items():
+            path = os.path.join(self.directory, 'narrative_{0}.prom'.format(kind))
+
+            with open(path + '.tmp', 'w') as textfile:
+                textfile.write(self.build_textfile(self.get_latest_runs(runs)))
+
+            os.rename(path + '.tmp', path)
+
+        self.runs = []
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import datetime
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SolutionJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('executor_class_load_path', models.CharField(max_length=96)),
+                ('status', models.IntegerField(default=0, db_index=True, choices=[(0, 'Pending'), (1, 'Running'), (2, 'Succeeded'), (3, 'Failed')])),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=3)),
+                ('next_attempt', models.DateTimeField(default=datetime.datetime.utcnow, db_index=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True, blank=True)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('error_traceback', models.TextField(null=True, blank=True)),
+                ('solution', models.ForeignKey(to='narrative.Solution')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0002_solutionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resolutionstep',
+            name='diagnosis_timings_json',
+            field=models.TextField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import models, migrations
+
+from narrative.plans import get_operation_signature
+
+
+def set_operation_signatures(apps, schema_editor):
+    Solution = apps.get_model('narrative', 'Solution')
+
+    for solution in Solution.objects.only('id', 'plan_json').iterator():
+        Solution.objects.filter(id=solution.id).update(
+            operation_signature=get_operation_signature(json.loads(solution.plan_json or '[]')))
+
+
+def clear_operation_signatures(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0003_resolutionstep_diagnosis_timings_json'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='solution',
+            name='operation_signature',
+            field=models.CharField(default='', max_length=40, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(set_operation_signatures, clear_operation_signatures),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+from narrative.models import ResolutionStepActionType
+
+
+def count_non_pass_steps(apps, schema_editor):
+    Issue = apps.get_model('narrative', 'Issue')
+    ResolutionStep = apps.get_model('narrative', 'ResolutionStep')
+
+    step_counts = ResolutionStep.objects.exclude(
+        action_type=ResolutionStepActionType.PASS).values('issue').annotate(step_count=models.Count('id'))
+
+    for step_count in step_counts:
+        Issue.objects.filter(id=step_count['issue']).update(non_pass_step_count=step_count['step_count'])
+
+
+def clear_non_pass_step_counts(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0004_solution_operation_signature'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='issue',
+            name='non_pass_step_count',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.RunPython(count_non_pass_steps, clear_non_pass_step_counts),
+    ]
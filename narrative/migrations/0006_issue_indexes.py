@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Backends that can index just the rows matching a condition; on the others, the
+# index on (failed_assertion, status) serves the same lookups
+PARTIAL_INDEX_VENDORS = ('postgresql', 'sqlite')
+
+
+def create_current_issue_index(apps, schema_editor):
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        # Only the issues that are OPEN, SOLUTION_APPLIED or IMPASSE
+        schema_editor.execute(
+            'CREATE INDEX narrative_issue_current ON narrative_issue (failed_assertion_id) '
+            'WHERE status IN (0, 1, 2)')
+
+
+def drop_current_issue_index(apps, schema_editor):
+    if schema_editor.connection.vendor in PARTIAL_INDEX_VENDORS:
+        schema_editor.execute('DROP INDEX narrative_issue_current')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0005_issue_non_pass_step_count'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='issue',
+            index_together=set([('failed_assertion', 'status')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='modelissue',
+            index_together=set([('model_type', 'model_id')]),
+        ),
+        migrations.RunPython(create_current_issue_index, drop_current_issue_index),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0006_issue_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assertionmeta',
+            name='record_watermark',
+            field=models.PositiveIntegerField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
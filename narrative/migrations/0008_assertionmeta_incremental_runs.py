@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0007_assertionmeta_record_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assertionmeta',
+            name='last_complete_run',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='assertionmeta',
+            name='last_full_sweep',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
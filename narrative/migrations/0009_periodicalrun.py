@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0001_initial'),
+        ('narrative', '0008_assertionmeta_incremental_runs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeriodicalRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('meta_id', models.PositiveIntegerField()),
+                ('started', models.DateTimeField(db_index=True)),
+                ('duration_seconds', models.FloatField()),
+                ('succeeded', models.NullBooleanField(default=None)),
+                ('query_count', models.PositiveIntegerField(default=0)),
+                ('records_checked', models.PositiveIntegerField(default=0)),
+                ('issues_opened', models.PositiveIntegerField(default=0)),
+                ('issues_resolved', models.PositiveIntegerField(default=0)),
+                ('emails_sent', models.PositiveIntegerField(default=0)),
+                ('meta_type', models.ForeignKey(to='contenttypes.ContentType')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterIndexTogether(
+            name='periodicalrun',
+            index_together=set([('meta_type', 'meta_id', 'started')]),
+        ),
+    ]
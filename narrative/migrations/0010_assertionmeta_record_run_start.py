@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0009_periodicalrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assertionmeta',
+            name='record_run_start',
+            field=models.DateTimeField(default=None, null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0010_assertionmeta_record_run_start'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='periodicalrun',
+            name='notifications_deferred',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
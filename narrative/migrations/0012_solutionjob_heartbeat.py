@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('narrative', '0011_periodicalrun_notifications_deferred'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='solutionjob',
+            name='heartbeat',
+            field=models.DateTimeField(null=True, blank=True),
+            preserve_default=True,
+        ),
+    ]
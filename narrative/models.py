@@ -1,14 +1,20 @@
+from collections import defaultdict
 import datetime
 import json
+import math
 import uuid
 
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
-from django.db import models
+from django.db import connection, models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from manager_utils import ManagerUtilsManager
 from pytz import utc as utc_tz
 import six
 
+from .plans import get_operation_signature, is_step_group
+
 
 def find_tuple(tuple_list, key, which):
     filtered_list = [tple for tple in tuple_list if tple[which] == key]
@@ -87,6 +93,31 @@ class IssueStatusType(StatusType):
         (WONT_FIX, 'Wont Fix'),
     )
 
+    # The statuses of issues that are still being worked on; listed
+    # positively so that lookups can use the indexes on status
+    current_statuses = (OPEN, SOLUTION_APPLIED, IMPASSE)
+
+
+class SolutionJobStatusType(StatusType):
+    # Waiting for a worker, possibly to retry after a failure
+    PENDING = 0
+
+    # Claimed by a worker
+    RUNNING = 1
+
+    # The plan ran to completion
+    SUCCEEDED = 2
+
+    # The plan failed on every attempt
+    FAILED = 3
+
+    types = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
 
 class ResolutionStepActionType(StatusType):
     EXEC = 0    # Perform some actions
@@ -206,6 +237,27 @@ def log_datum(*args, **kwargs):
     return datum
 
 
+def load_class(class_load_path):
+    """
+    Imports and returns the class at the python import path class_load_path.
+    """
+    class_path = '.'.join(class_load_path.split('.')[:-1])
+    class_name = class_load_path.split('.')[-1]
+    class_file_name = class_load_path.split('.')[-2]
+
+    try:
+        class_module = __import__(class_path, globals(), locals(), [class_file_name])
+        if not class_module or not hasattr(class_module, class_name):
+            return None
+
+        loaded_class = getattr(class_module, class_name)
+        if not loaded_class:
+            return None
+        return loaded_class
+    except ImportError:
+        return None
+
+
 @six.python_2_unicode_compatible
 class PeriodicalMeta(models.Model):
     """
@@ -260,34 +312,144 @@ class PeriodicalMeta(models.Model):
         """
         Imports and returns the Periodic module.
         """
-        class_path = '.'.join(self.class_load_path.split('.')[:-1])
-        class_name = self.class_load_path.split('.')[-1]
-        class_file_name = self.class_load_path.split('.')[-2]
-
-        try:
-            class_module = __import__(class_path, globals(), locals(), [class_file_name])
-            if not class_module or not hasattr(class_module, class_name):
-                return None
-
-            loaded_class = getattr(class_module, class_name)
-            if not loaded_class:
-                return None
-            return loaded_class
-        except ImportError:
-            return None
+        return load_class(self.class_load_path)
 
     def __str__(self):
         return '{0}::{1}'.format(self.display_name, self.class_load_path)
 
 
 class AssertionMeta(PeriodicalMeta):
-    pass
+    # Primary key of the last record a model assertion finished checking,
+    # while a run over its queryset is in progress, and when that run started
+    record_watermark = models.PositiveIntegerField(null=True, blank=True, default=None)
+    record_run_start = models.DateTimeField(null=True, blank=True, default=None)
+
+    # When the last finished run of an incremental model assertion, and the
+    # last one that checked all of the records, started
+    last_complete_run = models.DateTimeField(null=True, blank=True, default=None)
+    last_full_sweep = models.DateTimeField(null=True, blank=True, default=None)
 
 
 class EventMeta(PeriodicalMeta):
     pass
 
 
+class PeriodicalRunManager(models.Manager):
+    def clear_expired(self, ttl):
+        """
+        Delete the runs that started more than ttl ago, returning how many there were.
+        """
+        expired_set = self.filter(started__lt=datetime.datetime.utcnow() - ttl)
+        expired_count = expired_set.count()
+
+        expired_set.delete()
+
+        return expired_count
+
+    def get_latest_runs(self, meta_model):
+        """
+        The latest run of each periodical of the meta model, keyed by meta id.
+        """
+        runs = self.filter(meta_type=ContentType.objects.get_for_model(meta_model))
+        latest_starts = dict(
+            runs.values('meta_id').annotate(latest_started=models.Max('started')).order_by().values_list(
+                'meta_id', 'latest_started'))
+        latest_runs = {}
+
+        for run in runs.filter(started__in=set(latest_starts.values())).order_by('id'):
+            if run.started == latest_starts[run.meta_id]:
+                latest_runs[run.meta_id] = run
+
+        return latest_runs
+
+    def get_duration_percentiles(self, since, percentiles=(50, 95, 99)):
+        """
+        The number of runs, their total duration and the nearest rank
+        percentiles of their durations for each periodical run since then,
+        keyed by (meta_type_id, meta_id).  The database does the sorting;
+        PostgreSQL 9.4 and later compute everything in one query with
+        percentile_disc, other databases pick each percentile with an
+        offset query.
+        """
+        if connection.vendor == 'postgresql' and connection.pg_version >= 90400:
+            return self.get_duration_percentiles_with_percentile_disc(since, percentiles)
+
+        runs = self.filter(started__gte=since)
+        duration_stats = {}
+
+        for group in runs.values('meta_type_id', 'meta_id').annotate(
+                run_count=models.Count('id'), total_seconds=models.Sum('duration_seconds')).order_by():
+            group_runs = runs.filter(meta_type_id=group['meta_type_id'], meta_id=group['meta_id']).order_by(
+                'duration_seconds').values_list('duration_seconds', flat=True)
+
+            stats = {'run_count': group['run_count'], 'total_seconds': group['total_seconds']}
+
+            for percentile in percentiles:
+                rank = int(math.ceil(percentile / 100.0 * group['run_count']))
+                stats[percentile] = group_runs[max(rank, 1) - 1]
+
+            duration_stats[(group['meta_type_id'], group['meta_id'])] = stats
+
+        return duration_stats
+
+    def get_duration_percentiles_with_percentile_disc(self, since, percentiles):
+        percentile_columns = ', '.join(
+            'percentile_disc(%s) WITHIN GROUP (ORDER BY duration_seconds)' for percentile in percentiles)
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT meta_type_id, meta_id, COUNT(*), SUM(duration_seconds), {0} FROM {1} '
+            'WHERE started >= %s GROUP BY meta_type_id, meta_id'.format(percentile_columns, self.model._meta.db_table),
+            [percentile / 100.0 for percentile in percentiles] + [since])
+
+        duration_stats = {}
+
+        for row in cursor.fetchall():
+            stats = {'run_count': row[2], 'total_seconds': row[3]}
+            stats.update(zip(percentiles, row[4:]))
+
+            duration_stats[(row[0], row[1])] = stats
+
+        return duration_stats
+
+
+@six.python_2_unicode_compatible
+class PeriodicalRun(models.Model):
+    """
+    What one run of an assertion or event cost and did; see narrative.metrics.
+    """
+    class Meta:
+        index_together = (('meta_type', 'meta_id', 'started'),)
+
+    objects = PeriodicalRunManager()
+
+    # The AssertionMeta or EventMeta that was run
+    meta_type = models.ForeignKey(ContentType)
+    meta_id = models.PositiveIntegerField()
+    meta = generic.GenericForeignKey('meta_type', 'meta_id')
+
+    started = models.DateTimeField(db_index=True)
+    duration_seconds = models.FloatField()
+
+    # Whether the assertion passed or the event was detected; None if the run raised
+    succeeded = models.NullBooleanField(default=None)
+
+    # Queries made on the connection of the checking thread
+    query_count = models.PositiveIntegerField(default=0)
+
+    records_checked = models.PositiveIntegerField(default=0)
+    issues_opened = models.PositiveIntegerField(default=0)
+    issues_resolved = models.PositiveIntegerField(default=0)
+
+    emails_sent = models.PositiveIntegerField(default=0)
+
+    # Admin notifications added to the digest, which is sent once the run is done
+    notifications_deferred = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return 'PeriodicalRun - {0}:{1} started:{2} duration:{3:.3f}s'.format(
+            self.meta_type_id, self.meta_id, self.started, self.duration_seconds)
+
+
 @six.python_2_unicode_compatible
 class Solution(models.Model):
     def __init__(self, *args, **kwargs):
@@ -305,6 +467,9 @@ class Solution(models.Model):
     # The steps (stored as json) for this solution
     plan_json = models.TextField()
 
+    # Digest of the set of actions in the plan, for matching plans in the database; kept up to date by save
+    operation_signature = models.CharField(max_length=40, db_index=True, default='')
+
     # Time in which the solution was enacted
     enacted = models.DateTimeField(null=True, blank=True)
 
@@ -320,14 +485,21 @@ class Solution(models.Model):
     def set_plan(self, plan):
         self.plan_json = json.dumps(plan)
 
+    def save(self, *args, **kwargs):
+        self.operation_signature = get_operation_signature(self.get_plan())
+
+        super(Solution, self).save(*args, **kwargs)
+
     def __str__(self):
         return 'Solution - Diagnostic case name: {0}, description: {1}'.format(
             self.diagnostic_case_name, self.problem_description)
 
     def explain(self, tabs=''):
-        # Aggregate all of the plan steps into a nice human readable format
+        # Aggregate all of the plan steps into a nice human readable format;
+        # the steps of a group are listed together
         plan_explanation = [
-            step[0] for step in self.get_plan()
+            ' | '.join(step[0] for step in item) if is_step_group(item) else item[0]
+            for item in self.get_plan()
         ]
 
         step_separator = ('\n{0}    '.format(tabs))
@@ -347,12 +519,65 @@ class Solution(models.Model):
         return separator.join(explanation)
 
 
+@six.python_2_unicode_compatible
+class SolutionJob(models.Model):
+    """
+    A validated solution waiting to be executed by the solution job
+    workers (see narrative.jobs) rather than inline by its assertion.
+    """
+    solution = models.ForeignKey(Solution)
+
+    # Python import path to the Executor class that runs the plan
+    executor_class_load_path = models.CharField(max_length=96)
+
+    status = models.IntegerField(
+        choices=SolutionJobStatusType.types, default=SolutionJobStatusType.PENDING, db_index=True)
+
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+
+    # The job is not picked up again before this time
+    next_attempt = models.DateTimeField(default=datetime.datetime.utcnow, db_index=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    # Last time the worker running the plan of the latest attempt marked it as alive
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    # Exception traceback of the last failed attempt
+    error_traceback = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return 'SolutionJob - {0} ({1}, attempt {2} of {3})'.format(
+            self.solution, SolutionJobStatusType.status_by_id(self.status), self.attempts, self.max_attempts)
+
+
 class IssueManager(models.Manager):
     @property
     def current_issues(self):
-        resolved_list = [IssueStatusType.RESOLVED, IssueStatusType.WONT_FIX]
+        return self.filter(status__in=IssueStatusType.current_statuses)
+
+    def recount_non_pass_steps(self, issues=None):
+        """
+        Recompute the non pass step count of the issues (all of them by
+        default) from their resolution steps; this is needed after steps are
+        created or changed in bulk, which the counts do not follow.
+        """
+        issues = self.all() if issues is None else issues
+        issue_ids_by_count = defaultdict(list)
+
+        step_counts = ResolutionStep.objects.filter(issue__in=issues).exclude(
+            action_type=ResolutionStepActionType.PASS).values('issue').annotate(step_count=models.Count('id'))
 
-        return self.exclude(status__in=resolved_list)
+        for step_count in step_counts:
+            issue_ids_by_count[step_count['step_count']].append(step_count['issue'])
+
+        issues.update(non_pass_step_count=0)
+
+        for step_count, issue_ids in issue_ids_by_count.items():
+            self.filter(id__in=issue_ids).update(non_pass_step_count=step_count)
 
 
 @six.python_2_unicode_compatible
@@ -361,6 +586,9 @@ class Issue(models.Model):
     Assertions can find problems in the system; these
     problems are represented using issues.
     """
+    class Meta:
+        index_together = (('failed_assertion', 'status'),)
+
     # Which failing assertion generated this Issue
     failed_assertion = models.ForeignKey(AssertionMeta)
 
@@ -370,17 +598,44 @@ class Issue(models.Model):
     created_timestamp = models.DateTimeField(auto_now_add=True)
     resolved_timestamp = models.DateTimeField(null=True, blank=True)
 
+    # How many of the resolution steps are not PASSes; kept up to date by ResolutionStep.save and
+    # delete (including queryset deletes), but not by bulk_create or queryset updates of resolution
+    # steps, after which IssueManager.recount_non_pass_steps has to be called
+    non_pass_step_count = models.PositiveIntegerField(default=0)
+
     objects = IssueManager()
 
     def __str__(self):
         return 'Issue - {0} ({1})'.format(
             self.failed_assertion.display_name, IssueStatusType.status_by_id(self.status))
 
-    def explain(self, tabs=''):
+    def save(self, *args, **kwargs):
+        """
+        The non pass step count is only changed by relative updates, so
+        saving a stored issue leaves it alone rather than writing back a
+        count that may have gone stale since the issue was loaded.
+        """
+        if not self._state.adding and not args and kwargs.get('update_fields') is None and not kwargs.get(
+                'force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'non_pass_step_count'
+            ]
+
+        super(Issue, self).save(*args, **kwargs)
+
+    def explain(self, tabs='', resolution_steps=None):
+        """
+        Return a human readable summary of the issue; resolution_steps, in
+        the order they were created, can be passed in if already loaded.
+        """
+        if resolution_steps is None:
+            resolution_steps = self.resolutionstep_set.order_by('created').select_related('solution')
+
         step_separator = '    ' + '-' * 15
         resolution_separator = '\n{0}\n{1}    '.format(step_separator, tabs)
         resolution_steps = resolution_separator + resolution_separator.join(
-            [step.explain(tabs + '    ') for step in self.resolutionstep_set.order_by('created')])
+            [step.explain(tabs + '    ') for step in resolution_steps])
 
         explanation = [
             'Failed Assertion: {0}'.format(self.failed_assertion.display_name),
@@ -392,6 +647,27 @@ class Issue(models.Model):
 
         return '\n'.join(explanation)
 
+    @classmethod
+    def explain_many(cls, issues, tabs=''):
+        """
+        Explain each of the issues, loading their assertions and resolution
+        steps in bulk rather than per issue.
+        """
+        issues = list(issues)
+
+        failed_assertions = AssertionMeta.objects.in_bulk(set(issue.failed_assertion_id for issue in issues))
+
+        resolution_steps = dict((issue.id, []) for issue in issues)
+
+        for step in ResolutionStep.objects.filter(issue__in=resolution_steps).select_related(
+                'solution').order_by('issue', 'created'):
+            resolution_steps[step.issue_id].append(step)
+
+        for issue in issues:
+            issue.failed_assertion = failed_assertions[issue.failed_assertion_id]
+
+        return [issue.explain(tabs, resolution_steps[issue.id]) for issue in issues]
+
     def steps_matching_plan(self, plan):
         """
         Given an Issue, return the ResolutionStep where the solution applied
@@ -399,30 +675,15 @@ class Issue(models.Model):
 
         The match is in terms of matching operations; not neccesarily the arguments passed.
         """
-        def get_step_operations(plan):
-            return set([step[0] for step in plan])
-
-        target_steps = get_step_operations(plan)
-
-        matching_steps = []
-
-        for step in self.resolutionstep_set.all():
-            if step.solution:
-                if get_step_operations(step.solution.get_plan()) == target_steps:
-                    matching_steps.append(step)
-
-        return matching_steps
+        return list(self.resolutionstep_set.filter(
+            solution__operation_signature=get_operation_signature(plan)).select_related('solution'))
 
     def get_non_pass_steps(self):
         """
         Return all steps that are not PASSes.
         """
-        return [
-            isr
-            for isr
-            in self.resolutionstep_set.order_by('created')
-            if isr.action_type != ResolutionStepActionType.PASS
-        ]
+        return list(self.resolutionstep_set.exclude(
+            action_type=ResolutionStepActionType.PASS).order_by('created'))
 
     @property
     def age(self):
@@ -449,10 +710,40 @@ class ResolutionStep(models.Model):
     # The reason this step was selected; just human readable documentation
     reason = models.CharField(max_length=64, default=None, null=True, blank=True)
 
+    # Seconds each diagnostic case took in a parallel diagnosis (stored as json);
+    # cases that timed out have None
+    diagnosis_timings_json = models.TextField(null=True, blank=True, default=None)
+
+    def __init__(self, *args, **kwargs):
+        super(ResolutionStep, self).__init__(*args, **kwargs)
+
+        # The action type as stored, so save can tell how the issue's non pass step count changes
+        self._stored_action_type = self.action_type if self.pk else None
+
     def __str__(self):
         return 'Action: {0}, Solution: {1}'.format(
             ResolutionStepActionType.status_by_id(self.action_type), self.solution)
 
+    def save(self, *args, **kwargs):
+        super(ResolutionStep, self).save(*args, **kwargs)
+
+        was_non_pass = self._stored_action_type not in (None, ResolutionStepActionType.PASS)
+        is_non_pass = self.action_type != ResolutionStepActionType.PASS
+
+        if is_non_pass != was_non_pass:
+            adjust_non_pass_step_count(self, 1 if is_non_pass else -1)
+
+        self._stored_action_type = self.action_type
+
+    def get_diagnosis_timings(self):
+        if self.diagnosis_timings_json:
+            return json.loads(self.diagnosis_timings_json)
+        else:
+            return {}
+
+    def set_diagnosis_timings(self, diagnosis_timings):
+        self.diagnosis_timings_json = json.dumps(diagnosis_timings)
+
     def explain(self, tabs=''):
         if self.solution:
             solution_explanation = self.solution.explain(tabs + '    ')
@@ -470,12 +761,28 @@ class ResolutionStep(models.Model):
         return separator.join(explanation)
 
 
-class ModelIssueManager(models.Manager):
-    @property
-    def current_issues(self):
-        resolved_list = [IssueStatusType.RESOLVED, IssueStatusType.WONT_FIX]
+def adjust_non_pass_step_count(resolution_step, delta):
+    """
+    Adjust the non pass step count of the step's issue in the database, and
+    on the issue object the step was created with, if it has one.
+    """
+    Issue.objects.filter(id=resolution_step.issue_id).update(
+        non_pass_step_count=models.F('non_pass_step_count') + delta)
 
-        return self.exclude(status__in=resolved_list)
+    issue = getattr(resolution_step, ResolutionStep._meta.get_field('issue').get_cache_name(), None)
+
+    if issue is not None:
+        issue.non_pass_step_count += delta
+
+
+@receiver(post_delete, sender=ResolutionStep)
+def resolution_step_deleted(sender, instance, **kwargs):
+    if instance._stored_action_type not in (None, ResolutionStepActionType.PASS):
+        adjust_non_pass_step_count(instance, -1)
+
+
+class ModelIssueManager(IssueManager):
+    pass
 
 
 class ModelIssue(Issue):
@@ -483,6 +790,9 @@ class ModelIssue(Issue):
     Model assertions may find issues with particular models.
     This is used to track such an issue.
     """
+    class Meta:
+        index_together = (('model_type', 'model_id'),)
+
     model_type = models.ForeignKey(ContentType)
     model_id = models.PositiveIntegerField()
     model = generic.GenericForeignKey('model_type', 'model_id')
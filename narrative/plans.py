@@ -0,0 +1,50 @@
+"""
+Helpers for working with solution plans.
+
+A plan is a list of steps, each an (action, kwargs) pair, executed in
+order.  In place of a step, a plan may have a step group: a list of
+steps that do not depend on each other, which the Executor runs
+concurrently before moving on to the next item of the plan.
+
+    [
+        ('ping', {'host': 'a'}),
+        [('email', {...}), ('email', {...})],
+    ]
+"""
+import hashlib
+
+import six
+
+
+def is_step_group(item):
+    """
+    Determine if a plan item is a step group rather than a single step.
+    """
+    return len(item) > 0 and not isinstance(item[0], six.string_types)
+
+
+def iter_plan_steps(plan):
+    """
+    Iterate over every step of the plan, including those inside step groups.
+    """
+    for item in plan:
+        if is_step_group(item):
+            for step in item:
+                yield step
+        else:
+            yield item
+
+
+def get_plan_actions(plan):
+    """
+    Return the set of actions used anywhere in the plan.
+    """
+    return set(step[0] for step in iter_plan_steps(plan))
+
+
+def get_operation_signature(plan):
+    """
+    Return a short digest of the set of actions used in the plan; two plans
+    have the same signature exactly when they use the same actions.
+    """
+    return hashlib.sha1(','.join(sorted(get_plan_actions(plan))).encode('utf-8')).hexdigest()
@@ -1,13 +1,19 @@
 import datetime
 import json
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.core import mail
-from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from mock import patch
 
-from ..assertions import Assertion
-from ..executor import Executor
+from ..assertions import diagnosis_pool, diagnostic_priority, Assertion, DiagnosisStrategy
+from ..executor import admin_recipient_cache, collect_notifications, Executor
 from ..models import (Solution, AssertionMeta, Issue, ResolutionStep,
                       IssueStatusType, ResolutionStepActionType)
 
@@ -82,6 +88,44 @@ class AssertionTests(TestCase):
             set(['diagnostic_case_test_1', 'diagnostic_case_test_2']),
             'Diagnostic methods not returned as expected')
 
+    def test_diagnostic_cases_cached_per_class(self):
+        """
+        Verify that the diagnostic cases are only discovered once per class,
+        and rediscovered when one is added.
+        """
+        class CachedAssertion(Assertion):
+            def check(self):
+                pass
+
+            def diagnostic_case_b(self, *args, **kwargs):
+                pass
+
+            @diagnostic_priority(10)
+            def diagnostic_case_c(self, *args, **kwargs):
+                pass
+
+            def diagnostic_case_a(self, *args, **kwargs):
+                pass
+
+        assertion = CachedAssertion(self.assertion_meta)
+
+        self.assertEqual(
+            ('diagnostic_case_c', 'diagnostic_case_a', 'diagnostic_case_b'), assertion.diagnostic_cases,
+            'Verifying the cases are ordered by priority, then name')
+        self.assertIs(assertion.diagnostic_cases, CachedAssertion(self.assertion_meta).diagnostic_cases)
+
+        CachedAssertion.diagnostic_case_d = lambda self, *args, **kwargs: None
+
+        self.assertEqual(
+            ('diagnostic_case_c', 'diagnostic_case_a', 'diagnostic_case_b', 'diagnostic_case_d'),
+            assertion.diagnostic_cases)
+
+        # Cases attached to an instance are only seen by that instance
+        assertion.diagnostic_case_e = lambda *args, **kwargs: None
+
+        self.assertEqual(5, len(assertion.diagnostic_cases))
+        self.assertEqual(4, len(CachedAssertion(self.assertion_meta).diagnostic_cases))
+
     def test_validate_solution(self):
         """
         Verify that a valid solution can be validated,
@@ -320,6 +364,212 @@ class Test_diagnose(TestCase):
         self.assertTrue(
             self.deferred_multiple_solutions, 'Verifies that the admins were contacted about the multiple solutions')
 
+    def test_diagnose_first_match(self):
+        """
+        Verify that with the FIRST_MATCH strategy, the cases after the first
+        match are skipped, so multiple matches are not an impasse.
+        """
+        self.assertion.diagnosis_strategy = DiagnosisStrategy.FIRST_MATCH
+
+        self.mock_resolution_step_1 = ResolutionStep.objects.create(
+            issue=self.issue, action_type=ResolutionStepActionType.PASS)
+        self.mock_resolution_step_2 = ResolutionStep.objects.create(
+            issue=self.issue, action_type=ResolutionStepActionType.PASS)
+
+        self.assertion.diagnose(**{'current_issue': self.issue})
+
+        self.assertTrue(self.diagnostic_case_test_1_called, 'The first case should have been run')
+        self.assertFalse(self.diagnostic_case_test_2_called, 'The case after the match should have been skipped')
+        self.assertFalse(self.deferred_multiple_solutions, 'There should not be an impasse')
+        self.assertEqual(IssueStatusType.SOLUTION_APPLIED, Issue.objects.get(id=self.issue.id).status)
+
+    def test_diagnose_first_match_without_match(self):
+        self.assertion.diagnosis_strategy = DiagnosisStrategy.FIRST_MATCH
+
+        self.assertion.diagnose(**{'current_issue': self.issue})
+
+        self.assertTrue(self.diagnostic_case_test_1_called)
+        self.assertTrue(self.diagnostic_case_test_2_called)
+        self.assertTrue(self.defer_to_admins_called, 'Admins should have been notified')
+
+
+class Test_parallel_diagnose(TransactionTestCase):
+    """
+    The diagnosis_pool threads only see committed records, so these tests
+    cannot run in a transaction.
+    """
+    def setUp(self):
+        # The flush at teardown recreates the permissions; content types cached by earlier tests are stale by then
+        ContentType.objects.clear_cache()
+
+        class SlowAssertion(Assertion):
+            parallel_diagnosis = True
+            diagnostic_case_timeout = 0.5
+
+            def check(self_):
+                pass
+
+            def diagnostic_case_found(self_, current_issue, *args, **kwargs):
+                time.sleep(0.2)
+                return ResolutionStep(issue=current_issue, action_type=ResolutionStepActionType.PASS)
+
+            def diagnostic_case_nothing(self_, current_issue, *args, **kwargs):
+                time.sleep(0.2)
+
+            def diagnostic_case_hung(self_, current_issue, *args, **kwargs):
+                for i in range(40):
+                    if self_.is_diagnosis_cancelled():
+                        self.hung_case_cancelled.set()
+                        return None
+
+                    time.sleep(0.05)
+
+                return ResolutionStep(issue=current_issue, action_type=ResolutionStepActionType.PASS)
+
+        self.hung_case_cancelled = threading.Event()
+
+        self.assertion_meta = AssertionMeta.objects.create(
+            display_name='Mock assertion', class_load_path='foo.bar', enabled=True)
+
+        self.assertion = SlowAssertion(self.assertion_meta)
+
+        self.issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+
+    def tearDown(self):
+        ContentType.objects.clear_cache()
+
+    def test_parallel_diagnose(self):
+        """
+        Verify that the cases run concurrently, that a case past the timeout
+        counts as finding nothing, and that the timings are recorded.
+        """
+        start_time = time.time()
+
+        self.assertion.diagnose(current_issue=self.issue)
+
+        self.assertLess(time.time() - start_time, 1, 'Verifying the cases ran concurrently')
+
+        self.assertEqual(
+            IssueStatusType.SOLUTION_APPLIED, Issue.objects.get(id=self.issue.id).status,
+            'Verifying the hung case did not cause an impasse')
+
+        resolution_step = ResolutionStep.objects.get(issue=self.issue)
+        diagnosis_timings = resolution_step.get_diagnosis_timings()
+
+        self.assertEqual(
+            set(['diagnostic_case_found', 'diagnostic_case_nothing', 'diagnostic_case_hung']),
+            set(diagnosis_timings))
+        self.assertGreaterEqual(diagnosis_timings['diagnostic_case_found'], 0.2)
+        self.assertIsNone(diagnosis_timings['diagnostic_case_hung'])
+
+        self.assertTrue(self.hung_case_cancelled.wait(1), 'Verifying the hung case was told to stop')
+
+    def test_parallel_diagnose_first_match(self):
+        """
+        Verify that the first match in case order is taken without waiting for the cases after it.
+        """
+        self.assertion.diagnosis_strategy = DiagnosisStrategy.FIRST_MATCH
+        self.assertion.diagnostic_case_timeout = None
+
+        start_time = time.time()
+
+        self.assertion.diagnose(current_issue=self.issue)
+
+        self.assertLess(time.time() - start_time, 1, 'Verifying the hung case was not waited for')
+
+        self.assertEqual(
+            ['diagnostic_case_found'],
+            list(ResolutionStep.objects.get(issue=self.issue).get_diagnosis_timings()))
+
+        self.assertTrue(self.hung_case_cancelled.wait(1), 'Verifying the hung case was told to stop')
+
+    def test_cancelled_cases_skipped(self):
+        """
+        Verify that the cases run on the shared pool, and that a case which
+        has not started by the time its diagnosis is cancelled never runs.
+        """
+        pool = ThreadPool(1)
+        self.addCleanup(pool.terminate)
+
+        self.assertion.diagnosis_strategy = DiagnosisStrategy.FIRST_MATCH
+
+        with patch.object(diagnosis_pool, 'get_pool', return_value=pool), patch.object(
+                self.assertion, 'run_diagnostic_case', wraps=self.assertion.run_diagnostic_case) as run_mock:
+            self.assertion.diagnose(current_issue=self.issue)
+
+            # Wait for the pool's one thread to get through the cases queued behind the first match
+            pool.apply_async(time.sleep, (0,)).get(2)
+
+        # The hung case may have got the thread just before the diagnosis was cancelled, but stops on seeing it was
+        self.assertNotIn('diagnostic_case_nothing', [call[0][0] for call in run_mock.call_args_list])
+
+    def test_queued_time_not_counted(self):
+        """
+        Verify that a case's time runs from when it gets a thread, not from
+        when the diagnosis started.
+        """
+        class QueuedAssertion(Assertion):
+            parallel_diagnosis = True
+            diagnostic_case_timeout = 0.5
+
+            def check(self_):
+                pass
+
+            def diagnostic_case_first(self_, current_issue, *args, **kwargs):
+                time.sleep(0.3)
+                return ResolutionStep(issue=current_issue, action_type=ResolutionStepActionType.PASS)
+
+            def diagnostic_case_second(self_, current_issue, *args, **kwargs):
+                time.sleep(0.3)
+                return ResolutionStep(issue=current_issue, action_type=ResolutionStepActionType.PASS)
+
+        pool = ThreadPool(1)
+        self.addCleanup(pool.terminate)
+
+        with patch.object(diagnosis_pool, 'get_pool', return_value=pool):
+            case_results = QueuedAssertion(self.assertion_meta).run_diagnostic_cases(current_issue=self.issue)
+
+        self.assertEqual(
+            ['diagnostic_case_first', 'diagnostic_case_second'],
+            [diagnostic_case_name for diagnostic_case_name, result, seconds in case_results if result])
+
+    def test_late_case_step_discarded(self):
+        """
+        Verify that the step saved by a case that ran out of time is deleted
+        once the case finishes.
+        """
+        class LateAssertion(Assertion):
+            parallel_diagnosis = True
+            diagnostic_case_timeout = 0.1
+
+            def check(self_):
+                pass
+
+            def diagnostic_case_late(self_, current_issue, *args, **kwargs):
+                time.sleep(0.3)
+                return ResolutionStep(id=1234, issue=current_issue, action_type=ResolutionStepActionType.PASS)
+
+        step_deleted = threading.Event()
+
+        with patch.object(ResolutionStep, 'delete', side_effect=lambda: step_deleted.set()):
+            case_results = LateAssertion(self.assertion_meta).run_diagnostic_cases(current_issue=self.issue)
+
+            self.assertEqual([('diagnostic_case_late', None, None)], case_results)
+            self.assertTrue(step_deleted.wait(2), 'Verifying the late step was deleted')
+
+    def test_inside_transaction(self):
+        """
+        Verify that inside a transaction the cases are run in order on the
+        calling thread, which can see what the transaction wrote.
+        """
+        self.assertion.diagnosis_strategy = DiagnosisStrategy.FIRST_MATCH
+
+        with patch.object(diagnosis_pool, 'apply_async') as apply_async_mock, transaction.atomic():
+            case_results = self.assertion.run_diagnostic_cases(current_issue=self.issue)
+
+        self.assertFalse(apply_async_mock.called)
+        self.assertEqual(['diagnostic_case_found'], [case_result[0] for case_result in case_results])
+
 
 class Test_check_and_diagnose(TestCase):
     def setUp(self):
@@ -498,6 +748,51 @@ class Test_check_and_diagnose(TestCase):
             IssueStatusType.WONT_FIX,
             'Issue should still be marked as WONT_FIX')
 
+    # The number of queries each issue state transition takes ---
+    def test_passing_without_issue(self):
+        self.check_return_value = True
+
+        # Update last_check, try to resolve
+        with self.assertNumQueries(2):
+            self.assertTrue(self.assertion.check_and_diagnose())
+
+    def test_passing_resolves_issue(self):
+        issue = Issue.objects.create(failed_assertion=self.assertion_meta, status=IssueStatusType.IMPASSE)
+        self.check_return_value = True
+
+        with self.assertNumQueries(2):
+            self.assertTrue(self.assertion.check_and_diagnose())
+
+        self.assertEqual(IssueStatusType.RESOLVED, Issue.objects.get(id=issue.id).status)
+        self.assertTrue(self.post_recovery_cleanup_called)
+
+    def test_failing_creates_issue(self):
+        # Update last_check, fetch the current issue, create one
+        with self.assertNumQueries(3):
+            self.assertFalse(self.assertion.check_and_diagnose())
+
+        self.assertTrue(self.diagnose_called)
+
+    def test_failing_with_open_issue(self):
+        Issue.objects.create(failed_assertion=self.assertion_meta, status=IssueStatusType.WONT_FIX)
+        issue = Issue.objects.create(failed_assertion=self.assertion_meta, status=IssueStatusType.OPEN)
+
+        current_issues = []
+        self.assertion.diagnose = lambda *args, **kwargs: current_issues.append(kwargs['current_issue'])
+
+        with self.assertNumQueries(2):
+            self.assertFalse(self.assertion.check_and_diagnose())
+
+        self.assertEqual([issue], current_issues)
+
+    def test_failing_with_wont_fix_issue(self):
+        Issue.objects.create(failed_assertion=self.assertion_meta, status=IssueStatusType.WONT_FIX)
+
+        with self.assertNumQueries(2):
+            self.assertFalse(self.assertion.check_and_diagnose())
+
+        self.assertFalse(self.diagnose_called)
+
 
 class DoMethodTests(TestCase):
     """
@@ -574,3 +869,94 @@ class DoMethodTests(TestCase):
             mail.outbox[0].subject,
             expected_subject,
             'Verifying the subject was sent as expected')
+
+    def test_defer_to_admins_in_digest(self):
+        """
+        Verify that while notifications are being collected, each admin
+        gets a single digest with the repeated messages counted.
+        """
+        sent_count = len(mail.outbox)
+
+        with collect_notifications():
+            for i in range(50):
+                self.assertion.executor.do_defer_to_admins(
+                    'Failed assertion; No solutions found', 'Assertion Test Assertion failed')
+
+            self.assertion.executor.do_defer_to_admins('Invalid assertion detected', 'Invalid step')
+
+            self.assertEqual(len(mail.outbox), sent_count, 'Verifying nothing is sent until the run ends')
+
+        self.assertEqual(
+            len(mail.outbox), sent_count + 2, 'Verifying each admin got one digest')
+
+        self.assertEqual(
+            set(email.recipients()[0] for email in mail.outbox[sent_count:]),
+            set([self.test_user.email, self.test_user_2.email]),
+            'Verifying the digests are headed to the appropriate recipeients')
+
+        digest = mail.outbox[sent_count]
+
+        self.assertEqual('Narrative digest: 51 notifications', digest.subject)
+        self.assertIn('(50 times) Assertion Test Assertion failed', digest.body)
+        self.assertIn('Invalid step', digest.body)
+
+    def test_single_notification_in_digest(self):
+        """
+        Verify that a lone notification is sent as it would be outside a digest.
+        """
+        sent_count = len(mail.outbox)
+
+        with collect_notifications():
+            self.assertion.executor.do_defer_to_admins('test subject', 'test message')
+
+        self.assertEqual(
+            [('test subject', 'test message')] * 2,
+            [(email.subject, email.body) for email in mail.outbox[sent_count:]])
+
+    def test_defer_to_admins_from_step_group(self):
+        """
+        Verify that notifications sent by the threads running a step group
+        go into the digest collecting on the thread that started them.
+        """
+        # The step threads cannot see the test database, so the admins have to be cached already
+        admin_recipient_cache.get_admin_emails()
+        sent_count = len(mail.outbox)
+
+        with collect_notifications() as digest:
+            self.assertion.executor.execute([[
+                ('defer_to_admins', {'subject': 'test subject', 'message': 'first message'}),
+                ('defer_to_admins', {'subject': 'test subject', 'message': 'second message'}),
+            ]])
+
+        self.assertEqual(
+            ['Narrative digest: 2 notifications'] * 2,
+            [email.subject for email in mail.outbox[sent_count:]])
+
+        # Anything sent after the digest went out is not collected
+        self.assertFalse(digest.add('test subject', 'late message', None, [self.test_user.email]))
+
+    def test_admin_recipients_cached(self):
+        """
+        Verify that the admins are only looked up once, until the
+        group's membership changes.
+        """
+        self.assertion.executor.do_defer_to_admins('test subject', 'test message')
+
+        with self.assertNumQueries(0):
+            self.assertion.executor.do_defer_to_admins('test subject', 'test message')
+
+        test_user_3 = User.objects.create(
+            username='test_user_3', password='test_user_3', email='test_user_3@example.com')
+        Group.objects.get(name=settings.NARRATIVE_ADMIN_GROUP_NAME).user_set.add(test_user_3)
+
+        sent_count = len(mail.outbox)
+
+        self.assertion.executor.do_defer_to_admins('test subject', 'test message')
+
+        self.assertEqual(
+            set(mail.outbox[sent_count].recipients()),
+            set([self.test_user.email, self.test_user_2.email, test_user_3.email]),
+            'Verifying the new admin is notified')
+
+    def test_executor_reused(self):
+        self.assertIs(self.assertion.executor, self.assertion.executor)
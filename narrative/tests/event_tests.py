@@ -140,3 +140,66 @@ class Test_detect_and_handle(TestCase):
             original_datum_count,
             Datum.objects.filter(origin=self.event.origin_name).count())
         self.assertFalse(self.event_instance_detected_called)
+
+
+class Test_detect_many(TestCase):
+    def setUp(self):
+        Datum.objects.all().delete()
+
+        self.detected_job_ids = []
+        self.handled_summaries = []
+
+        class FailedJobsEvent(Event):
+            def detect(self_, *args, **kwargs):
+                return bool(self.detected_job_ids)
+
+            def instance_summary(self_, *args, **kwargs):
+                return {}
+
+            def detect_many(self_, *args, **kwargs):
+                return [{'job_id': job_id} for job_id in self.detected_job_ids]
+
+            def event_instance_detected(self_, instance_summary):
+                self.handled_summaries.append(instance_summary)
+
+        self.event_meta, created = EventMeta.objects.get_or_create(
+            display_name='Failed jobs', class_load_path='foo.bar')
+        self.event = FailedJobsEvent(self.event_meta)
+
+    def test_nothing_detected(self):
+        self.assertFalse(self.event.detect_and_handle())
+        self.assertEqual(0, Datum.objects.filter(origin=self.event.origin_name).count())
+
+    def test_only_new_instances_handled(self):
+        """
+        Verify that each distinct occurrence gets one datum, and is only
+        handled the first time it is detected.
+        """
+        self.detected_job_ids = [1, 2, 2, 3]
+
+        self.assertTrue(self.event.detect_and_handle())
+        self.assertEqual([{'job_id': 1}, {'job_id': 2}, {'job_id': 3}], self.handled_summaries)
+
+        self.detected_job_ids = [3, 4]
+        self.handled_summaries = []
+
+        self.assertTrue(self.event.detect_and_handle())
+        self.assertEqual([{'job_id': 4}], self.handled_summaries)
+
+        datums = Datum.objects.filter(origin=self.event.origin_name)
+
+        self.assertEqual(
+            [{'job_id': job_id} for job_id in [1, 2, 3, 4]],
+            sorted([datum.get_note() for datum in datums], key=lambda note: note['job_id']))
+        self.assertEqual(4, len(set(datum.thread_id for datum in datums)))
+
+    def test_chunked_lookups(self):
+        self.detected_job_ids = list(range(1200))
+
+        self.event.detect_and_handle()
+        self.handled_summaries = []
+        self.detected_job_ids = list(range(1100, 1300))
+
+        self.event.detect_and_handle()
+
+        self.assertEqual([{'job_id': job_id} for job_id in range(1200, 1300)], self.handled_summaries)
@@ -0,0 +1,164 @@
+import threading
+import time
+import unittest
+
+from django.test import TestCase
+
+from ..assertions import Assertion
+from ..executor import Executor, InvalidPlanError, PlanExecutionError
+from ..models import AssertionMeta, Solution
+
+
+class GroupTestExecutor(Executor):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    def do_ping(self, host):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.running, self.max_running)
+
+        time.sleep(0.05)
+
+        with self.lock:
+            self.running -= 1
+            self.calls.append(host)
+
+    def do_fail(self, reason):
+        raise Exception(reason)
+
+
+class StepGroupTests(unittest.TestCase):
+    def setUp(self):
+        self.executor = GroupTestExecutor()
+
+    def test_group_runs_concurrently(self):
+        plan = [
+            ('ping', {'host': 'first'}),
+            [('ping', {'host': 'a'}), ('ping', {'host': 'b'}), ('ping', {'host': 'c'})],
+            ('ping', {'host': 'last'}),
+        ]
+
+        self.executor.execute(plan)
+
+        self.assertEqual(3, self.executor.max_running, 'Verifying the grouped steps overlapped')
+        self.assertEqual('first', self.executor.calls[0])
+        self.assertEqual(set(['a', 'b', 'c']), set(self.executor.calls[1:4]))
+        self.assertEqual('last', self.executor.calls[4])
+
+    def test_can_execute_checks_groups(self):
+        invalid_step = ['reboot', {'host': 'b'}]
+
+        self.assertEqual(
+            (False, invalid_step),
+            self.executor.can_execute([('ping', {'host': 'first'}), [('ping', {'host': 'a'}), invalid_step]]))
+        self.assertEqual(
+            (True, None),
+            self.executor.can_execute([('ping', {'host': 'first'}), [('ping', {'host': 'a'})]]))
+
+    def test_group_errors_collected(self):
+        """
+        Verify that every step of a group runs even when some fail, and
+        that all of the failures are reported.
+        """
+        plan = [[('fail', {'reason': 'host a down'}), ('ping', {'host': 'b'}), ('fail', {'reason': 'host c down'})]]
+
+        with self.assertRaises(PlanExecutionError) as context:
+            self.executor.execute(plan)
+
+        self.assertEqual(['b'], self.executor.calls)
+        self.assertEqual(2, len(context.exception.step_errors))
+        self.assertIn('host a down', str(context.exception))
+        self.assertIn('host c down', str(context.exception))
+
+
+class ActionRegistryTests(unittest.TestCase):
+    def test_do_methods_registered(self):
+        self.assertEqual('do_ping', GroupTestExecutor.action_handlers['ping'])
+        self.assertEqual('do_email', GroupTestExecutor.action_handlers['email'])
+        self.assertNotIn('ping', Executor.action_handlers)
+
+    def test_register_action(self):
+        """
+        Verify that a plugin action is available to the class and its
+        subclasses, without overriding a subclass's own handler.
+        """
+        class PluginExecutor(Executor):
+            pass
+
+        class PluginSubExecutor(PluginExecutor):
+            def do_page(self, who):
+                self.paged = 'subclass ' + who
+
+        @PluginExecutor.register_action('page')
+        def page(executor, who):
+            executor.paged = who
+
+        plugin_executor = PluginExecutor()
+        plugin_executor.execute([('page', {'who': 'ops'})])
+        self.assertEqual('ops', plugin_executor.paged)
+
+        sub_executor = PluginSubExecutor()
+        sub_executor.execute([('page', {'who': 'ops'})])
+        self.assertEqual('subclass ops', sub_executor.paged)
+
+        self.assertEqual((False, ('page', {'who': 'ops'})), Executor().can_execute([('page', {'who': 'ops'})]))
+
+    def test_compiled_plan(self):
+        """
+        Verify that a compiled plan runs repeatedly without looking up handlers again.
+        """
+        executor = GroupTestExecutor()
+        compiled_plan = executor.compile([('ping', {'host': 'a'}), [('ping', {'host': 'b'})]])
+
+        executor.action_handlers = {}
+        compiled_plan.execute()
+        compiled_plan.execute()
+
+        self.assertEqual(['a', 'b', 'a', 'b'], executor.calls)
+
+    def test_compile_invalid_plan(self):
+        with self.assertRaises(InvalidPlanError) as context:
+            GroupTestExecutor().compile([[('ping', {'host': 'a'}), ('reboot', {'host': 'b'})]])
+
+        self.assertEqual(('reboot', {'host': 'b'}), context.exception.step)
+
+    def test_empty_step_group(self):
+        executor = GroupTestExecutor()
+        plan = [('ping', {'host': 'a'}), []]
+
+        self.assertEqual((False, []), executor.can_execute(plan))
+
+        with self.assertRaises(InvalidPlanError) as context:
+            executor.compile(plan)
+
+        self.assertEqual([], context.exception.step)
+        self.assertEqual([], executor.calls, 'Verifying nothing was run')
+
+
+class StepGroupSolutionTests(TestCase):
+    def test_errors_recorded_per_step(self):
+        executor = GroupTestExecutor()
+
+        class TestAssertion(Assertion):
+            def check(self):
+                return False
+
+            @property
+            def executor(self):
+                return executor
+
+        solution = Solution.objects.create(plan=[
+            [('fail', {'reason': 'host a down'}), ('fail', {'reason': 'host b down'})],
+        ])
+
+        TestAssertion(AssertionMeta.objects.create(display_name='Test Assertion')).execute_solution(solution)
+
+        solution = Solution.objects.get(id=solution.id)
+
+        self.assertIn('host a down', solution.error_traceback)
+        self.assertIn('host b down', solution.error_traceback)
+        self.assertIn('fail | fail', solution.explain())
@@ -0,0 +1,234 @@
+import datetime
+import threading
+import time
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from ..assertions import Assertion
+from ..executor import Executor
+from ..jobs import execute_solution_job, record_job_heartbeat, run_solution_jobs
+from ..models import AssertionMeta, Solution, SolutionJob, SolutionJobStatusType
+
+
+class JobTestExecutor(Executor):
+    """
+    Executor for the queued jobs; the workers load it by its import path.
+    """
+    lock = threading.Lock()
+    calls = []
+    running = 0
+    max_running = 0
+
+    def do_record(self, name):
+        with self.lock:
+            self.calls.append(name)
+
+    def do_fail(self):
+        raise Exception('Remediation failed')
+
+    def do_sleep(self, seconds):
+        with self.lock:
+            JobTestExecutor.running += 1
+            JobTestExecutor.max_running = max(JobTestExecutor.running, JobTestExecutor.max_running)
+
+        time.sleep(seconds)
+
+        with self.lock:
+            JobTestExecutor.running -= 1
+
+
+class JobTestAssertion(Assertion):
+    def check(self):
+        return False
+
+    @property
+    def executor(self):
+        return JobTestExecutor()
+
+
+class SolutionJobTests(TestCase):
+    def setUp(self):
+        JobTestExecutor.calls = []
+        JobTestExecutor.running = 0
+        JobTestExecutor.max_running = 0
+
+        self.assertion = JobTestAssertion(AssertionMeta.objects.create(display_name='Test Assertion'))
+
+    def queue_solution(self, plan):
+        solution = Solution.objects.create(plan=plan)
+
+        with self.settings(NARRATIVE_QUEUE_SOLUTIONS=True):
+            self.assertion.execute_solution(solution)
+
+        return solution
+
+    def test_execute_solution_queues_plan(self):
+        solution = self.queue_solution([('record', {'name': 'first'})])
+
+        self.assertEqual([], JobTestExecutor.calls, 'Verifying the plan was not run inline')
+        self.assertIsNone(Solution.objects.get(id=solution.id).enacted)
+
+        job = SolutionJob.objects.get(solution=solution)
+
+        self.assertEqual(SolutionJobStatusType.PENDING, job.status)
+        self.assertEqual('narrative.tests.job_tests.JobTestExecutor', job.executor_class_load_path)
+
+    def test_run_solution_jobs(self):
+        solution = self.queue_solution([('record', {'name': 'first'}), ('record', {'name': 'second'})])
+
+        self.assertEqual(1, run_solution_jobs(worker_count=2))
+
+        self.assertEqual(['first', 'second'], JobTestExecutor.calls)
+        self.assertEqual(SolutionJobStatusType.SUCCEEDED, SolutionJob.objects.get(solution=solution).status)
+
+        solution = Solution.objects.get(id=solution.id)
+
+        self.assertIsNotNone(solution.enacted)
+        self.assertIsNone(solution.error_traceback)
+
+    @override_settings(NARRATIVE_SOLUTION_JOB_MAX_ATTEMPTS=2)
+    def test_retries(self):
+        """
+        Verify that a failing job is retried after a delay, and recorded on
+        the solution once it runs out of attempts.
+        """
+        solution = self.queue_solution([('fail', {})])
+        utc_now = datetime.datetime.utcnow()
+
+        self.assertEqual(1, run_solution_jobs(get_utc_now=lambda: utc_now))
+
+        job = SolutionJob.objects.get(solution=solution)
+
+        self.assertEqual(SolutionJobStatusType.PENDING, job.status)
+        self.assertEqual(1, job.attempts)
+        self.assertIn('Remediation failed', job.error_traceback)
+        self.assertIsNone(Solution.objects.get(id=solution.id).enacted)
+
+        # The retry is not due yet
+        self.assertEqual(0, run_solution_jobs(get_utc_now=lambda: utc_now))
+
+        self.assertEqual(1, run_solution_jobs(get_utc_now=lambda: utc_now + datetime.timedelta(minutes=2)))
+
+        job = SolutionJob.objects.get(solution=solution)
+
+        self.assertEqual(SolutionJobStatusType.FAILED, job.status)
+        self.assertEqual(2, job.attempts)
+
+        solution = Solution.objects.get(id=solution.id)
+
+        self.assertIsNotNone(solution.enacted)
+        self.assertIn('Remediation failed', solution.error_traceback)
+
+    @override_settings(
+        NARRATIVE_SOLUTION_JOB_MAX_ATTEMPTS=1, NARRATIVE_SOLUTION_JOB_TIMEOUT=datetime.timedelta(seconds=0.1))
+    def test_timeout(self):
+        solution = self.queue_solution([('sleep', {'seconds': 1})])
+
+        run_solution_jobs()
+
+        self.assertIn('Timed out', Solution.objects.get(id=solution.id).error_traceback)
+
+    @override_settings(
+        NARRATIVE_SOLUTION_JOB_MAX_ATTEMPTS=2, NARRATIVE_SOLUTION_JOB_TIMEOUT=datetime.timedelta(seconds=0.1))
+    def test_timed_out_plan_not_retried_alongside(self):
+        """
+        Verify that a timed out attempt whose plan is still running is not
+        retried until its runner has gone.
+        """
+        solution = self.queue_solution([('sleep', {'seconds': 0.5})])
+        utc_now = datetime.datetime.utcnow()
+
+        self.assertEqual(1, run_solution_jobs(get_utc_now=lambda: utc_now))
+
+        job = SolutionJob.objects.get(solution=solution)
+
+        self.assertEqual(SolutionJobStatusType.RUNNING, job.status)
+        self.assertIn('Timed out', job.error_traceback)
+        # The plan may still be running, so the job is not retried
+        self.assertEqual(0, run_solution_jobs(get_utc_now=lambda: utc_now))
+
+        # Once the plan has stopped recording the heartbeat the job is abandoned, and put back in the queue
+        self.assertEqual(1, run_solution_jobs(get_utc_now=lambda: utc_now + datetime.timedelta(minutes=2)))
+
+        job = SolutionJob.objects.get(solution=solution)
+
+        self.assertEqual(SolutionJobStatusType.FAILED, job.status)
+        self.assertEqual(2, job.attempts)
+        self.assertIn('Timed out', Solution.objects.get(id=solution.id).error_traceback)
+
+    def test_worker_errors_reported(self):
+        """
+        Verify that a worker that fails outside of the plan still reports
+        back, rather than leaving the runner waiting.
+        """
+        solution = self.queue_solution([('record', {'name': 'first'})])
+
+        # The first call wraps the worker; the second fails to wrap its plan thread
+        with patch('narrative.jobs.bind_active_digest', side_effect=[execute_solution_job, RuntimeError('No threads')]):
+            self.assertEqual(1, run_solution_jobs())
+
+        job = SolutionJob.objects.get(solution=solution)
+
+        self.assertEqual(SolutionJobStatusType.PENDING, job.status)
+        self.assertIn('No threads', job.error_traceback)
+
+    @override_settings(NARRATIVE_ACTION_CONCURRENCY={'sleep': 1})
+    def test_action_concurrency_limit(self):
+        for i in range(4):
+            self.queue_solution([('sleep', {'seconds': 0.05}), ('record', {'name': str(i)})])
+
+        self.assertEqual(4, run_solution_jobs(worker_count=4))
+
+        self.assertEqual(1, JobTestExecutor.max_running, 'Verifying the sleeps never overlapped')
+        self.assertEqual(4, len(JobTestExecutor.calls), 'Verifying the unlimited steps all ran')
+
+    def test_abandoned_jobs_requeued(self):
+        solution = self.queue_solution([('record', {'name': 'first'})])
+        SolutionJob.objects.filter(solution=solution).update(
+            status=SolutionJobStatusType.RUNNING, attempts=1,
+            started=datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+
+        self.assertEqual(1, run_solution_jobs())
+
+        job = SolutionJob.objects.get(solution=solution)
+
+        self.assertEqual(SolutionJobStatusType.SUCCEEDED, job.status)
+        self.assertEqual(2, job.attempts)
+
+    def test_jobs_with_heartbeat_not_requeued(self):
+        """
+        Verify that a job whose plan is still recording its heartbeat is
+        not requeued, however long ago it started.
+        """
+        solution = self.queue_solution([('record', {'name': 'first'})])
+        utc_now = datetime.datetime.utcnow()
+        SolutionJob.objects.filter(solution=solution).update(
+            status=SolutionJobStatusType.RUNNING, attempts=1, started=utc_now - datetime.timedelta(hours=1))
+        job = SolutionJob.objects.get(solution=solution)
+
+        # The heartbeat of an earlier attempt does not count
+        self.assertEqual(0, record_job_heartbeat(job.id, 2, utc_now))
+        self.assertEqual(1, record_job_heartbeat(job.id, 1, utc_now))
+
+        self.assertEqual(0, run_solution_jobs(get_utc_now=lambda: utc_now))
+        self.assertEqual(SolutionJobStatusType.RUNNING, SolutionJob.objects.get(id=job.id).status)
+
+        self.assertEqual(1, run_solution_jobs(get_utc_now=lambda: utc_now + datetime.timedelta(minutes=2)))
+        self.assertEqual(SolutionJobStatusType.SUCCEEDED, SolutionJob.objects.get(id=job.id).status)
+
+    def test_abandoned_jobs_out_of_attempts(self):
+        solution = self.queue_solution([('record', {'name': 'first'})])
+        SolutionJob.objects.filter(solution=solution).update(
+            status=SolutionJobStatusType.RUNNING, attempts=3,
+            started=datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+
+        self.assertEqual(0, run_solution_jobs())
+
+        self.assertEqual(SolutionJobStatusType.FAILED, SolutionJob.objects.get(solution=solution).status)
+
+        solution = Solution.objects.get(id=solution.id)
+
+        self.assertIsNotNone(solution.enacted)
+        self.assertIn('Abandoned', solution.error_traceback)
@@ -0,0 +1,273 @@
+import datetime
+import os
+import shutil
+import socket
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import Group, User
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from ..assertions import Assertion
+from ..checker import check_enabled_assertions
+from ..executor import admin_recipient_cache, Executor
+from ..metrics import (
+    get_periodical_costs, measure_periodical_run, PeriodicalRunMetrics, PrometheusTextfileMetricsSink, record_metric,
+    StatsdMetricsSink)
+from ..models import AssertionMeta, EventMeta, Issue, PeriodicalRun
+
+
+class MeteredAssertion(Assertion):
+    """
+    Loaded by the checker by its import path.
+    """
+    check_result = False
+
+    def check(self):
+        Issue.objects.count()
+        return self.check_result
+
+    def diagnose(self, *args, **kwargs):
+        Executor().do_email('admin@example.com', 'Failing', 'Failing', None)
+
+
+class DeferringAssertion(Assertion):
+    def check(self):
+        return False
+
+    def diagnose(self, *args, **kwargs):
+        Executor().do_defer_to_admins('Failing', 'Failing')
+
+
+class RecordingMetricsSink(object):
+    runs = []
+    flush_count = 0
+
+    def record(self, run):
+        RecordingMetricsSink.runs.append(run)
+
+    def flush(self):
+        RecordingMetricsSink.flush_count += 1
+
+
+@override_settings(NARRATIVE_METRICS_SINKS=['narrative.tests.metrics_tests.RecordingMetricsSink'])
+class CheckerMetricsTests(TestCase):
+    def setUp(self):
+        RecordingMetricsSink.runs = []
+        RecordingMetricsSink.flush_count = 0
+
+        self.assertion_meta = AssertionMeta.objects.create(
+            display_name='Metered', class_load_path='narrative.tests.metrics_tests.MeteredAssertion',
+            enabled=True)
+
+    def test_runs_measured(self):
+        """
+        Verify that each run is stored and reported, whether or not the
+        checker is verbose.
+        """
+        MeteredAssertion.check_result = False
+
+        check_enabled_assertions()
+
+        periodical_run = PeriodicalRun.objects.get()
+
+        self.assertEqual(self.assertion_meta, periodical_run.meta)
+        self.assertFalse(periodical_run.succeeded)
+        self.assertEqual(1, periodical_run.records_checked)
+        self.assertEqual(1, periodical_run.issues_opened)
+        self.assertEqual(0, periodical_run.issues_resolved)
+        self.assertEqual(1, periodical_run.emails_sent)
+        self.assertTrue(periodical_run.query_count >= 3)
+
+        self.assertEqual(1, len(RecordingMetricsSink.runs))
+        self.assertEqual(1, RecordingMetricsSink.flush_count)
+
+        MeteredAssertion.check_result = True
+        AssertionMeta.objects.update(last_check=datetime.datetime(1970, 1, 1))
+
+        check_enabled_assertions()
+
+        periodical_run = PeriodicalRun.objects.latest('id')
+
+        self.assertTrue(periodical_run.succeeded)
+        self.assertEqual(1, periodical_run.issues_resolved)
+
+    def test_deferred_notifications_counted(self):
+        """
+        Verify that notifications added to the admin digest are not counted
+        as emails sent by the run.
+        """
+        admin_group, created = Group.objects.get_or_create(name=settings.NARRATIVE_ADMIN_GROUP_NAME)
+        admin_group.user_set.add(User.objects.create(username='admin', email='admin@example.com'))
+        admin_recipient_cache.invalidate()
+
+        self.assertion_meta.class_load_path = 'narrative.tests.metrics_tests.DeferringAssertion'
+        self.assertion_meta.save()
+
+        check_enabled_assertions()
+
+        periodical_run = PeriodicalRun.objects.get()
+
+        self.assertEqual(1, periodical_run.notifications_deferred)
+        self.assertEqual(0, periodical_run.emails_sent)
+        self.assertEqual(1, len(mail.outbox))
+
+    def test_expired_runs_cleared(self):
+        old_run = PeriodicalRun.objects.create(
+            meta=self.assertion_meta, started=datetime.datetime.utcnow() - datetime.timedelta(days=31),
+            duration_seconds=1)
+
+        check_enabled_assertions()
+
+        self.assertFalse(PeriodicalRun.objects.filter(id=old_run.id).exists())
+        self.assertEqual(1, PeriodicalRun.objects.count())
+
+    def test_queries_counted_without_keeping_them(self):
+        """
+        Verify that the queries of a run are counted, including those of a
+        nested run, without their SQL being kept.
+        """
+        query_log_length = len(connection.queries)
+
+        with measure_periodical_run(self.assertion_meta) as run:
+            Issue.objects.count()
+
+            with measure_periodical_run(self.assertion_meta) as nested_run:
+                Issue.objects.count()
+
+        self.assertEqual(2, run.query_count)
+        self.assertEqual(1, nested_run.query_count)
+        self.assertEqual(query_log_length, len(connection.queries))
+        self.assertNotIn('cursor', connections[DEFAULT_DB_ALIAS].__dict__)
+
+    def test_record_metric_outside_run(self):
+        record_metric('records_checked')
+
+        with measure_periodical_run(self.assertion_meta) as run:
+            record_metric('records_checked', 3)
+
+        self.assertEqual(3, run.counters['records_checked'])
+
+
+class PeriodicalCostTests(TestCase):
+    def setUp(self):
+        self.assertion_meta = AssertionMeta.objects.create(display_name='Slow', class_load_path='foo.bar')
+        self.event_meta = EventMeta.objects.create(display_name='Fast', class_load_path='foo.bar')
+
+        started = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        PeriodicalRun.objects.bulk_create(
+            [PeriodicalRun(meta=self.assertion_meta, started=started, duration_seconds=i) for i in range(100, 0, -1)] +
+            [PeriodicalRun(meta=self.event_meta, started=started, duration_seconds=i) for i in range(1, 11)] +
+            [PeriodicalRun(
+                meta=self.event_meta, started=started - datetime.timedelta(days=8), duration_seconds=1000)])
+
+    def test_duration_percentiles(self):
+        """
+        Verify the nearest rank percentiles of the runs in the window, with
+        the most costly periodical first.
+        """
+        costs = get_periodical_costs()
+
+        self.assertEqual([self.assertion_meta, self.event_meta], [cost['meta'] for cost in costs])
+        self.assertEqual(
+            [100, 5050, 50.5, 50, 95, 99],
+            [costs[0][key] for key in
+             ['run_count', 'total_seconds', 'mean_seconds', 'p50_seconds', 'p95_seconds', 'p99_seconds']])
+        self.assertEqual(
+            [10, 55, 5, 10, 10],
+            [costs[1][key] for key in ['run_count', 'total_seconds', 'p50_seconds', 'p95_seconds', 'p99_seconds']])
+
+    @patch('narrative.models.connection')
+    def test_duration_percentiles_before_postgresql_94(self, connection_mock):
+        """
+        Verify that PostgreSQL versions without percentile_disc use the offset queries.
+        """
+        connection_mock.vendor = 'postgresql'
+        connection_mock.pg_version = 90300
+
+        costs = get_periodical_costs()
+
+        self.assertFalse(connection_mock.cursor.called)
+        self.assertEqual([50, 95, 99], [costs[0][key] for key in ['p50_seconds', 'p95_seconds', 'p99_seconds']])
+
+    def test_costs_admin_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.login(username='admin', password='password')
+
+        response = self.client.get(reverse('admin:narrative_periodicalrun_costs'))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            [self.assertion_meta, self.event_meta], [cost['meta'] for cost in response.context['costs']])
+
+
+class MetricsSinkTests(TestCase):
+    def setUp(self):
+        self.assertion_meta = AssertionMeta.objects.create(
+            display_name='Slow "orders" check', class_load_path='foo.bar')
+        self.run = PeriodicalRunMetrics(self.assertion_meta)
+        self.run.started = datetime.datetime(2014, 1, 1)
+        self.run.duration_seconds = 1.5
+        self.run.query_count = 7
+        self.run.counters['records_checked'] = 100
+
+    def test_statsd(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+
+        with override_settings(NARRATIVE_STATSD_ADDRESS=receiver.getsockname()):
+            sink = StatsdMetricsSink()
+
+        sink.record(self.run)
+        sink.flush()
+
+        lines = receiver.recv(4096).decode('utf-8').split('\n')
+        receiver.close()
+
+        self.assertIn('narrative.assertionmeta.slow_orders_check.duration:1500|ms', lines)
+        self.assertIn('narrative.assertionmeta.slow_orders_check.queries:7|c', lines)
+        self.assertIn('narrative.assertionmeta.slow_orders_check.records_checked:100|c', lines)
+
+    def test_prometheus_textfile(self):
+        """
+        Verify that the periodicals that did not run keep the values of
+        their latest run, each labelled with its meta id.
+        """
+        other_assertion_meta = AssertionMeta.objects.create(
+            display_name='Slow "orders" check', class_load_path='foo.baz')
+        PeriodicalRun.objects.bulk_create([
+            PeriodicalRun(meta=other_assertion_meta, started=datetime.datetime(2013, 12, 31), duration_seconds=3),
+            PeriodicalRun(meta=other_assertion_meta, started=datetime.datetime(2013, 12, 30), duration_seconds=4),
+            PeriodicalRun(meta=self.assertion_meta, started=datetime.datetime(2013, 12, 30), duration_seconds=5),
+        ])
+        directory = tempfile.mkdtemp()
+
+        try:
+            with override_settings(NARRATIVE_PROMETHEUS_TEXTFILE_DIRECTORY=directory):
+                sink = PrometheusTextfileMetricsSink()
+
+            sink.record(self.run)
+            sink.flush()
+
+            self.assertEqual(['narrative_assertionmeta.prom'], os.listdir(directory))
+
+            with open(os.path.join(directory, 'narrative_assertionmeta.prom')) as textfile:
+                lines = textfile.read().split('\n')
+        finally:
+            shutil.rmtree(directory)
+
+        labels = '{{meta_id="{0}",name="Slow \\"orders\\" check"}}'.format(self.assertion_meta.id)
+        other_labels = '{{meta_id="{0}",name="Slow \\"orders\\" check"}}'.format(other_assertion_meta.id)
+
+        self.assertIn('# TYPE narrative_periodical_duration_seconds gauge', lines)
+        self.assertIn('narrative_periodical_duration_seconds' + labels + ' 1.5', lines)
+        self.assertIn('narrative_periodical_records_checked' + labels + ' 100', lines)
+        self.assertIn('narrative_periodical_last_run_timestamp_seconds' + labels + ' 1388534400.0', lines)
+        self.assertIn('narrative_periodical_duration_seconds' + other_labels + ' 3.0', lines)
+        self.assertEqual(2, len([line for line in lines if line.startswith('narrative_periodical_duration_seconds')]))
@@ -2,6 +2,7 @@ import json
 
 from django.test import TestCase
 
+from ..escalating_response import construct_escalating_response
 from ..models import AssertionMeta, Solution, Issue, ResolutionStep, ResolutionStepActionType, IssueStatusType
 
 
@@ -92,6 +93,56 @@ class IssueTests(TestCase):
             set([isr_1, isr_2]),
             'There should only be two matching issue resolution steps')
 
+    def test_steps_matching_plan_query_count(self):
+        """
+        Verify that matching a plan is a single query, with the solutions loaded along with the steps.
+        """
+        issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+
+        for i in range(3):
+            ResolutionStep.objects.create(
+                solution=Solution.objects.create(plan=[('do_email', {'address': str(i)})]), issue=issue)
+
+        with self.assertNumQueries(1):
+            matching_steps = issue.steps_matching_plan([('do_email', {})])
+
+            self.assertEqual(
+                ['0', '1', '2'],
+                sorted(step.solution.get_plan()[0][1]['address'] for step in matching_steps))
+
+    def test_operation_signature(self):
+        solution = Solution.objects.create(plan=[('do_email', {}), [('notify', {}), ('do_email', {})]])
+        other_solution = Solution.objects.create(plan=[('notify', {'subject': 'foo'}), ('do_email', {})])
+
+        self.assertEqual(solution.operation_signature, other_solution.operation_signature)
+
+        other_solution.set_plan([('notify', {})])
+        other_solution.save()
+
+        self.assertNotEqual(solution.operation_signature, other_solution.operation_signature)
+
+    def test_explain_many(self):
+        """
+        Verify that explain_many explains each issue as explain does,
+        with a fixed number of queries.
+        """
+        issues = []
+
+        for i in range(3):
+            issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+            ResolutionStep.objects.create(solution=Solution.objects.create(plan=[('do_email', {})]), issue=issue)
+            ResolutionStep.objects.create(action_type=ResolutionStepActionType.PASS, issue=issue)
+            issues.append(issue)
+
+        expected_explanations = [
+            Issue.objects.get(id=created_issue.id).explain() for created_issue in issues
+        ]
+
+        issues = list(Issue.objects.filter(id__in=[created_issue.id for created_issue in issues]).order_by('id'))
+
+        with self.assertNumQueries(2):
+            self.assertEqual(expected_explanations, Issue.explain_many(issues))
+
     def test_non_pass_steps(self):
         """
         Test that the non_pass_steps appropriately
@@ -138,6 +189,102 @@ class IssueTests(TestCase):
             set([isr_1, isr_2, isr_3]),
             'There should only be two matching issue resolution steps')
 
+    def test_non_pass_step_count(self):
+        """
+        Test that the issue's count of non pass steps follows the steps
+        being created, changed and deleted.
+        """
+        issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+
+        isr_1 = ResolutionStep.objects.create(solution=Solution.objects.create(plan=[]), issue=issue)
+        isr_2 = ResolutionStep.objects.create(solution=Solution.objects.create(plan=[]), issue=issue)
+        isr_pass = ResolutionStep.objects.create(action_type=ResolutionStepActionType.PASS, issue=issue)
+
+        self.assertEqual(2, issue.non_pass_step_count)
+        self.assertEqual(2, Issue.objects.get(id=issue.id).non_pass_step_count)
+
+        isr_pass.action_type = ResolutionStepActionType.EXEC
+        isr_pass.save()
+        self.assertEqual(3, Issue.objects.get(id=issue.id).non_pass_step_count)
+
+        isr_1.action_type = ResolutionStepActionType.PASS
+        isr_1.save()
+        isr_1.save()
+        self.assertEqual(2, Issue.objects.get(id=issue.id).non_pass_step_count)
+
+        isr_1.delete()
+        isr_2.delete()
+        self.assertEqual(1, Issue.objects.get(id=issue.id).non_pass_step_count)
+
+    def test_stale_issue_save_keeps_count(self):
+        issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+        stale_issue = Issue.objects.get(id=issue.id)
+
+        ResolutionStep.objects.create(solution=Solution.objects.create(plan=[]), issue=issue)
+
+        stale_issue.status = IssueStatusType.IMPASSE
+        stale_issue.save()
+
+        issue = Issue.objects.get(id=issue.id)
+
+        self.assertEqual(IssueStatusType.IMPASSE, issue.status)
+        self.assertEqual(1, issue.non_pass_step_count)
+
+    def test_recount_non_pass_steps(self):
+        """
+        Test that counts thrown off by bulk changes to the steps are
+        recomputed, and that queryset deletes are followed anyway.
+        """
+        issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+        other_issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+
+        ResolutionStep.objects.bulk_create([
+            ResolutionStep(issue=issue),
+            ResolutionStep(issue=issue),
+            ResolutionStep(issue=issue, action_type=ResolutionStepActionType.PASS),
+            ResolutionStep(issue=other_issue),
+        ])
+        Issue.objects.filter(id=other_issue.id).update(non_pass_step_count=5)
+
+        self.assertEqual(0, Issue.objects.get(id=issue.id).non_pass_step_count)
+
+        Issue.objects.recount_non_pass_steps()
+
+        self.assertEqual(
+            [2, 1], [Issue.objects.get(id=issue_id).non_pass_step_count for issue_id in (issue.id, other_issue.id)])
+
+        ResolutionStep.objects.filter(issue=issue).delete()
+
+        self.assertEqual(0, Issue.objects.get(id=issue.id).non_pass_step_count)
+
+    def test_escalating_response(self):
+        """
+        Test that the response is picked from the issue's count, and that
+        the steps are only loaded when there is a response to pass them to.
+        """
+        issue = Issue.objects.create(failed_assertion=self.assertion_meta)
+        isr_1 = ResolutionStep.objects.create(solution=Solution.objects.create(plan=[]), issue=issue)
+        ResolutionStep.objects.create(action_type=ResolutionStepActionType.PASS, issue=issue)
+
+        issue = Issue.objects.get(id=issue.id)
+        response_map = {
+            0: lambda steps: 'first',
+            1: lambda steps: ('second', steps[:1]),
+            2: lambda steps: steps,
+        }
+
+        with self.assertNumQueries(1):
+            self.assertEqual(('second', [isr_1]), construct_escalating_response(issue, response_map))
+
+        isr_2 = ResolutionStep.objects.create(solution=Solution.objects.create(plan=[]), issue=issue)
+
+        self.assertEqual([isr_1, isr_2], construct_escalating_response(issue, response_map))
+
+        ResolutionStep.objects.create(solution=Solution.objects.create(plan=[]), issue=issue)
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(construct_escalating_response(issue, response_map))
+
     def test_current_issues(self):
         issue1 = Issue.objects.create(failed_assertion=self.assertion_meta, status=IssueStatusType.OPEN)
         issue2 = Issue.objects.create(failed_assertion=self.assertion_meta, status=IssueStatusType.SOLUTION_APPLIED)
@@ -1,13 +1,43 @@
+import datetime
+
 from django.conf import settings
 from django.contrib.auth.models import User, Group
-from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from mock import patch
 
-from ..assertions import ModelAssertion
+from ..assertions import ModelAssertion, split_pk_range
 from ..models import AssertionMeta, Issue, ModelIssue, IssueStatusType, ResolutionStep, ResolutionStepActionType
 
 from test_project.models import TestModel
 
 
+class ShardedTestModelAssertion(ModelAssertion):
+    """
+    Checked in worker processes, so it has to be importable.
+    """
+    shard_workers = 2
+    chunk_size = 2
+
+    failing_pks = set()
+    diagnosed_records = []
+    recovered_records = []
+
+    @property
+    def queryset(self):
+        return TestModel.objects.all()
+
+    def check_record(self, record):
+        return record.pk not in self.failing_pks
+
+    def diagnose(self, *args, **kwargs):
+        self.diagnosed_records.append(kwargs['record'])
+
+    def post_recovery_cleanup(self, *args, **kwargs):
+        self.recovered_records.append(kwargs['record'])
+
+
 class ModelAssertionTests(TestCase):
     def setUp(self):
         self.mock_models = []
@@ -177,3 +207,227 @@ class ModelAssertionTests(TestCase):
             set([model_issue.failed_assertion for model_issue in model_issue_list]),
             set([self.assertion_meta]),
             'All of the model issues should reference the test asserrion meta')
+
+    def test_issue_lookup_by_content_type_id(self):
+        """
+        Verify that issues are looked up by content type id, without a
+        join, and are not confused with issues for another model's records.
+        """
+        record = self.mock_models[0]
+        ModelIssue.objects.create(failed_assertion=self.assertion_meta, model=self.test_user)
+
+        queryset = self.assertion.build_unresolved_issue_queryset(record=record)
+
+        self.assertNotIn('django_content_type', str(queryset.query))
+        self.assertEqual([], list(queryset))
+
+        issue = ModelIssue.objects.create(failed_assertion=self.assertion_meta, model=record)
+
+        self.assertEqual([issue], list(self.assertion.build_unresolved_issue_queryset(record=record)))
+
+    def test_chunked_queryset(self):
+        """
+        Verify that a queryset is checked in chunks, and that a run that
+        gets interrupted resumes after the last finished chunk.
+        """
+        checked_records = []
+        interrupt_at = [self.mock_models[7]]
+
+        class ChunkedModelAssertion(ModelAssertion):
+            chunk_size = 3
+            record_fields = ['id']
+
+            @property
+            def queryset(self_):
+                return TestModel.objects.all()
+
+            def check_record(self_, record):
+                if record in interrupt_at:
+                    interrupt_at.remove(record)
+                    raise RuntimeError('Interrupted')
+
+                checked_records.append(record)
+                return True
+
+        assertion = ChunkedModelAssertion(self.assertion_meta)
+
+        with self.assertRaises(RuntimeError):
+            assertion.check_and_diagnose()
+
+        self.assertEqual(self.mock_models[:7], checked_records)
+        self.assertEqual(self.mock_models[5].id, AssertionMeta.objects.get(id=self.assertion_meta.id).record_watermark)
+
+        # The next run picks up with the chunk that was interrupted, and clears the watermark when done
+        del checked_records[:]
+
+        self.assertTrue(assertion.check_and_diagnose())
+        self.assertEqual(self.mock_models[6:], checked_records)
+        self.assertIsNone(AssertionMeta.objects.get(id=self.assertion_meta.id).record_watermark)
+
+    def test_split_pk_range(self):
+        self.assertEqual([(1, 4), (5, 8), (9, 10)], split_pk_range(1, 10, 3))
+        self.assertEqual([(3, 3), (4, 4)], split_pk_range(3, 4, 8))
+
+    @patch('narrative.assertions.multiprocessing.Pool')
+    def test_sharded_check_in_transaction(self, pool_mock):
+        """
+        Verify that inside a transaction the records of a sharded assertion
+        are checked in order rather than in worker processes.
+        """
+        ShardedTestModelAssertion.failing_pks = set([self.mock_models[1].pk])
+        ShardedTestModelAssertion.diagnosed_records = []
+
+        self.assertFalse(ShardedTestModelAssertion(self.assertion_meta).check_and_diagnose())
+
+        self.assertFalse(pool_mock.called)
+        self.assertEqual([self.mock_models[1]], ShardedTestModelAssertion.diagnosed_records)
+
+    def test_incremental_check_and_diagnose(self):
+        """
+        Verify that only records changed since the last finished run, or
+        with unresolved issues, are checked, until a full sweep is due.
+        """
+        checked_records = []
+        failing_users = [self.test_user]
+
+        class UserAssertion(ModelAssertion):
+            modified_field = 'last_login'
+            full_sweep_interval = datetime.timedelta(hours=1)
+
+            @property
+            def queryset(self_):
+                return User.objects.all()
+
+            def check_record(self_, record):
+                checked_records.append(record)
+                return record not in failing_users
+
+            def diagnose(self_, *args, **kwargs):
+                pass
+
+        assertion = UserAssertion(self.assertion_meta)
+
+        # The first run checks all of the records
+        self.assertFalse(assertion.check_and_diagnose())
+        self.assertEqual([self.test_user, self.test_user_2], checked_records)
+
+        # Only the user with an open issue is checked once nothing changed
+        del checked_records[:]
+        self.assertFalse(assertion.check_and_diagnose())
+        self.assertEqual([self.test_user], checked_records)
+
+        # A changed user is checked along with it
+        del checked_records[:]
+        del failing_users[:]
+        self.test_user_2.last_login = timezone.now()
+        self.test_user_2.save()
+
+        self.assertTrue(assertion.check_and_diagnose())
+        self.assertEqual([self.test_user, self.test_user_2], checked_records)
+
+        del checked_records[:]
+        self.assertTrue(assertion.check_and_diagnose())
+        self.assertEqual([], checked_records)
+
+        # Until a full sweep is due
+        self.assertion_meta.last_full_sweep -= datetime.timedelta(hours=2)
+        self.assertTrue(assertion.check_and_diagnose())
+        self.assertEqual([self.test_user, self.test_user_2], checked_records)
+
+    def test_resumed_incremental_run(self):
+        """
+        Verify that a run that continues from the watermark of an
+        interrupted run counts as having started when that run did.
+        """
+        checked_records = []
+        interrupt_at = [self.test_user_2]
+
+        class UserAssertion(ModelAssertion):
+            modified_field = 'last_login'
+            chunk_size = 1
+
+            @property
+            def queryset(self_):
+                return User.objects.order_by('pk')
+
+            def check_record(self_, record):
+                if record in interrupt_at:
+                    interrupt_at.remove(record)
+                    raise RuntimeError('Interrupted')
+
+                checked_records.append(record)
+                return True
+
+        assertion = UserAssertion(self.assertion_meta)
+
+        with self.assertRaises(RuntimeError):
+            assertion.check_and_diagnose()
+
+        assertion_meta = AssertionMeta.objects.get(id=self.assertion_meta.id)
+        first_run_start = assertion_meta.record_run_start
+        self.assertIsNotNone(first_run_start)
+        self.assertIsNone(assertion_meta.last_complete_run)
+
+        # Records changed after the interrupted run started are checked by the next one
+        with patch('narrative.assertions.timezone.now', return_value=first_run_start + datetime.timedelta(hours=1)):
+            self.assertTrue(assertion.check_and_diagnose())
+
+        self.assertEqual([self.test_user, self.test_user_2], checked_records)
+
+        assertion_meta = AssertionMeta.objects.get(id=self.assertion_meta.id)
+        self.assertEqual(first_run_start, assertion_meta.last_complete_run)
+        self.assertIsNone(assertion_meta.record_watermark)
+        self.assertIsNone(assertion_meta.record_run_start)
+
+
+class ShardedModelAssertionTests(TransactionTestCase):
+    """
+    The worker processes only see committed records, so these tests cannot run in a transaction.
+    """
+    def setUp(self):
+        # The flush at teardown recreates the permissions; content types cached by earlier tests are stale by then
+        ContentType.objects.clear_cache()
+
+        self.assertion_meta = AssertionMeta.objects.create(
+            display_name='Mock model assertion', class_load_path='foo.bar', enabled=True)
+        self.mock_models = [TestModel.objects.create() for i in range(10)]
+
+    def tearDown(self):
+        ContentType.objects.clear_cache()
+
+    def test_sharded_check_and_diagnose(self):
+        """
+        Verify that records checked in worker processes get their issues
+        created, diagnosed and resolved like records checked in order.
+        """
+        ShardedTestModelAssertion.failing_pks = set(record.pk for record in self.mock_models[::2])
+        ShardedTestModelAssertion.diagnosed_records = []
+        ShardedTestModelAssertion.recovered_records = []
+
+        wont_fix_issue = ModelIssue.objects.create(
+            failed_assertion=self.assertion_meta, model=self.mock_models[0], status=IssueStatusType.WONT_FIX)
+        open_issue = ModelIssue.objects.create(
+            failed_assertion=self.assertion_meta, model=self.mock_models[2], status=IssueStatusType.IMPASSE)
+
+        # Left by an interrupted run in order; the shards cover every record anyway
+        self.assertion_meta.record_watermark = self.mock_models[5].pk
+        self.assertion_meta.save()
+
+        assertion = ShardedTestModelAssertion(self.assertion_meta)
+
+        self.assertFalse(assertion.check_and_diagnose())
+
+        self.assertEqual(self.mock_models[2::2], assertion.diagnosed_records)
+        self.assertIsNone(AssertionMeta.objects.get(id=self.assertion_meta.id).record_watermark)
+        self.assertEqual(
+            set(self.mock_models[2::2]),
+            set(issue.model for issue in ModelIssue.objects.current_issues))
+        self.assertEqual(open_issue, ModelIssue.objects.current_issues.get(model_id=self.mock_models[2].pk))
+        self.assertEqual(IssueStatusType.WONT_FIX, ModelIssue.objects.get(id=wont_fix_issue.id).status)
+
+        ShardedTestModelAssertion.failing_pks = set()
+
+        self.assertTrue(assertion.check_and_diagnose())
+
+        self.assertEqual(set(self.mock_models[2::2]), set(assertion.recovered_records))
+        self.assertFalse(ModelIssue.objects.current_issues.exists())
@@ -0,0 +1,200 @@
+import threading
+import time
+
+from django.contrib.auth.models import Group
+from django.test import TestCase
+from mock import patch
+
+from ..assertions import Assertion, ModelAssertion
+from ..jobs import get_class_load_path
+from ..models import AssertionMeta, IssueStatusType, ModelIssue
+from ..triggers import bind_assertion, TriggerQueue, unbind_assertion
+
+# Imported through its module so that nose does not collect the model as a test class
+from test_project import models as test_project_models
+
+
+class TriggeredModelAssertion(ModelAssertion):
+    """
+    Loaded by the trigger queue by its import path.
+    """
+    checked_records = []
+
+    @property
+    def queryset(self):
+        return test_project_models.TestModel.objects.all()
+
+    def check_record(self, record):
+        self.checked_records.append(record)
+        return True
+
+
+class TriggeredGroupAssertion(ModelAssertion):
+    """
+    Checks groups, which unlike the test models can be deleted in every test
+    run; nose derives a model from TestModel when it collects tests.
+    """
+    checked_records = []
+
+    @property
+    def queryset(self):
+        return Group.objects.all()
+
+    def check_record(self, record):
+        self.checked_records.append(record)
+        return True
+
+
+class TriggeredAssertion(Assertion):
+    check_count = 0
+
+    def check(self):
+        TriggeredAssertion.check_count += 1
+        return True
+
+
+class FailingTriggeredAssertion(Assertion):
+    def check(self):
+        raise RuntimeError('Check failed')
+
+
+class RecordingTriggerQueue(TriggerQueue):
+    """
+    Records flushes instead of checking anything, so the timer thread does
+    not need the database.
+    """
+    def __init__(self, *args, **kwargs):
+        super(RecordingTriggerQueue, self).__init__(*args, **kwargs)
+        self.flushed = threading.Event()
+        self.flushes = []
+
+    def flush(self):
+        self.flushes.append(self.take_pending()[0])
+        self.flushed.set()
+
+
+class TriggerTests(TestCase):
+    def setUp(self):
+        TriggeredModelAssertion.checked_records = []
+        TriggeredGroupAssertion.checked_records = []
+        TriggeredAssertion.check_count = 0
+
+        for assertion_class in [
+                TriggeredModelAssertion, TriggeredGroupAssertion, TriggeredAssertion, FailingTriggeredAssertion]:
+            AssertionMeta.objects.create(
+                display_name=assertion_class.__name__, class_load_path=get_class_load_path(assertion_class),
+                enabled=True)
+
+        self.queue = TriggerQueue(debounce_seconds=60)
+
+    def tearDown(self):
+        self.queue.take_pending()
+        unbind_assertion(TriggeredModelAssertion, test_project_models.TestModel)
+        unbind_assertion(TriggeredGroupAssertion, Group)
+        unbind_assertion(TriggeredAssertion, Group)
+
+    def test_model_assertion_checks_changed_records(self):
+        test_project_models.TestModel.objects.create()
+        bind_assertion(TriggeredModelAssertion, test_project_models.TestModel, queue=self.queue)
+
+        changed_records = [test_project_models.TestModel.objects.create() for i in range(2)]
+        changed_records[0].save()
+
+        self.assertEqual(
+            {get_class_load_path(TriggeredModelAssertion): set(record.pk for record in changed_records)},
+            self.queue.pending)
+
+        self.queue.flush()
+
+        self.assertEqual(changed_records, TriggeredModelAssertion.checked_records)
+        self.assertEqual({}, self.queue.pending)
+        self.assertIsNone(self.queue.timer)
+
+    def test_deleted_record_issues_resolved(self):
+        """
+        Verify that the issues of a deleted record are resolved, rather than
+        the record being looked for in the queryset.
+        """
+        bind_assertion(TriggeredGroupAssertion, Group, queue=self.queue)
+
+        record = Group.objects.create(name='Deleted')
+        issue = ModelIssue.objects.create(
+            failed_assertion=AssertionMeta.objects.get(display_name='TriggeredGroupAssertion'), model=record)
+        self.queue.take_pending()
+
+        record_pk = record.pk
+        record.delete()
+
+        self.assertEqual({}, self.queue.pending)
+        self.assertEqual(
+            {(get_class_load_path(TriggeredGroupAssertion), Group): set([record_pk])}, self.queue.pending_deletes)
+
+        self.queue.flush()
+
+        self.assertEqual([], TriggeredGroupAssertion.checked_records)
+        self.assertEqual(IssueStatusType.RESOLVED, ModelIssue.objects.get(id=issue.id).status)
+
+    def test_assertion_checked_once_per_flush(self):
+        bind_assertion(TriggeredAssertion, Group, queue=self.queue)
+
+        group = Group.objects.create(name='Triggered')
+        group.delete()
+
+        self.queue.flush()
+
+        self.assertEqual(1, TriggeredAssertion.check_count)
+
+    def test_unbind_assertion(self):
+        bind_assertion(TriggeredAssertion, Group, queue=self.queue)
+        unbind_assertion(TriggeredAssertion, Group)
+
+        Group.objects.create(name='Untriggered')
+
+        self.assertEqual({}, self.queue.pending)
+
+    def test_debounce(self):
+        """
+        Verify that a burst of changes is flushed once, after it ends.
+        """
+        queue = RecordingTriggerQueue(debounce_seconds=0.1)
+
+        for pk in range(5):
+            queue.enqueue('path.to.Assertion', [pk])
+
+        self.assertTrue(queue.flushed.wait(5))
+        time.sleep(0.2)
+
+        self.assertEqual([{'path.to.Assertion': set(range(5))}], queue.flushes)
+
+    def test_max_wait(self):
+        """
+        Verify that a steady stream of changes is flushed once the first
+        of them has waited for the maximum wait.
+        """
+        queue = RecordingTriggerQueue(debounce_seconds=0.2, max_wait_seconds=0.3)
+
+        for pk in range(10):
+            queue.enqueue('path.to.Assertion', [pk])
+
+            if queue.flushed.wait(0.1):
+                break
+
+        self.assertTrue(queue.flushed.is_set())
+        self.assertLess(pk, 9)
+
+    @patch('narrative.triggers.logger')
+    def test_failed_checks_skipped(self, logger_mock):
+        """
+        Verify that a class that cannot be loaded, or whose check fails,
+        does not keep the other classes from being checked.
+        """
+        self.queue.enqueue('path.to.MissingAssertion', [1])
+        self.queue.enqueue(get_class_load_path(FailingTriggeredAssertion), [1])
+        self.queue.enqueue(get_class_load_path(TriggeredAssertion), [1])
+
+        self.queue.flush()
+
+        self.assertEqual(1, TriggeredAssertion.check_count)
+        self.assertEqual({}, self.queue.pending)
+        self.assertEqual(1, logger_mock.error.call_count)
+        self.assertEqual(1, logger_mock.exception.call_count)
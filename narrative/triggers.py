@@ -0,0 +1,219 @@
+"""
+Checking assertions as soon as the records they are about change.
+
+bind_assertion connects an assertion class to the post_save and post_delete
+signals of a model.  Changes are collected in a TriggerQueue, which checks
+the affected assertions once no change has come in for the debounce period,
+so a burst of saves leads to a single check, or once changes have been
+waiting for the maximum wait, so a steady stream of saves cannot hold the
+check off forever.  ModelAssertions only check the records that changed,
+and resolve the issues of the records that were deleted, as there is
+nothing left to check; other assertions are checked as a whole.  A class that cannot be loaded or
+whose check fails is logged to the narrative.triggers logger and skipped;
+its records are left to the next regular run.
+
+The regular check_assertions runs are still needed to pick up anything that
+changes without sending signals, such as queryset updates.
+
+Settings:
+    NARRATIVE_TRIGGER_DEBOUNCE_SECONDS - quiet period before a triggered check (5)
+    NARRATIVE_TRIGGER_MAX_WAIT_SECONDS - longest a change waits for its check (60)
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+
+from .assertions import ModelAssertion
+from .executor import collect_notifications
+from .jobs import get_class_load_path
+from .models import AssertionMeta, load_class
+
+logger = logging.getLogger('narrative.triggers')
+
+
+class TriggerQueue(object):
+    """
+    Changed record primary keys waiting to be checked, per assertion class.
+    """
+    def __init__(self, debounce_seconds=None, max_wait_seconds=None):
+        self.debounce_seconds = debounce_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pending_deletes = {}
+        self.first_enqueued = None
+        self.timer = None
+
+    def get_debounce_seconds(self):
+        if self.debounce_seconds is not None:
+            return self.debounce_seconds
+
+        return getattr(settings, 'NARRATIVE_TRIGGER_DEBOUNCE_SECONDS', 5)
+
+    def get_max_wait_seconds(self):
+        if self.max_wait_seconds is not None:
+            return self.max_wait_seconds
+
+        return getattr(settings, 'NARRATIVE_TRIGGER_MAX_WAIT_SECONDS', 60)
+
+    def enqueue(self, class_load_path, pks):
+        """
+        Queue the records for a check by the assertion class, and restart
+        the debounce period, short of the maximum wait since the first
+        change that is still waiting.
+        """
+        with self.lock:
+            self.pending.setdefault(class_load_path, set()).update(pks)
+            self.restart_timer()
+
+    def enqueue_deletes(self, class_load_path, model, pks):
+        """
+        Queue the deleted records of the model for the model assertion
+        class to resolve the issues of; see enqueue.
+        """
+        with self.lock:
+            self.pending_deletes.setdefault((class_load_path, model), set()).update(pks)
+            self.restart_timer()
+
+    def restart_timer(self):
+        now = time.time()
+
+        if self.first_enqueued is None:
+            self.first_enqueued = now
+
+        if self.timer is not None:
+            self.timer.cancel()
+
+        delay = min(self.get_debounce_seconds(), self.first_enqueued + self.get_max_wait_seconds() - now)
+
+        self.timer = threading.Timer(max(delay, 0), self.flush_in_background)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def take_pending(self):
+        """
+        Take the records queued so far, as the pks to check per class and
+        the deleted pks per class and model.
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            pending = self.pending
+            pending_deletes = self.pending_deletes
+            self.pending = {}
+            self.pending_deletes = {}
+            self.first_enqueued = None
+
+            return pending, pending_deletes
+
+    def flush(self):
+        """
+        Check everything queued so far, right away.
+        """
+        pending, pending_deletes = self.take_pending()
+
+        with collect_notifications():
+            for (class_load_path, model), pks in pending_deletes.items():
+                try:
+                    resolve_deleted_records(class_load_path, model, pks)
+                except Exception:
+                    logger.exception('Resolving the deleted records of %s failed', class_load_path)
+
+            for class_load_path, pks in pending.items():
+                try:
+                    check_triggered_assertion(class_load_path, pks)
+                except Exception:
+                    logger.exception('Triggered check of %s failed', class_load_path)
+
+    def flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            # The timer thread has a connection of its own
+            connection.close()
+
+
+# Used by bind_assertion when no queue is given
+trigger_queue = TriggerQueue()
+
+
+def load_triggered_assertions(class_load_path):
+    """
+    An assertion of the class for each of its enabled assertion metas.
+    """
+    assertion_class = load_class(class_load_path)
+
+    if assertion_class is None:
+        logger.error('Could not load the triggered assertion class %s', class_load_path)
+        return []
+
+    return [
+        assertion_class(assertion_meta)
+        for assertion_meta in AssertionMeta.objects.filter(class_load_path=class_load_path, enabled=True)
+    ]
+
+
+def check_triggered_assertion(class_load_path, pks):
+    """
+    Check the changed records with each enabled assertion meta of the class.
+    """
+    for assertion in load_triggered_assertions(class_load_path):
+        if isinstance(assertion, ModelAssertion):
+            assertion.check_and_diagnose_records(pks)
+        else:
+            assertion.check_and_diagnose()
+
+
+def resolve_deleted_records(class_load_path, model, pks):
+    """
+    Resolve the issues of the deleted records with each enabled assertion
+    meta of the model assertion class.
+    """
+    for assertion in load_triggered_assertions(class_load_path):
+        assertion.resolve_deleted_record_issues(model, list(pks))
+
+
+def get_dispatch_uid(assertion_class, model):
+    return 'narrative.triggers:{0}:{1}'.format(get_class_load_path(assertion_class), get_class_load_path(model))
+
+
+def bind_assertion(assertion_class, model, get_record_pks=None, queue=None):
+    """
+    Check the assertion class's enabled assertions shortly after records of
+    the model are saved or deleted.  For ModelAssertions, get_record_pks
+    maps a changed instance to the primary keys of the records to check;
+    by default, the instance itself is checked, and once it is deleted its
+    issues are resolved.  The assertion class must be importable.
+    """
+    class_load_path = get_class_load_path(assertion_class)
+    queue = queue or trigger_queue
+
+    def record_changed(sender, instance, **kwargs):
+        queue.enqueue(class_load_path, get_record_pks(instance) if get_record_pks else [instance.pk])
+
+    def record_deleted(sender, instance, **kwargs):
+        if get_record_pks is None and issubclass(assertion_class, ModelAssertion):
+            # The record is gone from the queryset, so it cannot be checked
+            queue.enqueue_deletes(class_load_path, type(instance), [instance.pk])
+        else:
+            record_changed(sender, instance, **kwargs)
+
+    dispatch_uid = get_dispatch_uid(assertion_class, model)
+
+    post_save.connect(record_changed, sender=model, weak=False, dispatch_uid=dispatch_uid)
+    post_delete.connect(record_deleted, sender=model, weak=False, dispatch_uid=dispatch_uid)
+
+    return record_changed
+
+
+def unbind_assertion(assertion_class, model):
+    dispatch_uid = get_dispatch_uid(assertion_class, model)
+
+    post_save.disconnect(sender=model, dispatch_uid=dispatch_uid)
+    post_delete.disconnect(sender=model, dispatch_uid=dispatch_uid)
@@ -1,3 +1,6 @@
+import sys
+import traceback
+
 from .models import ResolutionStep, ResolutionStepActionType
 
 
@@ -5,3 +8,16 @@ def make_pass(current_issue, **kwargs):
     return ResolutionStep.objects.create(
         issue=current_issue, action_type=ResolutionStepActionType.PASS,
         **kwargs)
+
+
+def format_error_traceback(exc_info=None):
+    """
+    Format the exception being handled (or exc_info) for storing
+    as an error_traceback.
+    """
+    exc_type, exc_value, tb = exc_info or sys.exc_info()
+
+    return '\n'.join(
+        traceback.format_tb(tb) + [
+            str(exc_type),
+            str(exc_value)])
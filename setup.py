@@ -27,6 +27,8 @@ setup(
     packages=[
         'narrative',
         'narrative.batteries',
+        'narrative.batteries.migrations',
+        'narrative.batteries.south_migrations',
         'narrative.migrations',
         'narrative.south_migrations',
         'narrative.management',
@@ -50,12 +52,17 @@ setup(
         'django-tastypie>=0.12.1',
         'pytz>=2012h',
     ],
+    extras_require={
+        # Vectorizes the temporal clustering in narrative.batteries.uptime
+        'numpy': ['numpy'],
+    },
     tests_require=[
         'coverage',
         'flake8',
         'psycopg2',
         'django-nose',
         'mock',
+        'numpy',
         'south>=1.0.2',
         'django_dynamic_fixture',
         'django-extensions',